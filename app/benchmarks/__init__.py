@@ -0,0 +1,4 @@
+"""
+Benchmarks run against a generated datacenter instead of database.db, see python -m app.benchmarks --help.
+Results are saved as JSON so runs of two commits can be compared.
+"""
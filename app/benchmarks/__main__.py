@@ -0,0 +1,79 @@
+import argparse
+import sys
+from app.benchmarks.generator import DatacenterShape, generate
+from app.benchmarks.results import compare_results, load_results, save_results
+
+"""
+Run from repository root:
+    python -m app.benchmarks generate --racks 10000 --devices 500000
+    python -m app.benchmarks micro
+    python -m app.benchmarks load --requests 1000 --concurrency 32
+    python -m app.benchmarks load --requests 1000 --concurrency 32 --query-delay-ms 2
+    python -m app.benchmarks compare benchmark-results/micro-<old>.json benchmark-results/micro-<new>.json
+"""
+
+DEFAULT_DATABASE = "benchmark-results/datacenter.db"
+DEFAULT_RESULTS = "benchmark-results"
+
+def print_results(results: list[dict]):
+    for result in results:
+        values = "  ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items() if k != "name")
+        print(f"{result['name']:<32} {values}")
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.benchmarks", description="Datacenter API benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="Write a synthetic datacenter to a scratch SQLite file")
+    generate_parser.add_argument("--database", default=DEFAULT_DATABASE)
+    generate_parser.add_argument("--racks", type=int, default=10000)
+    generate_parser.add_argument("--devices", type=int, default=500000)
+    generate_parser.add_argument("--placed", type=float, default=0.8, help="Share of devices placed into racks")
+    generate_parser.add_argument("--seed", type=int, default=1)
+
+    micro_parser = commands.add_parser("micro", help="Packing loop, capacity validators, list mappers and response encoding")
+    micro_parser.add_argument("--database", default=DEFAULT_DATABASE)
+    micro_parser.add_argument("--repeat", type=int, default=5)
+    micro_parser.add_argument("--suggestion-devices", type=int, default=2000)
+    micro_parser.add_argument("--output", default=DEFAULT_RESULTS)
+
+    load_parser = commands.add_parser("load", help="Latency and throughput of endpoints through the ASGI app")
+    load_parser.add_argument("--database", default=DEFAULT_DATABASE)
+    load_parser.add_argument("--requests", type=int, default=500, help="Requests per endpoint")
+    load_parser.add_argument("--concurrency", type=int, default=16)
+    load_parser.add_argument("--only", action="append", help="Scenario name, for example 'GET /racks', can be repeated")
+    load_parser.add_argument("--seed", type=int, default=1)
+    load_parser.add_argument("--query-delay-ms", type=float, default=0, help="Wait added to every SQL statement")
+    load_parser.add_argument("--output", default=DEFAULT_RESULTS)
+
+    compare_parser = commands.add_parser("compare", help="Compare two saved results, exit code 1 on regression")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="Percent a metric may get worse")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        shape = DatacenterShape(args.racks, args.devices, args.placed, args.seed)
+        generate(args.database, shape)
+        print(f"Generated {args.racks} racks and {args.devices} devices in {args.database}")
+    elif args.command == "micro":
+        #Imported here, load needs to set database before app is imported
+        from app.benchmarks.micro import run_micro
+        results = run_micro(args.database, args.repeat, args.suggestion_devices)
+        print_results(results)
+        print(f"Saved to {save_results(args.output, 'micro', results, {'database': args.database, 'repeat': args.repeat})}")
+    elif args.command == "load":
+        from app.benchmarks.load import run_load
+        results = run_load(args.database, args.requests, args.concurrency, args.only, args.seed, args.query_delay_ms)
+        print_results(results)
+        info = {"database": args.database, "requests": args.requests, "concurrency": args.concurrency, "query_delay_ms": args.query_delay_ms}
+        print(f"Saved to {save_results(args.output, 'load', results, info)}")
+    elif args.command == "compare":
+        rows, regressed = compare_results(load_results(args.old), load_results(args.new), args.threshold)
+        for row in rows:
+            flag = "  REGRESSION" if row["regression"] else ""
+            print(f"{row['name']:<32} {row['metric']:<20} {row['old']:>12.2f} {row['new']:>12.2f} {row['change_percent']:>+8.1f}%{flag}")
+        sys.exit(1 if regressed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import math
+import os
+import random
+from itertools import islice
+from typing import Iterator
+from sqlalchemy import bindparam, event, insert, update
+from sqlmodel import SQLModel, create_engine
+from app.models import Device, Rack
+
+"""
+Synthetic datacenter in a scratch SQLite file.
+Same seed and shape always give the same rows, so benchmark runs of different commits see the same data.
+"""
+
+#(value, weight) pairs, rack sizes and power feeds seen in typical colocation rooms
+RACK_UNITS = [(42, 70), (45, 10), (48, 20)]
+RACK_POWER = [(5000, 30), (8000, 40), (12000, 20), (17300, 10)]
+DEVICE_UNITS = [(1, 45), (2, 35), (4, 15), (8, 4), (10, 1)]
+#Watts per unit of a device are log-normal around this median
+DEVICE_WATTS_PER_UNIT = 250
+#Racks are filled up to this share of power feed, the usual derating, so there is room left for /suggestion
+RACK_POWER_FILL = 0.8
+INSERT_CHUNK = 10000
+
+class DatacenterShape:
+    def __init__(self, racks: int, devices: int, placed: float = 0.8, seed: int = 1):
+        self.racks = racks
+        self.devices = devices
+        #Share of devices that get a rack, rest stays unassigned for /suggestion
+        self.placed = placed
+        self.seed = seed
+
+    def as_dict(self) -> dict:
+        return {"racks": self.racks, "devices": self.devices, "placed": self.placed, "seed": self.seed}
+
+def choose(rng: random.Random, options: list[tuple[int, int]]) -> int:
+    return rng.choices([value for value, _ in options], weights=[weight for _, weight in options])[0]
+
+def generate_racks(rng: random.Random, shape: DatacenterShape) -> list[dict]:
+    return [{
+        "id": i, "name": f"R{i:06d}", "description": f"Row {i // 20 + 1} position {i % 20 + 1}",
+        "serial_number": f"BR-{i:08d}", "unit_capacity": choose(rng, RACK_UNITS),
+        "max_power_consumption": choose(rng, RACK_POWER), "used_units": 0, "used_power": 0,
+    } for i in range(1, shape.racks + 1)]
+
+def generate_devices(rng: random.Random, shape: DatacenterShape, racks: list[dict]) -> Iterator[dict]:
+    #Devices are placed while they are generated, usage counters of racks are updated in place
+    for i in range(1, shape.devices + 1):
+        units = choose(rng, DEVICE_UNITS)
+        watts = units * DEVICE_WATTS_PER_UNIT * math.exp(rng.gauss(0, 0.5))
+        device = {
+            "id": i, "name": f"D{i:07d}", "description": f"Server model {rng.randint(1, 40)}",
+            "serial_number": f"BD-{i:08d}", "unit_size": units, "power_consumption": max(int(watts), 10), "rack_id": None,
+        }
+        if racks and rng.random() < shape.placed:
+            #A few random racks are tried, full datacenters leave some devices unassigned
+            for _ in range(4):
+                rack = racks[rng.randrange(len(racks))]
+                if (rack["used_units"] + units <= rack["unit_capacity"]
+                        and rack["used_power"] + device["power_consumption"] <= rack["max_power_consumption"] * RACK_POWER_FILL):
+                    rack["used_units"] += units
+                    rack["used_power"] += device["power_consumption"]
+                    device["rack_id"] = rack["id"]
+                    break
+        yield device
+
+def generate(path: str, shape: DatacenterShape):
+    """
+    Write datacenter of given shape to a new SQLite file at path, existing file is replaced.
+    Devices are generated and inserted in chunks, so memory does not grow with number of devices.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    for suffix in ("", "-wal", "-shm", "-version"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rng = random.Random(shape.seed)
+    racks = generate_racks(rng, shape)
+
+    engine = create_engine(f"sqlite:///{path}")
+    #File is thrown away if generation fails, durability is not needed while it is written
+    event.listen(engine, "connect", lambda connection, record: connection.execute("PRAGMA synchronous=OFF"))
+    SQLModel.metadata.create_all(engine)
+    rack_table, device_table = Rack.__table__, Device.__table__
+    with engine.begin() as connection:
+        if racks:
+            connection.execute(insert(rack_table), racks)
+        devices = generate_devices(rng, shape, racks)
+        while chunk := list(islice(devices, INSERT_CHUNK)):
+            connection.execute(insert(device_table), chunk)
+        if racks:
+            usage = [{"rack": r["id"], "units": r["used_units"], "power": r["used_power"]} for r in racks]
+            connection.execute(
+                update(rack_table).where(rack_table.c.id == bindparam("rack"))
+                .values(used_units=bindparam("units"), used_power=bindparam("power")),
+                usage
+            )
+    engine.dispose()
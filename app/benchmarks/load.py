@@ -0,0 +1,116 @@
+import asyncio
+import os
+import random
+import sqlite3
+import time
+from typing import Callable
+
+"""
+In-process HTTP load harness, requests go through the whole ASGI app without a network or uvicorn.
+Every scenario is one endpoint called with random ids of the generated datacenter by concurrency clients at once.
+Generated database is usually in page cache, query_delay_ms adds a wait to every statement as a slow disk or
+a busy lock would, the wait blocks the thread that runs the statement.
+"""
+
+def scenarios(ids: dict) -> dict[str, Callable[[random.Random], str]]:
+    racks, devices, unassigned = ids["racks"], ids["devices"], ids["unassigned"]
+    return {
+        "GET /racks": lambda rng: f"/racks/?limit=100&after={rng.randint(0, max(racks - 100, 0))}",
+        "GET /racks/{id}": lambda rng: f"/racks/{rng.randint(1, racks)}",
+        "GET /racks/fit": lambda rng: f"/racks/fit?units={rng.choice([1, 2, 4])}&power={rng.randint(100, 1500)}",
+        "GET /devices": lambda rng: f"/devices/?limit=100&after={rng.randint(0, max(devices - 100, 0))}",
+        "GET /devices/{id}": lambda rng: f"/devices/{rng.randint(1, devices)}",
+        "GET /devices?q": lambda rng: f"/devices/?q=model {rng.randint(1, 40)}&limit=50",
+        #Random devices so most requests miss the suggestion cache
+        "GET /suggestion": lambda rng: "/suggestion/?incremental=true&strategy=best_fit_decreasing&" + "&".join(
+            f"device_ids={id}" for id in rng.sample(unassigned, min(20, len(unassigned)))),
+    }
+
+def read_ids(path: str) -> dict:
+    connection = sqlite3.connect(path)
+    try:
+        racks = connection.execute("SELECT coalesce(max(id), 0) FROM rack").fetchone()[0]
+        devices = connection.execute("SELECT coalesce(max(id), 0) FROM device").fetchone()[0]
+        unassigned = [row[0] for row in connection.execute("SELECT id FROM device WHERE rack_id IS NULL LIMIT 10000")]
+    finally:
+        connection.close()
+    return {"racks": racks, "devices": devices, "unassigned": unassigned}
+
+def add_query_delay(dbapi_connection, query_delay_ms: float):
+    #Trace callback runs in the thread that executes the statement, for aiosqlite that is its worker thread, not the event loop
+    from sqlalchemy.util import await_only
+    delay = lambda statement: time.sleep(query_delay_ms / 1000)
+    await_only(dbapi_connection.driver_connection.set_trace_callback(delay))
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    #Nearest rank, the value below which percent of requests finished
+    if not sorted_values:
+        return 0.0
+    rank = max(int(len(sorted_values) * percent / 100 + 0.5), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+async def run_scenario(client, name: str, make_url, requests: int, concurrency: int, seed: int) -> dict:
+    rng = random.Random(f"{seed}-{name}")
+    for _ in range(min(10, requests)):
+        await client.get(make_url(rng))
+
+    latencies: list[float] = []
+    #Planning answers 400 when devices do not fit, so status codes are counted instead of treated as failures
+    status_codes: dict[str, int] = {}
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            url = make_url(rng)
+            start = time.perf_counter()
+            response = await client.get(url)
+            latencies.append(time.perf_counter() - start)
+            status_codes[str(response.status_code)] = status_codes.get(str(response.status_code), 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "name": name,
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "status_codes": status_codes,
+        "requests_per_second": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+def run_load(path: str, requests: int = 500, concurrency: int = 16, only: list[str] | None = None, seed: int = 1,
+             query_delay_ms: float = 0) -> list[dict]:
+    """
+    App reads settings when it is first imported, so this has to run in a process that did not import it yet.
+    Environment variables such as READ_MODEL apply as for the server.
+    """
+    url = f"sqlite+aiosqlite:///{os.path.abspath(path)}"
+    os.environ["DATABASE_URL"] = url
+    import httpx
+    from sqlalchemy import event
+    from app.database import engine
+    from app.main import app
+    from app.settings import settings
+    if settings.database_url != url:
+        raise RuntimeError("App was already imported with another DATABASE_URL, run load benchmark in a new process.")
+    if query_delay_ms > 0:
+        event.listen(engine.sync_engine, "connect", lambda dbapi_connection, record: add_query_delay(dbapi_connection, query_delay_ms))
+
+    selected = {name: make_url for name, make_url in scenarios(read_ids(path)).items() if not only or name in only}
+
+    async def run():
+        results = []
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+                for name, make_url in selected.items():
+                    results.append(await run_scenario(client, name, make_url, requests, concurrency, seed))
+        return results
+    return asyncio.run(run())
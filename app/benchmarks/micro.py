@@ -0,0 +1,127 @@
+import asyncio
+import statistics
+import time
+from typing import Callable
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.routing import APIRoute, serialize_response
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.main import app
+from app.models import Device, Rack
+from app.planner import PackingStrategy, PlacementError, pack
+from app.routers.devices import map_device_form, power_consumption_validation, unit_size_validation
+from app.routers.racks import map_rack_form
+from app.routers.suggestion import map_suggestion, map_suggestion_info
+from app.routers.usage_helper import bulk_rack_capacity_validation
+
+"""
+Micro benchmarks of code that runs for every row: packing loop of /suggestion, capacity validators, list mappers
+and encoding of responses.
+Inputs are read once from a generated datacenter, only the measured function runs in the timed loop.
+"""
+
+def measure(name: str, fn: Callable[[], object], repeat: int, items: int) -> dict:
+    #Median of repeat runs, items is number of rows one run handles
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    median = statistics.median(timings)
+    return {
+        "name": name,
+        "median_ms": median * 1000,
+        "min_ms": min(timings) * 1000,
+        "items": items,
+        "items_per_second": items / median if median else None,
+    }
+
+def load_input(path: str, suggestion_devices: int) -> tuple[list[Rack], list[Device], list[Device]]:
+    #Racks in /suggestion order, placed devices and unassigned devices with most power first
+    with Session(create_engine(f"sqlite:///{path}")) as session:
+        racks = session.exec(select(Rack).order_by(Rack.max_power_consumption.desc(), Rack.id)).all()
+        placed = session.exec(select(Device).where(Device.rack_id.is_not(None)).order_by(Device.id)).all()
+        unassigned = session.exec(select(Device).where(Device.rack_id.is_(None))
+                                  .order_by(Device.power_consumption.desc(), Device.id).limit(suggestion_devices)).all()
+    return racks, placed, unassigned
+
+def pack_benchmarks(racks: list[Rack], devices: list[Device], repeat: int) -> list[dict]:
+    results = []
+    for strategy in PackingStrategy:
+        def run():
+            try:
+                map_suggestion(racks, devices, pack(racks, devices, strategy, occupied=True), True)
+            except PlacementError:
+                #Full datacenter is still a valid measurement of the search
+                pass
+        results.append(measure(f"pack/{strategy.value}", run, repeat, len(devices)))
+    return results
+
+def validator_benchmarks(path: str, racks: list[Rack], placed: list[Device], repeat: int) -> list[dict]:
+    racks_by_id = {r.id: r for r in racks}
+    moves = [Device(id=d.id, unit_size=d.unit_size, power_consumption=d.power_consumption, rack_id=racks[i % len(racks)].id)
+             for i, d in enumerate(placed[:1000])]
+    current = {d.id: d for d in placed[:1000]}
+
+    def single():
+        for device in moves:
+            rack = racks_by_id[device.rack_id]
+            try:
+                power_consumption_validation(rack, device, current[device.id])
+                unit_size_validation(rack, device, current[device.id])
+            except Exception:
+                pass
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async def bulk():
+        async with AsyncSession(engine) as session:
+            await bulk_rack_capacity_validation(moves, current, session, {})
+
+    results = [
+        measure("validate/single", single, repeat, len(moves)),
+        measure("validate/bulk", lambda: asyncio.run(bulk()), repeat, len(moves)),
+    ]
+    asyncio.run(engine.dispose())
+    return results
+
+def mapper_benchmarks(racks: list[Rack], placed: list[Device], repeat: int) -> list[dict]:
+    rack_names = {r.id: r.name for r in racks}
+    devices = placed[:10000]
+    return [
+        measure("map/racks", lambda: [map_rack_form(r).model_dump_json() for r in racks], repeat, len(racks)),
+        measure("map/devices", lambda: [map_device_form(d, rack_names.get(d.rack_id)).model_dump_json() for d in devices], repeat, len(devices)),
+    ]
+
+def encode_benchmarks(racks: list[Rack], placed: list[Device], repeat: int) -> list[dict]:
+    #Response of already mapped rows, through response_model and response class of the route as the app does it
+    routes = {(route.path, method): route for route in app.routes if isinstance(route, APIRoute) for method in route.methods}
+    rack_names = {r.id: r.name for r in racks}
+    devices = placed[:10000]
+    #Plan of the size of whole datacenter, every rack with devices that are in it now
+    devices_of_rack: dict[int, list[Device]] = {}
+    for device in placed:
+        devices_of_rack.setdefault(device.rack_id, []).append(device)
+    suggestion = [map_suggestion_info(r, devices_of_rack.get(r.id, [])) for r in racks]
+
+    def encode(path: str, content):
+        route = routes[(path, "GET")]
+        response_class = route.response_class
+        if isinstance(response_class, DefaultPlaceholder):
+            response_class = response_class.value
+        async def run():
+            return response_class(await serialize_response(field=route.response_field, response_content=content, is_coroutine=True))
+        return lambda: asyncio.run(run())
+
+    return [
+        measure("encode/racks", encode("/racks/", [map_rack_form(r) for r in racks]), repeat, len(racks)),
+        measure("encode/devices", encode("/devices/", [map_device_form(d, rack_names.get(d.rack_id)) for d in devices]), repeat, len(devices)),
+        measure("encode/suggestion", encode("/suggestion/", suggestion), repeat, len(suggestion)),
+    ]
+
+def run_micro(path: str, repeat: int = 5, suggestion_devices: int = 2000) -> list[dict]:
+    racks, placed, unassigned = load_input(path, suggestion_devices)
+    return (pack_benchmarks(racks, unassigned, repeat)
+            + validator_benchmarks(path, racks, placed, repeat)
+            + mapper_benchmarks(racks, placed, repeat)
+            + encode_benchmarks(racks, placed, repeat))
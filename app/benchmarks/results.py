@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import time
+
+"""Benchmark results saved as JSON, one file per run, named after the commit it ran on."""
+
+#Metric compared between runs and whether a higher value is better
+METRICS = {"micro": [("median_ms", False)], "load": [("p50_ms", False), ("p99_ms", False), ("requests_per_second", True)]}
+
+def current_commit() -> str | None:
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+def save_results(directory: str, kind: str, results: list[dict], info: dict) -> str:
+    os.makedirs(directory, exist_ok=True)
+    commit = current_commit()
+    created_at = time.strftime("%Y%m%d-%H%M%S")
+    content = {"kind": kind, "commit": commit, "created_at": created_at, "info": info, "results": results}
+    path = os.path.join(directory, f"{kind}-{commit or 'unknown'}-{created_at}.json")
+    with open(path, "w") as file:
+        json.dump(content, file, indent=2)
+    return path
+
+def load_results(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+def compare_results(old: dict, new: dict, threshold_percent: float) -> tuple[list[dict], bool]:
+    """Change of every metric in percent, returns rows and whether any got worse by more than threshold."""
+    if old["kind"] != new["kind"]:
+        raise ValueError(f"Cannot compare {old['kind']} results with {new['kind']} results.")
+    old_results = {r["name"]: r for r in old["results"]}
+    rows = []
+    regressed = False
+    for result in new["results"]:
+        before = old_results.get(result["name"])
+        if before is None:
+            continue
+        for metric, higher_is_better in METRICS[new["kind"]]:
+            if not before.get(metric) or result.get(metric) is None:
+                continue
+            change = (result[metric] - before[metric]) / before[metric] * 100
+            worse = -change if higher_is_better else change
+            rows.append({"name": result["name"], "metric": metric, "old": before[metric], "new": result[metric],
+                         "change_percent": change, "regression": worse > threshold_percent})
+            regressed = regressed or worse > threshold_percent
+    return rows, regressed
@@ -0,0 +1,82 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+#Result of in-flight computation whose caller was cancelled
+CANCELLED = object()
+
+class ResultCache:
+    """
+    LRU cache with size and TTL limits for results of expensive computations.
+    Keys should contain inventory version so entries stop matching once data changes.
+    Concurrent calls for the same missing key wait for a single computation instead of starting their own.
+    """
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.in_flight: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        if self.max_size <= 0:
+            return await compute()
+
+        while True:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return value
+                del self.entries[key]
+
+            future = self.in_flight.get(key)
+            if future is None:
+                break
+            self.coalesced += 1
+            #shield so one cancelled waiter does not cancel result for others
+            value = await asyncio.shield(future)
+            if value is not CANCELLED:
+                return value
+            #Call that computed was cancelled, first waiter to wake up computes instead
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            #Cancellation is not a result of compute, waiters must not get it
+            future.set_result(CANCELLED)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            #exception is retrieved so it is not reported when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+
+        future.set_result(value)
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+        }
@@ -1,9 +1,80 @@
-from sqlmodel import SQLModel, create_engine, Session, select
+import time
+from sqlalchemy import event, inspect, make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlmodel import SQLModel, func, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .metrics import CONNECTION_WAIT_SECONDS, WRITE_LOCK_WAIT_SECONDS, install_engine_metrics
 from .models import *
+from .profiling import diagnostics_enabled, install_engine_profiling
+from .settings import settings
 
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
-engine = create_engine(sqlite_url, echo=True)
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    #Checkout waits here when all pool_size + max_overflow connections are in use
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            CONNECTION_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+def create_engine_from_settings():
+    url = make_url(settings.database_url)
+    options = {}
+    #In memory SQLite uses a single static connection, pool size does not apply
+    if url.database not in (None, "", ":memory:"):
+        options["pool_size"] = settings.database_pool_size
+        options["max_overflow"] = settings.database_max_overflow
+        if settings.metrics:
+            options["poolclass"] = TimedQueuePool
+
+    new_engine = create_async_engine(url, echo=settings.database_echo, **options)
+    if new_engine.dialect.name == "sqlite":
+        event.listen(new_engine.sync_engine, "connect", set_sqlite_pragmas)
+        event.listen(new_engine.sync_engine, "begin", begin_sqlite_transaction)
+    if settings.metrics:
+        install_engine_metrics(new_engine.sync_engine)
+    if diagnostics_enabled():
+        install_engine_profiling(new_engine.sync_engine)
+    return new_engine
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    #Driver must not start transactions on its own, begin_sqlite_transaction starts them
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+    cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}")
+    cursor.execute(f"PRAGMA cache_size={settings.sqlite_cache_size}")
+    cursor.execute(f"PRAGMA mmap_size={settings.sqlite_mmap_size}")
+    cursor.close()
+
+def begin_sqlite_transaction(connection):
+    """
+    Transactions of write_engine start with BEGIN IMMEDIATE, they take the write lock before their first read
+    so checks of capacity and serial numbers cannot race with a writer in another process.
+    A deferred transaction that writes later would fail with SQLITE_BUSY instead of waiting for the lock.
+    Busy timeout waits for the lock, BEGIN is retried if it is still held after that.
+    """
+    mode = connection.get_execution_options().get("sqlite_begin", "DEFERRED")
+    start = time.perf_counter()
+    for attempt in range(settings.sqlite_busy_retries + 1):
+        try:
+            connection.exec_driver_sql(f"BEGIN {mode}")
+            break
+        except OperationalError as e:
+            if not is_database_busy(e) or attempt == settings.sqlite_busy_retries:
+                raise
+    if mode == "IMMEDIATE":
+        WRITE_LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+def is_database_busy(error: OperationalError) -> bool:
+    return "database is locked" in str(error.orig) or "database is busy" in str(error.orig)
+
+engine = create_engine_from_settings()
+#Same pool, transactions hold the write lock from the start
+write_engine = engine.execution_options(sqlite_begin="IMMEDIATE")
 
 """
 Important: Rows used in test cases have 'Test' in their name. 
@@ -11,11 +82,17 @@ Tests will fail if you change values of unit_capacity or max_power_consumption
 on Rack or power_consumption and unit_size on Device.
 """
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    #Objects are returned from routes after commit so they must not be expired
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+
+async def get_write_session():
+    #For routes that write, see begin_sqlite_transaction
+    async with AsyncSession(write_engine, expire_on_commit=False) as session:
         yield session
 
-def create_dummy_data():
+async def create_dummy_data():
     rack = [
         Rack(name="R1", description="R1 desc", serial_number="SN-001", unit_capacity=10, max_power_consumption=2000),
         Rack(name="R2", description="R2 desc", serial_number="SN-002", unit_capacity=12, max_power_consumption=1500),
@@ -74,9 +151,10 @@ def create_dummy_data():
             unit_size=1, power_consumption=500),
     ]
 
-    with Session(engine) as session:
+    #Workers start at the same time, only the first one to get the write lock inserts data
+    async with AsyncSession(write_engine) as session:
         #Check if data already exists in db
-        query: list[Rack] = session.exec(select(Rack)).all()
+        query: list[Rack] = (await session.exec(select(Rack))).all()
         if(len(query) > 0):
             return
 
@@ -94,8 +172,63 @@ def create_dummy_data():
         for item in devices_for_test:
             session.add(item)
 
-        session.commit()
+        await session.flush()
+        await recompute_rack_usage(session)
+        await session.commit()
+
+
+async def recompute_rack_usage(session: AsyncSession) -> int:
+    """
+    Rebuild used_units and used_power of every rack from the device table.
+    Repairs counters if they ever drift from the devices, returns number of racks updated.
+    """
+    used_units = select(func.coalesce(func.sum(Device.unit_size), 0)).where(Device.rack_id == Rack.id).scalar_subquery()
+    used_power = select(func.coalesce(func.sum(Device.power_consumption), 0)).where(Device.rack_id == Rack.id).scalar_subquery()
+    result = await session.exec(update(Rack).values(used_units=used_units, used_power=used_power))
+    return result.rowcount
+
+
+async def migrate_db():
+    """Bring database files created by older versions up to date, create_all does not alter existing tables."""
+    async with AsyncSession(write_engine) as session:
+        connection = await session.connection()
+        rack_columns = await connection.run_sync(lambda c: [col["name"] for col in inspect(c).get_columns("rack")])
+        if "used_units" not in rack_columns:
+            await connection.exec_driver_sql("ALTER TABLE rack ADD COLUMN used_units INTEGER NOT NULL DEFAULT 0")
+        if "used_power" not in rack_columns:
+            await connection.exec_driver_sql("ALTER TABLE rack ADD COLUMN used_power INTEGER NOT NULL DEFAULT 0")
+        if "used_units" not in rack_columns or "used_power" not in rack_columns:
+            await recompute_rack_usage(session)
+
+        await connection.run_sync(create_missing_indexes)
+
+        #Registry table is new in old files, triggers keep it filled from now on.
+        #Serial numbers repeated across racks and devices by older versions are registered once.
+        if (await session.exec(select(func.count()).select_from(SerialNumber))).one() == 0:
+            await connection.exec_driver_sql(
+                "INSERT OR IGNORE INTO serial_number (serial_number, owner_table, owner_id) "
+                "SELECT serial_number, 'rack', id FROM rack UNION ALL SELECT serial_number, 'device', id FROM device"
+            )
+
+        #Search index is empty when virtual table was just created for existing rows
+        for table in FULL_TEXT_SEARCH_TABLES:
+            indexed = (await connection.exec_driver_sql(f"SELECT count(*) FROM {table}_fts_docsize")).scalar()
+            rows = (await connection.exec_driver_sql(f"SELECT count(*) FROM {table}")).scalar()
+            if indexed != rows:
+                await connection.exec_driver_sql(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+        await session.commit()
+
+def create_missing_indexes(connection):
+    #Inspector does not report expression indexes so existing names are read from sqlite_master
+    existing = set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").scalars())
+    for table in (Rack.__table__, Device.__table__):
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
 
 
-def create_db():
-    SQLModel.metadata.create_all(engine)
\ No newline at end of file
+async def create_db():
+    #Holding the write lock, workers starting together do not create the same tables twice
+    async with write_engine.begin() as connection:
+        await connection.run_sync(SQLModel.metadata.create_all)
+    await migrate_db()
\ No newline at end of file
@@ -0,0 +1,167 @@
+import asyncio
+import multiprocessing
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from typing import Any, Awaitable, Callable
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    TIMED_OUT = "timed_out"
+
+class QueueFullError(Exception):
+    pass
+
+class Job:
+    def __init__(self, kind: str, fn: Callable, args: tuple, finish: Callable[[Any], Any]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = JobStatus.QUEUED
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.result: Any = None
+        self.error: str | None = None
+        #Set by the caller, for example ETag of data the job was planned from
+        self.etag: str | None = None
+        self.fn = fn
+        self.args = args
+        #Runs in the event loop on value returned from worker process, result of job is what it returns
+        self.finish = finish
+
+    def complete(self, status: JobStatus, result: Any = None, error: str | None = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        #Inputs can be large, they are not needed any more
+        self.args = ()
+
+class JobQueue:
+    """
+    Runs CPU bound jobs in a process pool so they never block the event loop.
+    At most max_workers jobs run at once and at most max_pending are queued or running, more are rejected.
+    Worker process cannot be interrupted, so a cancelled or timed out job keeps its worker until it finishes
+    but its result is dropped. Finished jobs are kept for polling, oldest are dropped above keep_finished.
+    on_change is scheduled whenever a job starts or finishes, for example to share its status with other processes.
+    cancelled is awaited when a running job ends, before it gets its status, for example to find a cancel made through another process.
+    """
+    def __init__(
+        self,
+        max_workers: int,
+        max_pending: int,
+        timeout_seconds: float,
+        keep_finished: int,
+        on_change: Callable[[Job], Awaitable[None]] | None = None,
+        cancelled: Callable[[Job], Awaitable[bool]] | None = None
+    ):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout_seconds = timeout_seconds
+        self.keep_finished = keep_finished
+        self.on_change = on_change
+        self.cancelled = cancelled
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.waiting: deque[Job] = deque()
+        self.running = 0
+        self.executor: ProcessPoolExecutor | None = None
+
+    def submit(self, kind: str, fn: Callable, args: tuple, finish: Callable[[Any], Any]) -> Job:
+        """fn and args must be picklable, fn is usually a module level function."""
+        if len(self.waiting) + self.running >= self.max_pending:
+            raise QueueFullError(f"Job queue is full, at most {self.max_pending} jobs can be queued or running.")
+        job = Job(kind, fn, args, finish)
+        self.jobs[job.id] = job
+        self.waiting.append(job)
+        self.drop_finished()
+        self.start_waiting()
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job: Job):
+        if job.status == JobStatus.QUEUED:
+            self.waiting.remove(job)
+            job.complete(JobStatus.CANCELLED)
+        elif job.status == JobStatus.RUNNING:
+            job.complete(JobStatus.CANCELLED)
+        self.changed(job)
+
+    def start_waiting(self):
+        while self.waiting and self.running < self.max_workers:
+            job = self.waiting.popleft()
+            self.running += 1
+            job.status = JobStatus.RUNNING
+            job.started_at = time.time()
+            future = asyncio.wrap_future(self.get_executor().submit(job.fn, *job.args))
+            asyncio.ensure_future(self.watch(job, future))
+            self.changed(job)
+
+    async def watch(self, job: Job, future: asyncio.Future):
+        try:
+            value = await asyncio.wait_for(asyncio.shield(future), self.timeout_seconds)
+        except asyncio.TimeoutError:
+            if await self.still_running(job):
+                job.complete(JobStatus.TIMED_OUT, error=f"Job did not finish in {self.timeout_seconds} seconds.")
+                self.changed(job)
+            #Worker is still busy, next job is started only once it is free
+            await asyncio.wait([future])
+        except Exception as e:
+            if await self.still_running(job):
+                job.complete(JobStatus.FAILED, error=str(e))
+        else:
+            if await self.still_running(job):
+                try:
+                    job.complete(JobStatus.DONE, result=job.finish(value))
+                except Exception as e:
+                    job.complete(JobStatus.FAILED, error=str(e))
+        finally:
+            self.running -= 1
+            if job.status != JobStatus.TIMED_OUT:
+                self.changed(job)
+            self.start_waiting()
+
+    async def still_running(self, job: Job) -> bool:
+        if job.status == JobStatus.RUNNING and self.cancelled is not None:
+            try:
+                if await self.cancelled(job):
+                    job.complete(JobStatus.CANCELLED)
+            except Exception:
+                #Job keeps its outcome if the check cannot be made
+                pass
+        return job.status == JobStatus.RUNNING
+
+    def changed(self, job: Job):
+        if self.on_change is not None:
+            asyncio.ensure_future(self.on_change(job))
+
+    def drop_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self.jobs[job_id]
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            #Spawned workers do not inherit threads and open database connections of the server process
+            self.executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.waiting),
+            "running": self.running,
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+        }
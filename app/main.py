@@ -1,20 +1,53 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
-from .database import create_db, create_dummy_data
-from app.routers import racks, devices, suggestion
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
+from sqlalchemy.exc import OperationalError
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .database import create_db, create_dummy_data, is_database_busy, write_engine
+from .metrics import MetricsMiddleware, render_metrics
+from .profiling import ProfilingMiddleware, diagnostics_enabled
+from .settings import settings
+from app.routers import racks, devices, suggestion, inventory, debug
+from app.routers.version_helper import get_inventory_version, version_signal
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    create_db()
-    create_dummy_data()
+    await create_db()
+    await create_dummy_data()
+    #Signal file may be new or left by an older database, it is read under the write lock so no writer is in between
+    async with AsyncSession(write_engine) as session:
+        version_signal.publish(await get_inventory_version(session))
     yield
+    suggestion.job_queue.shutdown()
 
-app = FastAPI(lifespan=lifespan)
+#Routes declare response_model, so responses are serialized by pydantic and encoded by orjson without jsonable_encoder
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.include_router(racks.router)
 app.include_router(devices.router)
 app.include_router(suggestion.router)
+app.include_router(inventory.router)
+if settings.profiling:
+    app.include_router(debug.router)
 
-@app.get("/")
+if diagnostics_enabled():
+    #Added first so metrics middleware wraps it and its time is part of request latency
+    app.add_middleware(ProfilingMiddleware)
+if settings.metrics:
+    app.add_middleware(MetricsMiddleware)
+
+    #async so it renders on the event loop thread where metrics are written
+    @app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+    async def metrics():
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.exception_handler(OperationalError)
+async def database_busy(request: Request, error: OperationalError):
+    #Write lock was not free after all retries, client can try again
+    if not is_database_busy(error):
+        raise error
+    return JSONResponse(status_code=503, content={"detail": "Database is busy, try again."}, headers={"Retry-After": "1"})
+
+@app.get("/", response_model=dict[str, str])
 def home():
     return {"hello": "world"}
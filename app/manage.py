@@ -0,0 +1,31 @@
+import argparse
+import asyncio
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.database import create_db, engine, recompute_rack_usage
+from app.routers.version_helper import RACK_TABLE, bump_inventory_version
+
+"""
+Maintenance commands, run from repository root:
+    python -m app.manage recompute-usage
+"""
+
+async def recompute_usage():
+    await create_db()
+    async with AsyncSession(engine) as session:
+        count = await recompute_rack_usage(session)
+        #Running servers see the change through version, their caches and read models are refreshed
+        await bump_inventory_version(session, RACK_TABLE)
+        await session.commit()
+    print(f"Recomputed usage of {count} racks")
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.manage", description="Datacenter API maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("recompute-usage", help="Rebuild used_units and used_power of every rack from its devices")
+
+    args = parser.parse_args()
+    if args.command == "recompute-usage":
+        asyncio.run(recompute_usage())
+
+if __name__ == "__main__":
+    main()
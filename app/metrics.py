@@ -0,0 +1,171 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from sqlalchemy import event
+
+"""
+Metrics in Prometheus text format, served by GET /metrics.
+Values live in memory of the process, with several workers every process exports its own.
+All observations happen on the event loop thread, so plain increments are enough.
+"""
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+#Planning time is labeled by these size classes instead of exact counts, so number of series stays small
+SIZE_CLASSES = (10, 100, 1000, 10000, 100000)
+
+class Histogram:
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...], buckets: tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        #Labels to [count per bucket with +Inf last, sum]
+        self.series: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.series.items()):
+            label_text = format_labels(self.label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{{{label_text}{',' if label_text else ''}le=\"{le}\"}} {cumulative}")
+            suffix = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.series: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float, *labels: str):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.series.items()):
+            label_text = format_labels(self.label_names, labels)
+            lines.append(f"{self.name}{{{label_text}}} {value}" if label_text else f"{self.name} {value}")
+        return lines
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+def size_class(count: int) -> str:
+    for bound in SIZE_CLASSES:
+        if count <= bound:
+            return f"<={bound}"
+    return f">{SIZE_CLASSES[-1]}"
+
+REQUEST_SECONDS = Histogram(
+    "datacenter_http_request_duration_seconds", "Time from request start until response body was sent.",
+    ("method", "route", "status"), LATENCY_BUCKETS)
+REQUEST_STATEMENTS = Histogram(
+    "datacenter_http_request_sql_statements", "SQL statements executed by one request.",
+    ("method", "route"), STATEMENT_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram(
+    "datacenter_http_request_sql_duration_seconds", "Time one request spent executing SQL statements.",
+    ("method", "route"), LATENCY_BUCKETS)
+SQL_STATEMENTS = Counter(
+    "datacenter_sql_statements_total", "SQL statements executed, by first keyword.", ("operation",))
+SQL_SECONDS = Counter(
+    "datacenter_sql_duration_seconds_total", "Time spent executing SQL statements, by first keyword.", ("operation",))
+CONNECTION_WAIT_SECONDS = Histogram(
+    "datacenter_db_connection_wait_seconds", "Time spent getting a connection from the pool, opening a new one included.", (), WAIT_BUCKETS)
+WRITE_LOCK_WAIT_SECONDS = Histogram(
+    "datacenter_db_write_lock_wait_seconds", "Time BEGIN IMMEDIATE waited for the SQLite write lock, retries included.", (), WAIT_BUCKETS)
+PLANNING_SECONDS = Histogram(
+    "datacenter_suggestion_planning_seconds", "Time spent placing devices into racks by /suggestion, without loading input.",
+    ("strategy", "mode", "devices", "racks"), LATENCY_BUCKETS)
+
+METRICS = [REQUEST_SECONDS, REQUEST_STATEMENTS, REQUEST_SQL_SECONDS, SQL_STATEMENTS, SQL_SECONDS,
+           CONNECTION_WAIT_SECONDS, WRITE_LOCK_WAIT_SECONDS, PLANNING_SECONDS]
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+class RequestStats:
+    __slots__ = ("statements", "sql_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+#Set by MetricsMiddleware for the duration of a request, SQL events add to it
+current_request: ContextVar[RequestStats | None] = ContextVar("current_request", default=None)
+
+def observe_planning(strategy: str, mode: str, devices: int, racks: int, seconds: float):
+    PLANNING_SECONDS.observe(seconds, strategy, mode, size_class(devices), size_class(racks))
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info["metrics_start"].pop()
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "EMPTY"
+    SQL_STATEMENTS.inc(1, operation)
+    SQL_SECONDS.inc(elapsed, operation)
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.sql_seconds += elapsed
+
+def handle_error(context):
+    #Failed statement does not reach after_cursor_execute
+    start = context.connection.info.get("metrics_start") if context.connection is not None else None
+    if start:
+        start.pop()
+
+def install_engine_metrics(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(sync_engine, "handle_error", handle_error)
+
+class MetricsMiddleware:
+    """Plain ASGI middleware, it does not wrap request or response objects so it adds almost no overhead."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            #Route template keeps ids out of labels
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            REQUEST_SECONDS.observe(elapsed, method, path, str(status))
+            REQUEST_STATEMENTS.observe(stats.statements, method, path)
+            REQUEST_SQL_SECONDS.observe(stats.sql_seconds, method, path)
@@ -1,12 +1,13 @@
+from sqlalchemy import DDL, JSON, Column, Index, event
 from sqlmodel import CheckConstraint, Field, Relationship, SQLModel, create_engine
 
 class DeviceBase(SQLModel):
-    name: str = Field()
+    name: str = Field(index=True)
     description: str = Field()
     serial_number: str = Field(unique=True, max_length=30, description="Serial number must be maximum 30 characters")
     unit_size: int = Field(gt=0, description="Value must be positive number")
-    power_consumption: int = Field(gt=0, description="Value must be positive number")
-    rack_id: int | None = Field(default=None, foreign_key="rack.id", ondelete="RESTRICT")
+    power_consumption: int = Field(gt=0, index=True, description="Value must be positive number")
+    rack_id: int | None = Field(default=None, foreign_key="rack.id", ondelete="RESTRICT", index=True)
 
 class Device(DeviceBase, table=True):
     __tablename__ = "device"
@@ -17,18 +18,19 @@ class Device(DeviceBase, table=True):
     )
 
     id: int | None = Field(default=None, primary_key=True) 
-    rack : "Rack" = Relationship(back_populates="devices")
+    #Relationships must be eager loaded explicitly, lazy loading is not possible with AsyncSession
+    rack : "Rack" = Relationship(back_populates="devices", sa_relationship_kwargs={"lazy": "raise_on_sql"})
 
 class DeviceForm(DeviceBase):
     id: int
     rack_name: str
 
 class RackBase(SQLModel):
-    name: str = Field()
+    name: str = Field(index=True)
     description: str = Field()
     serial_number: str = Field(unique=True, max_length=30, description="Serial number must be maximum 30 characters")
     unit_capacity: int = Field(gt=0, description="Value must be positive number")
-    max_power_consumption: int = Field(gt=0, description="Value must be positive number")
+    max_power_consumption: int = Field(gt=0, index=True, description="Value must be positive number")
 
 class Rack(RackBase, table=True):
     __tablename__ = "rack"
@@ -39,13 +41,103 @@ class Rack(RackBase, table=True):
     )
 
     id: int | None = Field(default=None, primary_key=True) 
-    devices: list["Device"] = Relationship(back_populates="rack")
+    used_units: int = Field(default=0, description="Sum of unit_size of devices in this rack")
+    used_power: int = Field(default=0, description="Sum of power_consumption of devices in this rack")
+    devices: list["Device"] = Relationship(back_populates="rack", sa_relationship_kwargs={"lazy": "raise_on_sql"})
+
+#Free capacity of rack, queries must use these exact expressions so SQLite can use the indexes
+RACK_FREE_UNITS = Rack.unit_capacity - Rack.used_units
+RACK_FREE_POWER = Rack.max_power_consumption - Rack.used_power
+Index("ix_rack_free_units", RACK_FREE_UNITS)
+Index("ix_rack_free_power", RACK_FREE_POWER)
 
 class RackForm(RackBase):
     id: int
     power_consumption: int
 
+class RackFitForm(RackForm):
+    free_units: int
+    free_power: int
+
 
 class AddDeviceForm(SQLModel):
     rack_id: int
-    device_id: int
\ No newline at end of file
+    device_id: int
+
+class BulkDeleteForm(SQLModel):
+    ids: list[int]
+
+class MessageForm(SQLModel):
+    message: str
+
+class InventoryVersion(SQLModel, table=True):
+    """Version per table, incremented in the same transaction as every write to that table."""
+    __tablename__ = "inventory_version"
+
+    table_name: str = Field(primary_key=True)
+    version: int = Field(default=0)
+
+class PlanningJob(SQLModel, table=True):
+    """
+    State of /suggestion/jobs shared by worker processes, job runs in the process that accepted it.
+    Written by that process whenever status changes, any process can read it or cancel the job.
+    """
+    __tablename__ = "planning_job"
+
+    id: str = Field(primary_key=True)
+    kind: str = Field()
+    status: str = Field()
+    etag: str | None = Field(default=None)
+    created_at: float = Field()
+    started_at: float | None = Field(default=None)
+    finished_at: float | None = Field(default=None, index=True)
+    result: list | dict | None = Field(default=None, sa_column=Column(JSON))
+    error: str | None = Field(default=None)
+
+class SerialNumber(SQLModel, table=True):
+    """
+    Serial numbers of all racks and devices, primary key keeps them unique across both tables.
+    Rows are written only by triggers below, so every write path including bulk statements keeps it in sync.
+    """
+    __tablename__ = "serial_number"
+
+    serial_number: str = Field(primary_key=True)
+    owner_table: str = Field()
+    owner_id: int = Field()
+
+def serial_number_triggers(table: str) -> list[str]:
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_serial_number_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO serial_number (serial_number, owner_table, owner_id) VALUES (NEW.serial_number, '{table}', NEW.id);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_serial_number_update AFTER UPDATE OF serial_number ON {table}
+        WHEN NEW.serial_number IS NOT OLD.serial_number
+        BEGIN
+            DELETE FROM serial_number WHERE serial_number = OLD.serial_number;
+            INSERT INTO serial_number (serial_number, owner_table, owner_id) VALUES (NEW.serial_number, '{table}', NEW.id);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_serial_number_delete AFTER DELETE ON {table}
+        BEGIN
+            DELETE FROM serial_number WHERE serial_number = OLD.serial_number;
+        END""",
+    ]
+
+SERIAL_NUMBER_TRIGGERS = serial_number_triggers("rack") + serial_number_triggers("device")
+
+def full_text_search_ddl(table: str) -> list[str]:
+    """FTS5 index over name and description, content is read from the table itself and kept in sync by triggers."""
+    insert = f"INSERT INTO {table}_fts (rowid, name, description) VALUES (NEW.id, NEW.name, NEW.description);"
+    delete = f"INSERT INTO {table}_fts ({table}_fts, rowid, name, description) VALUES ('delete', OLD.id, OLD.name, OLD.description);"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(name, description, content='{table}', content_rowid='id')",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF name, description ON {table} BEGIN {delete} {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN {delete} END",
+    ]
+
+FULL_TEXT_SEARCH_TABLES = ["rack", "device"]
+FULL_TEXT_SEARCH_DDL = full_text_search_ddl("rack") + full_text_search_ddl("device")
+
+for statement in SERIAL_NUMBER_TRIGGERS + FULL_TEXT_SEARCH_DDL:
+    event.listen(SQLModel.metadata, "after_create", DDL(statement))
@@ -0,0 +1,3 @@
+from .engine import DeviceSpec, PackingStrategy, Placement, PlacementError, RackSpec, pack, snapshot
+from .search import SearchResult, optimize
+from .rebalance import Move, RebalanceResult, rebalance
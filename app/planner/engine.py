@@ -0,0 +1,423 @@
+from enum import Enum
+from typing import Protocol, Sequence
+
+"""
+Placement of devices into racks.
+Engine works only with unit and power numbers so it does not depend on database models,
+racks and devices are referenced by their index in the input sequences.
+"""
+
+class PackingStrategy(str, Enum):
+    #Rack whose power percentage is lowest after adding device, original /suggestion behaviour
+    LEAST_POWER_PERCENTAGE = "least_power_percentage"
+    #Rack with least power left after adding device
+    BEST_FIT_DECREASING = "best_fit_decreasing"
+    #First rack in input order that can take device
+    FIRST_FIT_DECREASING = "first_fit_decreasing"
+    #Rack with lowest max(units %, power %) so both dimensions are balanced
+    BALANCED = "balanced"
+
+class RackLike(Protocol):
+    unit_capacity: int
+    max_power_consumption: int
+    #Read only when packing into occupied racks
+    used_units: int
+    used_power: int
+
+class DeviceLike(Protocol):
+    unit_size: int
+    power_consumption: int
+
+class PlacementError(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+class Placement:
+    """Devices placed into one rack, indexes point into racks and devices passed to pack."""
+    __slots__ = ("rack_index", "device_indexes")
+
+    def __init__(self, rack_index: int, device_indexes: list[int]):
+        self.rack_index = rack_index
+        self.device_indexes = device_indexes
+
+class RackSpec:
+    """Numbers of a rack without the model, cheap to pickle when planning runs in another process."""
+    __slots__ = ("unit_capacity", "max_power_consumption", "used_units", "used_power")
+
+    def __init__(self, rack: RackLike):
+        self.unit_capacity = rack.unit_capacity
+        self.max_power_consumption = rack.max_power_consumption
+        self.used_units = rack.used_units
+        self.used_power = rack.used_power
+
+class DeviceSpec:
+    __slots__ = ("unit_size", "power_consumption")
+
+    def __init__(self, device: DeviceLike):
+        self.unit_size = device.unit_size
+        self.power_consumption = device.power_consumption
+
+def snapshot(racks: Sequence[RackLike], devices: Sequence[DeviceLike]) -> tuple[list[RackSpec], list[DeviceSpec]]:
+    return [RackSpec(r) for r in racks], [DeviceSpec(d) for d in devices]
+
+class Inputs:
+    """Numbers read from racks and devices, base_units and base_power are usage racks start with."""
+    __slots__ = ("capacities", "max_powers", "sizes", "powers", "base_units", "base_power")
+
+    def __init__(self, racks: Sequence[RackLike], devices: Sequence[DeviceLike], occupied: bool):
+        self.capacities = [r.unit_capacity for r in racks]
+        self.max_powers = [r.max_power_consumption for r in racks]
+        self.sizes = [d.unit_size for d in devices]
+        self.powers = [d.power_consumption for d in devices]
+        self.base_units = [r.used_units for r in racks] if occupied else [0] * len(racks)
+        self.base_power = [r.used_power for r in racks] if occupied else [0] * len(racks)
+
+def pack(racks: Sequence[RackLike], devices: Sequence[DeviceLike], strategy: PackingStrategy, occupied: bool = False) -> list[Placement]:
+    """
+    Place every device into one of the racks.
+    With occupied racks start with their used_units and used_power, otherwise they are treated as empty.
+    Returns used racks in order in which they received their first device.
+    Raises PlacementError if devices cannot be stored.
+    """
+    inputs = Inputs(racks, devices, occupied)
+    check_totals(inputs)
+    order = placement_order(inputs.powers, strategy)
+    rack_of_device = STRATEGIES[strategy](inputs, order)
+    return group_placements(rack_of_device, order)
+
+def check_totals(inputs: Inputs):
+    #Test if total unit size or power consumption of devices is larger then the racks
+    if(sum(inputs.sizes) > sum(inputs.capacities) - sum(inputs.base_units)):
+        raise PlacementError("Not enough space to store all devices")
+    if(sum(inputs.powers) > sum(inputs.max_powers) - sum(inputs.base_power)):
+        raise PlacementError("Not enough power to store all devices")
+
+def placement_order(powers: list[int], strategy: PackingStrategy) -> Sequence[int]:
+    if strategy == PackingStrategy.LEAST_POWER_PERCENTAGE:
+        #Input order is kept, caller decides order in which devices are placed
+        return range(len(powers))
+    return sorted(range(len(powers)), key=lambda i: powers[i], reverse=True)
+
+def group_placements(rack_of_device: list[int], order: Sequence[int]) -> list[Placement]:
+    placements: dict[int, Placement] = {}
+    for device_index in order:
+        rack_index = rack_of_device[device_index]
+        placement = placements.get(rack_index)
+        if placement is None:
+            placements[rack_index] = Placement(rack_index, [device_index])
+        else:
+            placement.device_indexes.append(device_index)
+    return list(placements.values())
+
+def not_placed():
+    return PlacementError("Not enough space or power to store all devices")
+
+def least_power_percentage(inputs: Inputs, order) -> list[int]:
+    """
+    Percentage after placement is (used + p) / max. Racks sorted by max power are leaves of a segment tree,
+    node keeps lowest used / max, most free units and most free power of its racks. used / max + p / highest max
+    of node is then a lower bound of percentage of any rack under it, so search goes depth first into the child
+    with lower bound and skips nodes whose bound is above best rack found or that have no rack with enough room.
+    Racks of one node have similar max power, so bounds are tight and only a few paths are visited.
+    """
+    capacities, max_powers, sizes, powers = inputs.capacities, inputs.max_powers, inputs.sizes, inputs.powers
+    used_units = list(inputs.base_units)
+    used_power = list(inputs.base_power)
+    count = len(capacities)
+    leaves = 1
+    while leaves < max(count, 1):
+        leaves *= 2
+    rack_at = sorted(range(count), key=lambda idx: (max_powers[idx], idx))
+    leaf_of = [0] * count
+    inf = float("inf")
+    lowest_fraction = [inf] * (2 * leaves)
+    most_units = [-1] * (2 * leaves)
+    most_power = [-1] * (2 * leaves)
+    highest_max = [1] * (2 * leaves)
+    for position, idx in enumerate(rack_at):
+        node = leaves + position
+        leaf_of[idx] = node
+        highest_max[node] = max_powers[idx]
+        #Full racks stay out of the tree as before
+        if used_units[idx] < capacities[idx]:
+            lowest_fraction[node] = used_power[idx] / max_powers[idx]
+            most_units[node] = capacities[idx] - used_units[idx]
+            most_power[node] = max_powers[idx] - used_power[idx]
+    for node in range(leaves - 1, 0, -1):
+        left, right = 2 * node, 2 * node + 1
+        lowest_fraction[node] = min(lowest_fraction[left], lowest_fraction[right])
+        most_units[node] = max(most_units[left], most_units[right])
+        most_power[node] = max(most_power[left], most_power[right])
+        highest_max[node] = max(highest_max[left], highest_max[right])
+
+    rack_of_device = [-1] * len(sizes)
+    for device_index in order:
+        size = sizes[device_index]
+        power = powers[device_index]
+        best_pct = inf
+        best_idx = -1
+        stack = [(0.0, 1)]
+        while stack:
+            bound, node = stack.pop()
+            #Bound is compared with slack, exact percentages of racks decide ties by lowest rack index as before
+            if bound > best_pct * (1 + 1e-9):
+                continue
+            if node >= leaves:
+                idx = rack_at[node - leaves]
+                if used_units[idx] + size <= capacities[idx]:
+                    pct = (used_power[idx] + power) / max_powers[idx] * 100
+                    if pct < best_pct or (pct == best_pct and idx < best_idx):
+                        best_pct = pct
+                        best_idx = idx
+                continue
+            left, right = 2 * node, 2 * node + 1
+            left_bound = right_bound = inf
+            if most_power[left] >= power and most_units[left] >= size:
+                left_bound = (lowest_fraction[left] + power / highest_max[left]) * 100
+            if most_power[right] >= power and most_units[right] >= size:
+                right_bound = (lowest_fraction[right] + power / highest_max[right]) * 100
+            #Child with lower bound is popped first
+            if left_bound <= right_bound:
+                if right_bound != inf:
+                    stack.append((right_bound, right))
+                stack.append((left_bound, left))
+            elif right_bound != inf:
+                if left_bound != inf:
+                    stack.append((left_bound, left))
+                stack.append((right_bound, right))
+
+        if best_idx < 0:
+            raise not_placed()
+
+        used_units[best_idx] += size
+        used_power[best_idx] += power
+        rack_of_device[device_index] = best_idx
+        node = leaf_of[best_idx]
+        if used_units[best_idx] < capacities[best_idx]:
+            lowest_fraction[node] = used_power[best_idx] / max_powers[best_idx]
+            most_units[node] = capacities[best_idx] - used_units[best_idx]
+            most_power[node] = max_powers[best_idx] - used_power[best_idx]
+        else:
+            lowest_fraction[node], most_units[node], most_power[node] = inf, -1, -1
+        node //= 2
+        while node:
+            left, right = 2 * node, 2 * node + 1
+            fraction = lowest_fraction[left] if lowest_fraction[left] < lowest_fraction[right] else lowest_fraction[right]
+            units = most_units[left] if most_units[left] > most_units[right] else most_units[right]
+            free_power = most_power[left] if most_power[left] > most_power[right] else most_power[right]
+            #Values of a rack only go one way, ancestors above an unchanged node are unchanged too
+            if fraction == lowest_fraction[node] and units == most_units[node] and free_power == most_power[node]:
+                break
+            lowest_fraction[node], most_units[node], most_power[node] = fraction, units, free_power
+            node //= 2
+    return rack_of_device
+
+def first_fit_decreasing(inputs: Inputs, order) -> list[int]:
+    """
+    For every distinct device size a segment tree over racks keeps max free power of racks that still have
+    room for that size, leftmost rack that fits is then found with one descent from the root.
+    """
+    sizes, powers = inputs.sizes, inputs.powers
+    count = len(inputs.capacities)
+    leaves = 1
+    while leaves < max(count, 1):
+        leaves *= 2
+    free_units = [c - u for c, u in zip(inputs.capacities, inputs.base_units)]
+    free_power = [m - p for m, p in zip(inputs.max_powers, inputs.base_power)]
+
+    trees: dict[int, list[int]] = {}
+    for size in set(sizes):
+        tree = [-1] * (2 * leaves)
+        for idx in range(count):
+            if free_units[idx] >= size:
+                tree[leaves + idx] = free_power[idx]
+        for node in range(leaves - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+        trees[size] = tree
+
+    rack_of_device = [-1] * len(sizes)
+    for device_index in order:
+        size = sizes[device_index]
+        power = powers[device_index]
+        tree = trees[size]
+        if tree[1] < power:
+            raise not_placed()
+
+        node = 1
+        while node < leaves:
+            node = 2 * node if tree[2 * node] >= power else 2 * node + 1
+
+        idx = node - leaves
+        rack_of_device[device_index] = idx
+        free_units[idx] -= size
+        free_power[idx] -= power
+        for tree_size, tree in trees.items():
+            value = free_power[idx] if free_units[idx] >= tree_size else -1
+            node = leaves + idx
+            if tree[node] == value:
+                continue
+            tree[node] = value
+            node //= 2
+            #free power only decreases, stop once a range max is not affected
+            while node:
+                left = tree[2 * node]
+                right = tree[2 * node + 1]
+                highest = left if left > right else right
+                if tree[node] == highest:
+                    break
+                tree[node] = highest
+                node //= 2
+    return rack_of_device
+
+class RackTree:
+    """
+    Segment tree over racks sorted by (key, index) at start. Node keeps lowest (key, index), most free units
+    and most free power of its racks, racks without any free units or power are left out. Search goes depth first
+    into the child with lower key and skips nodes whose key is above best rack found or that have no rack with
+    enough room, so it usually follows a single path. Worst case it visits every rack, when the racks with room for
+    units and the racks with room for power are different ones spread over the tree.
+    """
+    __slots__ = ("leaves", "leaf_of", "rack_at", "lowest_key", "lowest_idx", "most_units", "most_power")
+
+    def __init__(self, keys: list[float], free_units: list[int], free_power: list[int]):
+        count = len(keys)
+        leaves = 1
+        while leaves < max(count, 1):
+            leaves *= 2
+        self.leaves = leaves
+        self.rack_at = sorted(range(count), key=lambda idx: (keys[idx], idx))
+        self.leaf_of = [0] * count
+        inf = float("inf")
+        self.lowest_key = [inf] * (2 * leaves)
+        self.lowest_idx = [count] * (2 * leaves)
+        self.most_units = [-1] * (2 * leaves)
+        self.most_power = [-1] * (2 * leaves)
+        for position, idx in enumerate(self.rack_at):
+            self.leaf_of[idx] = leaves + position
+            self.set_leaf(idx, keys[idx], free_units[idx], free_power[idx])
+        lowest_key, lowest_idx, most_units, most_power = self.lowest_key, self.lowest_idx, self.most_units, self.most_power
+        for node in range(leaves - 1, 0, -1):
+            left, right = 2 * node, 2 * node + 1
+            lower = left if (lowest_key[left], lowest_idx[left]) <= (lowest_key[right], lowest_idx[right]) else right
+            lowest_key[node], lowest_idx[node] = lowest_key[lower], lowest_idx[lower]
+            most_units[node] = max(most_units[left], most_units[right])
+            most_power[node] = max(most_power[left], most_power[right])
+
+    def set_leaf(self, idx: int, key: float, free_units: int, free_power: int):
+        node = self.leaf_of[idx]
+        if free_units > 0 and free_power > 0:
+            self.lowest_key[node], self.lowest_idx[node] = key, idx
+            self.most_units[node], self.most_power[node] = free_units, free_power
+        else:
+            self.lowest_key[node], self.lowest_idx[node] = float("inf"), len(self.leaf_of)
+            self.most_units[node], self.most_power[node] = -1, -1
+
+    def find(self, size: int, power: int, floor: float) -> int:
+        """Rack with lowest (key, index) that has room for the device, -1 if none has. floor is lowest key a rack with room can have."""
+        lowest_key, lowest_idx, most_units, most_power = self.lowest_key, self.lowest_idx, self.most_units, self.most_power
+        leaves = self.leaves
+        best_key = float("inf")
+        best_idx = -1
+        if most_units[1] < size or most_power[1] < power:
+            return best_idx
+        stack = [1]
+        while stack:
+            node = stack.pop()
+            key = lowest_key[node]
+            #Rack with lowest key of node may not fit, then only floor bounds keys of the others
+            if key < floor:
+                if floor > best_key:
+                    continue
+            elif key > best_key or (key == best_key and lowest_idx[node] > best_idx):
+                continue
+            if node >= leaves:
+                #Leaf is only pushed if rack fits
+                best_key, best_idx = key, lowest_idx[node]
+                continue
+            left, right = 2 * node, 2 * node + 1
+            left_fits = most_units[left] >= size and most_power[left] >= power
+            right_fits = most_units[right] >= size and most_power[right] >= power
+            #Child with lower key is popped first
+            if left_fits and right_fits:
+                if (lowest_key[left], lowest_idx[left]) <= (lowest_key[right], lowest_idx[right]):
+                    stack.append(right)
+                    stack.append(left)
+                else:
+                    stack.append(left)
+                    stack.append(right)
+            elif left_fits:
+                stack.append(left)
+            elif right_fits:
+                stack.append(right)
+        return best_idx
+
+    def update(self, idx: int, key: float, free_units: int, free_power: int):
+        self.set_leaf(idx, key, free_units, free_power)
+        lowest_key, lowest_idx, most_units, most_power = self.lowest_key, self.lowest_idx, self.most_units, self.most_power
+        node = self.leaf_of[idx] // 2
+        while node:
+            left, right = 2 * node, 2 * node + 1
+            if lowest_key[left] < lowest_key[right] or (lowest_key[left] == lowest_key[right] and lowest_idx[left] < lowest_idx[right]):
+                key, lowest = lowest_key[left], lowest_idx[left]
+            else:
+                key, lowest = lowest_key[right], lowest_idx[right]
+            units = most_units[left] if most_units[left] > most_units[right] else most_units[right]
+            power = most_power[left] if most_power[left] > most_power[right] else most_power[right]
+            #Ancestors above an unchanged node are unchanged too
+            if key == lowest_key[node] and lowest == lowest_idx[node] and units == most_units[node] and power == most_power[node]:
+                break
+            lowest_key[node], lowest_idx[node], most_units[node], most_power[node] = key, lowest, units, power
+            node //= 2
+
+def best_fit_decreasing(inputs: Inputs, order) -> list[int]:
+    """Rack with least free power that fits is found in a RackTree keyed by free power."""
+    sizes, powers = inputs.sizes, inputs.powers
+    free_units = [c - u for c, u in zip(inputs.capacities, inputs.base_units)]
+    free_power = [m - p for m, p in zip(inputs.max_powers, inputs.base_power)]
+    tree = RackTree(free_power, free_units, free_power)
+
+    rack_of_device = [-1] * len(sizes)
+    for device_index in order:
+        size = sizes[device_index]
+        power = powers[device_index]
+        #Rack that fits has at least power free, that is lowest key it can have
+        idx = tree.find(size, power, power)
+        if idx < 0:
+            raise not_placed()
+
+        rack_of_device[device_index] = idx
+        free_units[idx] -= size
+        free_power[idx] -= power
+        tree.update(idx, free_power[idx], free_units[idx], free_power[idx])
+    return rack_of_device
+
+def balanced(inputs: Inputs, order) -> list[int]:
+    """Rack with lowest max(units %, power %) that fits is found in a RackTree keyed by that load."""
+    capacities, max_powers, sizes, powers = inputs.capacities, inputs.max_powers, inputs.sizes, inputs.powers
+    used_units = list(inputs.base_units)
+    used_power = list(inputs.base_power)
+    loads = [max(used_units[idx] / capacities[idx], used_power[idx] / max_powers[idx]) for idx in range(len(capacities))]
+    tree = RackTree(loads, [c - u for c, u in zip(capacities, used_units)], [m - p for m, p in zip(max_powers, used_power)])
+
+    rack_of_device = [-1] * len(sizes)
+    for device_index in order:
+        size = sizes[device_index]
+        power = powers[device_index]
+        chosen = tree.find(size, power, 0)
+        if chosen < 0:
+            raise not_placed()
+
+        rack_of_device[device_index] = chosen
+        used_units[chosen] += size
+        used_power[chosen] += power
+        load = max(used_units[chosen] / capacities[chosen], used_power[chosen] / max_powers[chosen])
+        tree.update(chosen, load, capacities[chosen] - used_units[chosen], max_powers[chosen] - used_power[chosen])
+    return rack_of_device
+
+STRATEGIES = {
+    PackingStrategy.LEAST_POWER_PERCENTAGE: least_power_percentage,
+    PackingStrategy.BEST_FIT_DECREASING: best_fit_decreasing,
+    PackingStrategy.FIRST_FIT_DECREASING: first_fit_decreasing,
+    PackingStrategy.BALANCED: balanced,
+}
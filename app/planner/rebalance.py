@@ -0,0 +1,195 @@
+import time
+from bisect import insort
+from typing import Sequence
+from .engine import DeviceLike, RackLike
+
+"""
+Rebalancing racks by moving as few already placed devices as possible.
+Distance to target is power above max_power_percentage plus variance of power percentages above max_variance,
+it is zero once the target is met. Every step makes the single device move that lowers distance the most,
+devices are taken from the most loaded racks and tried in the least loaded rack they fit in.
+When target is met, moves that turned out not to be needed are moved back.
+"""
+
+#Most loaded racks that give devices in every step
+SOURCE_RACKS = 8
+
+class Move:
+    __slots__ = ("device_index", "from_rack_index", "to_rack_index")
+
+    def __init__(self, device_index: int, from_rack_index: int, to_rack_index: int):
+        self.device_index = device_index
+        self.from_rack_index = from_rack_index
+        self.to_rack_index = to_rack_index
+
+class RebalanceResult:
+    __slots__ = ("moves", "target_met", "max_percentage_before", "max_percentage_after", "variance_before", "variance_after")
+
+    def __init__(self, moves: list[Move], target_met: bool, max_percentages: tuple[float, float], variances: tuple[float, float]):
+        self.moves = moves
+        self.target_met = target_met
+        self.max_percentage_before, self.max_percentage_after = max_percentages
+        self.variance_before, self.variance_after = variances
+
+class Balance:
+    """
+    Current assignment with everything needed to evaluate a move in constant time:
+    sums of power percentages and their squares for variance, power above limit and racks sorted by percentage.
+    """
+    def __init__(self, racks: Sequence[RackLike], devices: Sequence[DeviceLike], rack_of_device: list[int], max_percentage: float | None):
+        self.capacities = [r.unit_capacity for r in racks]
+        self.max_powers = [r.max_power_consumption for r in racks]
+        self.total_max_power = sum(self.max_powers) or 1
+        self.sizes = [d.unit_size for d in devices]
+        self.powers = [d.power_consumption for d in devices]
+        self.assignment = list(rack_of_device)
+        self.devices_of_rack: list[set[int]] = [set() for _ in racks]
+        self.used_units = [0] * len(racks)
+        self.used_power = [0] * len(racks)
+        for device_index, rack_index in enumerate(rack_of_device):
+            self.devices_of_rack[rack_index].add(device_index)
+            self.used_units[rack_index] += self.sizes[device_index]
+            self.used_power[rack_index] += self.powers[device_index]
+
+        self.limits = [max_power * max_percentage / 100 for max_power in self.max_powers] if max_percentage is not None else None
+        self.percentages = [self.percentage(idx, self.used_power[idx]) for idx in range(len(racks))]
+        self.by_percentage = sorted((pct, idx) for idx, pct in enumerate(self.percentages))
+        self.total = sum(self.percentages)
+        self.total_squares = sum(pct * pct for pct in self.percentages)
+        self.total_excess = sum(self.excess(idx, used) for idx, used in enumerate(self.used_power))
+
+    def percentage(self, rack_index: int, used: int) -> float:
+        return used / self.max_powers[rack_index] * 100
+
+    def excess(self, rack_index: int, used: int) -> float:
+        #Power above limit in percent of total max power, so it is comparable with variance
+        if self.limits is None:
+            return 0.0
+        return max(used - self.limits[rack_index], 0.0) / self.total_max_power * 100
+
+    def variance(self, total: float | None = None, total_squares: float | None = None) -> float:
+        count = len(self.percentages)
+        if count == 0:
+            return 0.0
+        total = self.total if total is None else total
+        total_squares = self.total_squares if total_squares is None else total_squares
+        return max(total_squares / count - (total / count) ** 2, 0.0)
+
+    def max_percentage(self) -> float:
+        return self.by_percentage[-1][0] if self.by_percentage else 0.0
+
+    def fits(self, device_index: int, rack_index: int) -> bool:
+        return (self.used_units[rack_index] + self.sizes[device_index] <= self.capacities[rack_index]
+                and self.used_power[rack_index] + self.powers[device_index] <= self.max_powers[rack_index])
+
+    def move(self, device_index: int, target: int):
+        source = self.assignment[device_index]
+        power = self.powers[device_index]
+        self.assignment[device_index] = target
+        self.devices_of_rack[source].discard(device_index)
+        self.devices_of_rack[target].add(device_index)
+        self.used_units[source] -= self.sizes[device_index]
+        self.used_units[target] += self.sizes[device_index]
+        for rack_index, change in ((source, -power), (target, power)):
+            old_used = self.used_power[rack_index]
+            old_pct = self.percentages[rack_index]
+            self.used_power[rack_index] += change
+            new_pct = self.percentage(rack_index, self.used_power[rack_index])
+            self.percentages[rack_index] = new_pct
+            self.total += new_pct - old_pct
+            self.total_squares += new_pct * new_pct - old_pct * old_pct
+            self.total_excess += self.excess(rack_index, self.used_power[rack_index]) - self.excess(rack_index, old_used)
+            self.by_percentage.remove((old_pct, rack_index))
+            insort(self.by_percentage, (new_pct, rack_index))
+
+def rebalance(
+    racks: Sequence[RackLike],
+    devices: Sequence[DeviceLike],
+    rack_of_device: list[int],
+    max_percentage: float | None,
+    max_variance: float | None,
+    max_moves: int,
+    budget_ms: int,
+) -> RebalanceResult:
+    """
+    Find device moves after which no rack is above max_percentage of its power
+    and variance of power percentages is at most max_variance.
+    rack_of_device holds current rack index of every device, it is not changed.
+    If target cannot be met within max_moves or budget_ms, moves that get closest to it are returned.
+    """
+    deadline = time.perf_counter() + budget_ms / 1000
+    balance = Balance(racks, devices, rack_of_device, max_percentage)
+    max_percentage_before = balance.max_percentage()
+    variance_before = balance.variance()
+
+    def distance(total_excess: float, variance: float) -> float:
+        return total_excess + (max(variance - max_variance, 0.0) if max_variance is not None else 0.0)
+
+    moved_count = 0
+    while distance(balance.total_excess, balance.variance()) > 1e-9 and time.perf_counter() < deadline:
+        best = best_move(balance, max_percentage, max_variance, distance)
+        if best is None:
+            break
+        device_index, target = best
+        home = rack_of_device[device_index]
+        #Moving a device again or back home does not need another move from the budget
+        change = (target != home) - (balance.assignment[device_index] != home)
+        if moved_count + change > max_moves:
+            break
+        balance.move(device_index, target)
+        moved_count += change
+
+    target_met = distance(balance.total_excess, balance.variance()) <= 1e-9
+    if target_met:
+        #Greedy may move a device whose move is no longer needed once later moves were made
+        for device_index, home in enumerate(rack_of_device):
+            current = balance.assignment[device_index]
+            if current == home or not balance.fits(device_index, home):
+                continue
+            balance.move(device_index, home)
+            if distance(balance.total_excess, balance.variance()) > 1e-9:
+                balance.move(device_index, current)
+
+    moves = [Move(i, home, balance.assignment[i]) for i, home in enumerate(rack_of_device) if balance.assignment[i] != home]
+    return RebalanceResult(moves, target_met, (max_percentage_before, balance.max_percentage()), (variance_before, balance.variance()))
+
+def best_move(balance: Balance, max_percentage: float | None, max_variance: float | None, distance) -> tuple[int, int] | None:
+    """Single device move that lowers distance the most, None if no move lowers it."""
+    count = len(balance.by_percentage)
+    mean = balance.total / count if count else 0.0
+    #Only racks above the limit, or above mean percentage for variance, can give a device that lowers the distance
+    sources = []
+    for pct, idx in reversed(balance.by_percentage):
+        if len(sources) == SOURCE_RACKS:
+            break
+        above_limit = max_percentage is not None and pct > max_percentage
+        if not above_limit and (max_variance is None or pct <= mean):
+            break
+        sources.append(idx)
+
+    best = None
+    best_distance = distance(balance.total_excess, balance.variance()) - 1e-9
+    for source in sources:
+        source_used = balance.used_power[source]
+        source_pct = balance.percentages[source]
+        for device_index in balance.devices_of_rack[source]:
+            power = balance.powers[device_index]
+            #Least loaded rack the device fits in, for similar racks it lowers both excess and variance the most
+            target = next((idx for _, idx in balance.by_percentage if idx != source and balance.fits(device_index, idx)), None)
+            if target is None:
+                continue
+            used = balance.used_power[target]
+            new_source_pct = balance.percentage(source, source_used - power)
+            new_target_pct = balance.percentage(target, used + power)
+            old_target_pct = balance.percentages[target]
+            total_excess = (balance.total_excess
+                            + balance.excess(source, source_used - power) - balance.excess(source, source_used)
+                            + balance.excess(target, used + power) - balance.excess(target, used))
+            total = balance.total + new_source_pct - source_pct + new_target_pct - old_target_pct
+            total_squares = (balance.total_squares + new_source_pct ** 2 - source_pct ** 2
+                             + new_target_pct ** 2 - old_target_pct ** 2)
+            new_distance = distance(total_excess, balance.variance(total, total_squares))
+            if new_distance < best_distance:
+                best_distance = new_distance
+                best = (device_index, target)
+    return best
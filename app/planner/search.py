@@ -0,0 +1,204 @@
+import time
+from typing import Sequence
+from .engine import (
+    STRATEGIES, DeviceLike, Inputs, PackingStrategy, Placement, PlacementError, RackLike,
+    check_totals, group_placements, not_placed, placement_order,
+)
+
+"""
+Optimizing placement within a time budget.
+Objective is sum of used^2 / max power over racks divided by sum of max power, which is capacity weighted mean of
+squared power fractions. For a fixed total power it is lowest when every rack has the same power percentage.
+Search starts from a greedy plan, improves it with move/swap local search and for small inputs
+runs branch and bound which proves optimality if it finishes before the deadline.
+"""
+
+#Branch and bound is started only for this many devices or less, unless no greedy plan was found
+EXACT_SEARCH_DEVICE_LIMIT = 16
+
+class SearchResult:
+    __slots__ = ("placements", "objective", "optimal")
+
+    def __init__(self, placements: list[Placement], objective: float, optimal: bool):
+        self.placements = placements
+        self.objective = objective
+        self.optimal = optimal
+
+class SearchTimeout(Exception):
+    pass
+
+def optimize(racks: Sequence[RackLike], devices: Sequence[DeviceLike], strategy: PackingStrategy, budget_ms: int, occupied: bool = False) -> SearchResult:
+    deadline = time.perf_counter() + budget_ms / 1000
+    inputs = Inputs(racks, devices, occupied)
+    check_totals(inputs)
+
+    rack_of_device = initial_assignment(inputs, strategy)
+    if rack_of_device is not None:
+        local_search(rack_of_device, inputs, deadline)
+
+    optimal = False
+    if rack_of_device is None or len(devices) <= EXACT_SEARCH_DEVICE_LIMIT:
+        search = BranchAndBound(inputs, rack_of_device, deadline)
+        optimal = search.run()
+        rack_of_device = search.best
+
+    if rack_of_device is None:
+        raise not_placed()
+
+    objective = power_objective(rack_of_device, inputs)
+    return SearchResult(group_placements(rack_of_device, range(len(devices))), objective, optimal)
+
+def power_objective(rack_of_device: list[int], inputs: Inputs) -> float:
+    used_power = list(inputs.base_power)
+    for device_index, rack_index in enumerate(rack_of_device):
+        used_power[rack_index] += inputs.powers[device_index]
+    return sum(used * used / max_power for used, max_power in zip(used_power, inputs.max_powers)) / sum(inputs.max_powers)
+
+def initial_assignment(inputs: Inputs, strategy: PackingStrategy) -> list[int] | None:
+    #Requested strategy first, other strategies may still pack inputs on which it fails
+    for candidate in [strategy] + [s for s in PackingStrategy if s != strategy]:
+        try:
+            order = placement_order(inputs.powers, candidate)
+            return STRATEGIES[candidate](inputs, order)
+        except PlacementError:
+            continue
+    return None
+
+def local_search(rack_of_device: list[int], inputs: Inputs, deadline: float):
+    """Apply improving device moves and swaps between racks until none is left or deadline passes."""
+    capacities, max_powers, sizes, powers = inputs.capacities, inputs.max_powers, inputs.sizes, inputs.powers
+    used_units = list(inputs.base_units)
+    used_power = list(inputs.base_power)
+    for device_index, rack_index in enumerate(rack_of_device):
+        used_units[rack_index] += sizes[device_index]
+        used_power[rack_index] += powers[device_index]
+
+    def cost(rack_index: int, power: int) -> float:
+        return power * power / max_powers[rack_index]
+
+    improved = True
+    while improved:
+        improved = False
+        for device_index, source in enumerate(rack_of_device):
+            if time.perf_counter() > deadline:
+                return
+            size = sizes[device_index]
+            power = powers[device_index]
+            source_delta = cost(source, used_power[source] - power) - cost(source, used_power[source])
+            best_delta = -1e-9
+            best_target = -1
+            for target in range(len(capacities)):
+                if target == source:
+                    continue
+                if used_units[target] + size > capacities[target] or used_power[target] + power > max_powers[target]:
+                    continue
+                delta = source_delta + cost(target, used_power[target] + power) - cost(target, used_power[target])
+                if delta < best_delta:
+                    best_delta = delta
+                    best_target = target
+            if best_target >= 0:
+                rack_of_device[device_index] = best_target
+                used_units[source] -= size
+                used_power[source] -= power
+                used_units[best_target] += size
+                used_power[best_target] += power
+                improved = True
+
+        for first in range(len(rack_of_device)):
+            if time.perf_counter() > deadline:
+                return
+            for second in range(first + 1, len(rack_of_device)):
+                #Row of pairs is as long as device count, so clock is read within it too
+                if second % 256 == 0 and time.perf_counter() > deadline:
+                    return
+                a = rack_of_device[first]
+                b = rack_of_device[second]
+                if a == b:
+                    continue
+                units_change = sizes[second] - sizes[first]
+                power_change = powers[second] - powers[first]
+                if used_units[a] + units_change > capacities[a] or used_power[a] + power_change > max_powers[a]:
+                    continue
+                if used_units[b] - units_change > capacities[b] or used_power[b] - power_change > max_powers[b]:
+                    continue
+                delta = (cost(a, used_power[a] + power_change) - cost(a, used_power[a])
+                         + cost(b, used_power[b] - power_change) - cost(b, used_power[b]))
+                if delta < -1e-9:
+                    rack_of_device[first] = b
+                    rack_of_device[second] = a
+                    used_units[a] += units_change
+                    used_power[a] += power_change
+                    used_units[b] -= units_change
+                    used_power[b] -= power_change
+                    improved = True
+
+class BranchAndBound:
+    """
+    Depth first search over device to rack assignments, largest devices first.
+    Objective only grows while devices are added so partial objective is a lower bound,
+    racks in identical state are tried only once at each level.
+    """
+    def __init__(self, inputs: Inputs, incumbent: list[int] | None, deadline: float):
+        self.capacities = inputs.capacities
+        self.max_powers = inputs.max_powers
+        self.sizes = inputs.sizes
+        self.powers = inputs.powers
+        self.deadline = deadline
+        self.order = sorted(range(len(self.sizes)), key=lambda i: (self.powers[i], self.sizes[i]), reverse=True)
+        self.best = list(incumbent) if incumbent is not None else None
+        #Search works with objective not divided by total max power, it starts from usage racks already have
+        self.base_objective = sum(used * used / max_power for used, max_power in zip(inputs.base_power, self.max_powers))
+        self.best_objective = power_objective(incumbent, inputs) * sum(self.max_powers) if incumbent is not None else float("inf")
+        self.used_units = list(inputs.base_units)
+        self.used_power = list(inputs.base_power)
+        self.assignment = [-1] * len(self.sizes)
+        self.nodes = 0
+
+    def run(self) -> bool:
+        """Returns True if whole search space was explored, best plan is then optimal."""
+        try:
+            self.branch(0, self.base_objective)
+            return self.best is not None
+        except SearchTimeout:
+            return False
+
+    def branch(self, depth: int, objective: float):
+        self.nodes += 1
+        if self.nodes % 1024 == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+        if depth == len(self.order):
+            self.best = list(self.assignment)
+            self.best_objective = objective
+            return
+
+        device_index = self.order[depth]
+        size = self.sizes[device_index]
+        power = self.powers[device_index]
+        candidates = []
+        seen = set()
+        for rack_index in range(len(self.capacities)):
+            units = self.used_units[rack_index]
+            used = self.used_power[rack_index]
+            max_power = self.max_powers[rack_index]
+            if units + size > self.capacities[rack_index] or used + power > max_power:
+                continue
+            state = (self.capacities[rack_index], max_power, units, used)
+            if state in seen:
+                continue
+            seen.add(state)
+            delta = ((used + power) ** 2 - used * used) / max_power
+            candidates.append((delta, rack_index))
+        candidates.sort()
+
+        for delta, rack_index in candidates:
+            if objective + delta >= self.best_objective - 1e-9:
+                #candidates are sorted so remaining ones cannot be better
+                break
+            self.assignment[device_index] = rack_index
+            self.used_units[rack_index] += size
+            self.used_power[rack_index] += power
+            self.branch(depth + 1, objective + delta)
+            self.used_units[rack_index] -= size
+            self.used_power[rack_index] -= power
+        self.assignment[device_index] = -1
@@ -0,0 +1,172 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from sqlalchemy import event
+from app.settings import settings
+
+"""
+Opt-in diagnostics of slow requests.
+With PROFILING=true a request sent with header X-Profile: true runs under cProfile, report is kept for /debug/profiles.
+Statements slower than SLOW_QUERY_MS are logged with parameters and route.
+Same SELECT repeated N_PLUS_ONE_THRESHOLD times in one request is logged as a likely N+1 query.
+"""
+
+logger = logging.getLogger("app.profiling")
+
+PROFILE_HEADER = b"x-profile"
+#Longest parameters text kept for a slow query
+MAX_PARAMETERS_LENGTH = 500
+PROFILE_LINES = 60
+
+class RequestTrace:
+    __slots__ = ("scope", "selects")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        #Statement text to number of times it ran
+        self.selects: dict[str, int] = {}
+
+    def route(self) -> str:
+        #Template is known once request was routed, before that path is used
+        route = self.scope.get("route")
+        return f"{self.scope['method']} {getattr(route, 'path', self.scope['path'])}"
+
+current_trace: ContextVar[RequestTrace | None] = ContextVar("current_trace", default=None)
+
+class Profile:
+    __slots__ = ("id", "route", "duration_ms", "created_at", "report")
+
+    def __init__(self, id: str, route: str, duration_ms: float, report: str):
+        self.id = id
+        self.route = route
+        self.duration_ms = duration_ms
+        self.created_at = time.time()
+        self.report = report
+
+    def summary(self) -> dict:
+        return {"id": self.id, "route": self.route, "duration_ms": self.duration_ms, "created_at": self.created_at}
+
+#Newest entries are kept, oldest are dropped above PROFILING_KEEP
+profiles: OrderedDict[str, Profile] = OrderedDict()
+slow_queries: deque[dict] = deque(maxlen=settings.profiling_keep)
+repeated_queries: deque[dict] = deque(maxlen=settings.profiling_keep)
+
+def format_parameters(parameters, executemany: bool) -> str:
+    if executemany and parameters:
+        text = f"{len(parameters)} rows, first {parameters[0]!r}"
+    else:
+        text = repr(parameters)
+    return text if len(text) <= MAX_PARAMETERS_LENGTH else text[:MAX_PARAMETERS_LENGTH] + "..."
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("profiling_start", []).append(time.perf_counter())
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - connection.info["profiling_start"].pop()) * 1000
+    trace = current_trace.get()
+    if 0 < settings.slow_query_ms <= duration_ms:
+        entry = {
+            "statement": statement,
+            "parameters": format_parameters(parameters, executemany),
+            "duration_ms": duration_ms,
+            "route": trace.route() if trace is not None else None,
+            "created_at": time.time(),
+        }
+        slow_queries.append(entry)
+        logger.warning("Slow query %.1f ms in %s: %s %s", duration_ms, entry["route"], statement, entry["parameters"])
+    if trace is not None and statement.lstrip()[:6].upper() == "SELECT":
+        trace.selects[statement] = trace.selects.get(statement, 0) + 1
+
+def handle_error(context):
+    #Failed statement does not reach after_cursor_execute
+    start = context.connection.info.get("profiling_start") if context.connection is not None else None
+    if start:
+        start.pop()
+
+def diagnostics_enabled() -> bool:
+    return settings.profiling or settings.slow_query_ms > 0 or settings.n_plus_one_threshold > 0
+
+def install_engine_profiling(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(sync_engine, "handle_error", handle_error)
+
+def report_repeated_selects(trace: RequestTrace):
+    if settings.n_plus_one_threshold <= 0:
+        return
+    for statement, count in trace.selects.items():
+        if count >= settings.n_plus_one_threshold:
+            entry = {"route": trace.route(), "statement": statement, "count": count, "created_at": time.time()}
+            repeated_queries.append(entry)
+            logger.warning("Possible N+1 query in %s, same SELECT ran %d times: %s", entry["route"], count, statement)
+
+def save_profile(profile_id: str, profiler: cProfile.Profile, route: str, duration_ms: float) -> Profile:
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    profile = Profile(profile_id, route, duration_ms, text.getvalue())
+    profiles[profile.id] = profile
+    while len(profiles) > settings.profiling_keep:
+        profiles.popitem(last=False)
+    if settings.profile_dir:
+        os.makedirs(settings.profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(settings.profile_dir, f"{profile.id}.prof"))
+    return profile
+
+class ProfilingMiddleware:
+    """
+    Traces SQL of every request, profiles requests that ask for it.
+    cProfile sees the whole event loop thread, so requests served at the same time show up in the profile too.
+    Only one request is profiled at once, X-Profile is answered with busy while another profile runs.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.profiling = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(scope)
+        token = current_trace.set(trace)
+        profiler = None
+        if settings.profiling and dict(scope["headers"]).get(PROFILE_HEADER, b"").lower() in (b"1", b"true"):
+            #cProfile allows one active profiler per thread
+            if self.profiling:
+                send = self.add_header(send, b"busy")
+            else:
+                self.profiling = True
+                profiler = cProfile.Profile()
+                profile_id = uuid.uuid4().hex
+                send = self.add_header(send, profile_id.encode())
+
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                await self.app(scope, receive, send)
+            else:
+                profiler.enable()
+                try:
+                    await self.app(scope, receive, send)
+                finally:
+                    profiler.disable()
+                    self.profiling = False
+                    #Id is sent with response headers, before the profile is saved under it
+                    save_profile(profile_id, profiler, trace.route(), (time.perf_counter() - start) * 1000)
+        finally:
+            current_trace.reset(token)
+            report_repeated_selects(trace)
+
+    @staticmethod
+    def add_header(send, value: bytes):
+        async def send_with_header(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", value)]
+            await send(message)
+        return send_with_header
@@ -0,0 +1,25 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+from app import profiling
+
+router = APIRouter(prefix="/debug", tags=["debug"], include_in_schema=False)
+
+#async so lists are read on the event loop thread where they are written
+@router.get("/profiles", response_model=list[dict])
+async def get_profiles():
+    return [p.summary() for p in reversed(profiling.profiles.values())]
+
+@router.get("/profiles/{id}", response_class=PlainTextResponse)
+async def get_profile(id: str):
+    profile = profiling.profiles.get(id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile with id '{id}' does not exist.")
+    return PlainTextResponse(f"{profile.route} {profile.duration_ms:.1f} ms\n\n{profile.report}")
+
+@router.get("/slow_queries", response_model=list[dict])
+async def get_slow_queries():
+    return list(reversed(profiling.slow_queries))
+
+@router.get("/n_plus_one", response_model=list[dict])
+async def get_n_plus_one():
+    return list(reversed(profiling.repeated_queries))
@@ -1,24 +1,73 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from pydantic import ValidationError
-from sqlmodel import Session, select
-from app.database import get_session
-from app.models import DeviceForm, Device, Rack, AddDeviceForm
-from app.routers.validation_helper import device_exist_validation, rack_exist_validation
+from sqlmodel import delete, insert, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.database import get_session, get_write_session
+from app.models import DeviceForm, Device, Rack, AddDeviceForm, BulkDeleteForm, MessageForm
+from app.routers.usage_helper import (
+    add_rack_usage, apply_rack_usage, bulk_rack_capacity_validation, rack_power_validation, rack_units_validation,
+    remove_rack_usage,
+)
+from app.routers.filter_helper import DeviceFilters, filter_device_records, filter_devices
+from app.routers.pagination_helper import PageParams, page_records, page_response, paginate
+from app.routers.read_model_helper import DeviceRecord, read_model
+from app.routers.validation_helper import (
+    add_error, bulk_errors_validation, bulk_model_validation, bulk_serial_number_validation, bulk_size_validation,
+    device_exist_validation, rack_exist_validation, serial_number_validation,
+)
+from app.routers.version_helper import DEVICE_TABLE, RACK_TABLE, bump_inventory_version, get_inventory_version, inventory_etag, not_modified
 
 router = APIRouter(prefix="/devices", tags=["devices"])
 
-@router.get("/")
-async def get_all(session: Session = Depends(get_session)):
-    racks = [map_device_form(d) for d in session.exec(select(Device)).all()]
-    return racks
+@router.get("/", response_model=list[DeviceForm])
+async def get_all(
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
+    filters: DeviceFilters = Depends(),
+    session: AsyncSession = Depends(get_session)
+    ):
+    #Full text search needs the FTS index, it is always answered by database
+    model = await read_model.current(session) if read_model.enabled and filters.q is None else None
+    #Device rows include rack name, so ETag covers both tables
+    version = model.version if model is not None else await get_inventory_version(session)
+    if (cached := not_modified(request, response, inventory_etag(version))) is not None:
+        return cached
 
-@router.get("/{device_id}")
-async def get_single(device_id: int, session: Session = Depends(get_session)):
-    device: Device = session.get(Device, device_id)
-    device_exist_validation(device_id, device)
-    return map_device_form(device)
+    if model is not None:
+        ids, keep = filter_device_records(model, filters)
+        map_record = lambda device: map_device_form(device, model.rack_name(device.rack_id))
+        return page_records(ids, model.devices, keep, page, map_record, request, response)
 
-def map_device_form(device: Device):
+    statement = paginate(filter_devices(select_device_forms(), filters), Device.id, page)
+    return await page_response(statement, page, lambda row: map_device_form(*row), request, response, session)
+
+@router.get("/{device_id}", response_model=DeviceForm)
+async def get_single(device_id: int, request: Request, response: Response, session: AsyncSession = Depends(get_session)):
+    model = await read_model.current(session) if read_model.enabled else None
+    version = model.version if model is not None else await get_inventory_version(session)
+    if model is not None:
+        device = model.devices.get(device_id)
+        device_exist_validation(device_id, device)
+        rack_name = model.rack_name(device.rack_id)
+    else:
+        row = (await session.exec(select_device_forms().where(Device.id == device_id))).first()
+        device_exist_validation(device_id, row)
+        device, rack_name = row
+    #Checked before If-None-Match, * must not turn 404 into 304
+    if (cached := not_modified(request, response, inventory_etag(version))) is not None:
+        return cached
+    return map_device_form(device, rack_name)
+
+def device_write_tables(device: Device) -> list[str]:
+    #Usage counters of rack change only if device is placed in a rack
+    return [DEVICE_TABLE] if device.rack_id is None else [DEVICE_TABLE, RACK_TABLE]
+
+def select_device_forms():
+    #Join rack name in the same query instead of lazy loading device.rack for every device
+    return select(Device, Rack.name).join(Rack, Device.rack_id == Rack.id, isouter=True)
+
+def map_device_form(device: Device | DeviceRecord, rack_name: str | None):
     return DeviceForm(
         id = device.id,
         name = device.name,
@@ -27,22 +76,26 @@ def map_device_form(device: Device):
         unit_size = device.unit_size,
         power_consumption = device.power_consumption,
         rack_id = device.rack_id,
-        rack_name = device.rack.name if device.rack is not None else "None" 
+        rack_name = rack_name if rack_name is not None else "None"
     )
 
-@router.post("/")
-async def create_device(device: Device, session: Session = Depends(get_session)):
+@router.post("/", response_model=Device)
+async def create_device(device: Device, session: AsyncSession = Depends(get_write_session)):
     try: 
         device.name = device.name.strip()
         device.description = device.description.strip()
         device.serial_number = device.serial_number.strip()
 
-        device_validation(device, session, True)
+        await device_validation(device, session, True)
         Device.model_validate(device)
 
+        await add_rack_usage(device, session)
         session.add(device)
-        session.commit()
-        session.refresh(device)
+        tables = device_write_tables(device)
+        await bump_inventory_version(session, *tables)
+        changed = await read_model.changed_rows(session, tables, rack_ids=[device.rack_id], device_ids=[device.id])
+        await session.commit()
+        read_model.apply(changed)
         return device
     except ValidationError as e:
         msg: list[str] = [err["msg"] for err in  e.errors()]
@@ -51,7 +104,7 @@ async def create_device(device: Device, session: Session = Depends(get_session))
                 detail={'messages': msg}
             )
 
-def device_validation(device: Device, session: Session, create_mod: bool):
+async def device_validation(device: Device, session: AsyncSession, create_mod: bool):
     #Check if Device with this id already exist, only check if it is creation, not update of device
     if device.id is not None:
         if device.id < 1:
@@ -61,7 +114,7 @@ def device_validation(device: Device, session: Session, create_mod: bool):
                 )
         
         if create_mod:
-            if(session.get(Device, device.id) is not None):
+            if(await session.get(Device, device.id) is not None):
                 raise HTTPException(
                     status_code=400,
                     detail=f"Device with id '{device.id}' already exists."
@@ -79,73 +132,157 @@ def device_validation(device: Device, session: Session, create_mod: bool):
         )
     
     if(device.rack_id is not None):
-        rack: Rack = session.get(Rack, device.rack_id)
+        rack: Rack = await session.get(Rack, device.rack_id)
         rack_exist_validation(device.rack_id, rack)
-        power_consumption_validation(create_mod, rack, device)
-        unit_size_validation(create_mod, rack, device)
+        #In update mod device is already in identity map so no extra query is made
+        current: Device | None = None if create_mod else await session.get(Device, device.id)
+        power_consumption_validation(rack, device, current)
+        unit_size_validation(rack, device, current)
 
-    id_to_check = device.id if not create_mod else -1
-    unique_serial_number_validation(id_to_check, device.serial_number, session)
+    await serial_number_validation(device, session)
 
-def power_consumption_validation(create_mod: bool, rack: Rack, device: Device):
-    #if it is update mod then we dont want to take into considaration current device
-    total_consumption: int
-    if(create_mod):
-        total_consumption = sum([d.power_consumption for d in rack.devices])
-    else:
-        total_consumption = sum([d.power_consumption for d in rack.devices if d.id != device.id])
-
-    if(total_consumption + device.power_consumption > rack.max_power_consumption):
-        raise HTTPException(
-            status_code=400,
-            detail=f"Power consumption exceeds maximum allowed value in the current rack."
-        )
+def power_consumption_validation(rack: Rack, device: Device, current: Device | None = None):
+    #if device is already in this rack then we dont want to take into considaration its current consumption
+    total_consumption: int = rack.used_power
+    if(current is not None and current.rack_id == rack.id):
+        total_consumption -= current.power_consumption
+    rack_power_validation(rack, total_consumption, device.power_consumption)
 
-def unit_size_validation(create_mod: bool, rack: Rack, device: Device):
-    total_unit_size: int
-    if(create_mod):
-        total_unit_size: int = sum([d.unit_size for d in rack.devices])
-    else:
-        total_unit_size: int = sum([d.unit_size for d in rack.devices if d.id != device.id])
+def unit_size_validation(rack: Rack, device: Device, current: Device | None = None):
+    total_unit_size: int = rack.used_units
+    if(current is not None and current.rack_id == rack.id):
+        total_unit_size -= current.unit_size
+    rack_units_validation(rack, total_unit_size, device.unit_size)
     
-    if(total_unit_size + device.unit_size > rack.unit_capacity):
-        raise HTTPException(
-            status_code=400,
-            detail=f"There is not enough space in rack to store this device."
-        )
-    
-def unique_serial_number_validation(current_id: int, value: str, session: Session): 
-    select_rack = select(Rack.id).where(Rack.serial_number == value)
-    rack = session.exec(select_rack).first()
-    select_device = select(Device.id).where(Device.serial_number == value).where(Device.id != current_id)
-    device = session.exec(select_device).first()
-    if device is not None or rack is not None:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Serial number '{value}' already exists."
-        )
-    return
+@router.post("/bulk", response_model=list[Device])
+async def create_devices(devices: list[Device], session: AsyncSession = Depends(get_write_session)):
+    """Create all devices in one transaction, nothing is created if any device is invalid."""
+    bulk_size_validation(devices)
+    errors: dict[int, list[str]] = {}
+    for device in devices:
+        device.name = device.name.strip()
+        device.description = device.description.strip()
+        device.serial_number = device.serial_number.strip()
+    bulk_model_validation(Device, devices, errors)
+
+    given_ids = [d.id for d in devices if d.id is not None]
+    existing_ids = set((await session.exec(select(Device.id).where(Device.id.in_(given_ids)))).all())
+    seen_ids: set[int] = set()
+    for index, device in enumerate(devices):
+        if device.id is None:
+            continue
+        if device.id < 1:
+            add_error(errors, index, "Device id must be positive number.")
+        elif device.id in existing_ids or device.id in seen_ids:
+            add_error(errors, index, f"Device with id '{device.id}' already exists.")
+        seen_ids.add(device.id)
+
+    await bulk_serial_number_validation(devices, session, errors)
+    changes = await bulk_rack_capacity_validation(devices, {}, session, errors)
+    bulk_errors_validation(errors)
+
+    await apply_rack_usage(changes, session)
+    rows = [d.model_dump(include=DEVICE_COLUMNS) for d in devices]
+    #Core insert on the table so rows with and without rack_id go into a single executemany
+    await session.exec(insert(Device.__table__), params=rows)
+    await bump_inventory_version(session, DEVICE_TABLE, RACK_TABLE)
+    #ids generated by database are read back through unique serial numbers before commit
+    serials = [d.serial_number for d in devices]
+    created = {d.serial_number: d for d in (await session.exec(select(Device).where(Device.serial_number.in_(serials)))).all()}
+    changed = await read_model.changed_rows(session, [DEVICE_TABLE, RACK_TABLE], rack_ids=[d.rack_id for d in devices], device_ids=[d.id for d in created.values()])
+    await session.commit()
+    read_model.apply(changed)
+    return [created[serial] for serial in serials]
+
+@router.put("/bulk", response_model=list[Device])
+async def update_devices(devices: list[Device], session: AsyncSession = Depends(get_write_session)):
+    """Update all devices in one transaction, nothing is updated if any device is invalid."""
+    bulk_size_validation(devices)
+    errors: dict[int, list[str]] = {}
+    for device in devices:
+        device.name = device.name.strip()
+        device.description = device.description.strip()
+        device.serial_number = device.serial_number.strip()
+    bulk_model_validation(Device, devices, errors)
+
+    ids = [d.id for d in devices if d.id is not None]
+    current = {d.id: d for d in (await session.exec(select(Device).where(Device.id.in_(ids)))).all()}
+    seen_ids: set[int] = set()
+    for index, device in enumerate(devices):
+        if device.id is None:
+            add_error(errors, index, "Device id is required.")
+        elif device.id not in current:
+            add_error(errors, index, f"Device with id {device.id} does not exist")
+        elif device.id in seen_ids:
+            add_error(errors, index, f"Device with id '{device.id}' is updated more than once.")
+        seen_ids.add(device.id)
+
+    await bulk_serial_number_validation(devices, session, errors)
+    changes = await bulk_rack_capacity_validation(devices, current, session, errors)
+    bulk_errors_validation(errors)
+
+    await apply_rack_usage(changes, session)
+    rows = [d.model_dump(include=DEVICE_COLUMNS) for d in devices]
+    rack_ids = [d.rack_id for d in devices] + [d.rack_id for d in current.values()]
+    await session.exec(update(Device), params=rows)
+    await bump_inventory_version(session, DEVICE_TABLE, RACK_TABLE)
+    changed = await read_model.changed_rows(session, [DEVICE_TABLE, RACK_TABLE], rack_ids=rack_ids, device_ids=ids)
+    await session.commit()
+    read_model.apply(changed)
+    return devices
+
+@router.post("/bulk_delete", response_model=MessageForm)
+async def delete_devices(form: BulkDeleteForm, session: AsyncSession = Depends(get_write_session)):
+    bulk_size_validation(form.ids)
+    errors: dict[int, list[str]] = {}
+    current = {d.id: d for d in (await session.exec(select(Device).where(Device.id.in_(form.ids)))).all()}
+    for index, device_id in enumerate(form.ids):
+        if device_id not in current:
+            add_error(errors, index, f"Device with id {device_id} does not exist")
+    bulk_errors_validation(errors)
+
+    changes: dict[int, list[int]] = {}
+    for device in current.values():
+        if device.rack_id is not None:
+            rack_change = changes.setdefault(device.rack_id, [0, 0])
+            rack_change[0] -= device.unit_size
+            rack_change[1] -= device.power_consumption
+
+    await apply_rack_usage(changes, session)
+    await session.exec(delete(Device).where(Device.id.in_(form.ids)))
+    await bump_inventory_version(session, DEVICE_TABLE, RACK_TABLE)
+    changed = await read_model.changed_rows(session, [DEVICE_TABLE, RACK_TABLE], rack_ids=changes.keys(), device_ids=current.keys())
+    await session.commit()
+    read_model.apply(changed)
+    return {"message": f"{len(current)} devices deleted successfully"}
+
+DEVICE_COLUMNS = {"id", "name", "description", "serial_number", "unit_size", "power_consumption", "rack_id"}
 
-@router.put("/{device_id}")
-async def update_device(device_id: int, device: Device, session: Session = Depends(get_session)):
+@router.put("/{device_id}", response_model=Device)
+async def update_device(device_id: int, device: Device, session: AsyncSession = Depends(get_write_session)):
     try: 
         device.id = device_id
-        device_to_update: Device = session.get(Device, device_id)
+        device_to_update: Device = await session.get(Device, device_id)
         device_exist_validation(device_id, device_to_update)
         
-        device_validation(device, session, False)
+        await device_validation(device, session, False)
         Device.model_validate(device)
 
+        old_rack_id = device_to_update.rack_id
+        await remove_rack_usage(device_to_update, session)
         device_to_update.name = device.name.strip()
         device_to_update.description = device.description.strip()
         device_to_update.serial_number = device.serial_number.strip()
         device_to_update.unit_size = device.unit_size
         device_to_update.power_consumption = device.power_consumption
         device_to_update.rack_id = device.rack_id
+        await add_rack_usage(device_to_update, session)
 
         session.add(device_to_update)
-        session.commit()
-        session.refresh(device_to_update)
+        await bump_inventory_version(session, DEVICE_TABLE, RACK_TABLE)
+        changed = await read_model.changed_rows(session, [DEVICE_TABLE, RACK_TABLE], rack_ids=[old_rack_id, device.rack_id], device_ids=[device_id])
+        await session.commit()
+        read_model.apply(changed)
         return device_to_update
     except ValidationError as e:
         msg: list[str] = [err["msg"] for err in  e.errors()]
@@ -154,45 +291,59 @@ async def update_device(device_id: int, device: Device, session: Session = Depen
                 detail={'messages': msg}
             )
     
-@router.delete("/{device_id}")
-async def delete_device(device_id: int, session: Session = Depends(get_session)):
-    device_to_delete: Device = session.get(Device, device_id)
+@router.delete("/{device_id}", response_model=MessageForm)
+async def delete_device(device_id: int, session: AsyncSession = Depends(get_write_session)):
+    device_to_delete: Device = await session.get(Device, device_id)
     device_exist_validation(device_id, device_to_delete)
-    session.delete(device_to_delete)
-    session.commit()
+    await remove_rack_usage(device_to_delete, session)
+    await session.delete(device_to_delete)
+    tables = device_write_tables(device_to_delete)
+    await bump_inventory_version(session, *tables)
+    changed = await read_model.changed_rows(session, tables, rack_ids=[device_to_delete.rack_id], device_ids=[device_id])
+    await session.commit()
+    read_model.apply(changed)
     return {"message": f"Device '{device_to_delete.name}' deleted successfully"}
 
-@router.post("/add_to_rack")
-async def add_device_to_rack(form: AddDeviceForm, session: Session = Depends(get_session)):
-    rack = session.get(Rack, form.rack_id)
+@router.post("/add_to_rack", response_model=MessageForm)
+async def add_device_to_rack(form: AddDeviceForm, session: AsyncSession = Depends(get_write_session)):
+    rack = await session.get(Rack, form.rack_id)
     rack_exist_validation(form.rack_id, rack)
-    device = session.get(Device, form.device_id)
+    device = await session.get(Device, form.device_id)
     device_exist_validation(form.device_id, device)
     
     if device.rack_id == rack.id:
         return {"message": "Device is already added to this rack"}
     
-    power_consumption_validation(True, rack, device)
-    unit_size_validation(True, rack, device)
+    power_consumption_validation(rack, device)
+    unit_size_validation(rack, device)
 
+    #Device can be moved from another rack
+    old_rack_id = device.rack_id
+    await remove_rack_usage(device, session)
     device.rack_id = rack.id
+    await add_rack_usage(device, session)
     session.add(device)
-    session.commit()
-    session.refresh(device)
+    await bump_inventory_version(session, DEVICE_TABLE, RACK_TABLE)
+    changed = await read_model.changed_rows(session, [DEVICE_TABLE, RACK_TABLE], rack_ids=[old_rack_id, rack.id], device_ids=[device.id])
+    await session.commit()
+    read_model.apply(changed)
     return {"message": f"Device '{device.name}' is added to rack '{rack.name}'"}
 
-@router.post("/remove_from_rack")
-async def remove_device_from_rack(form: AddDeviceForm, session: Session = Depends(get_session)):
-    rack = session.get(Rack, form.rack_id)
+@router.post("/remove_from_rack", response_model=MessageForm)
+async def remove_device_from_rack(form: AddDeviceForm, session: AsyncSession = Depends(get_write_session)):
+    rack = await session.get(Rack, form.rack_id)
     rack_exist_validation(form.rack_id, rack)
-    device = session.get(Device, form.device_id)
+    device = await session.get(Device, form.device_id)
     device_exist_validation(form.device_id, device)
     
     if device.rack_id != rack.id:
         return {"message": "Device is already removed from this rack"}
 
+    await remove_rack_usage(device, session)
     device.rack_id = None
     session.add(device)
-    session.commit()
-    session.refresh(device)
+    await bump_inventory_version(session, DEVICE_TABLE, RACK_TABLE)
+    changed = await read_model.changed_rows(session, [DEVICE_TABLE, RACK_TABLE], rack_ids=[rack.id], device_ids=[device.id])
+    await session.commit()
+    read_model.apply(changed)
     return {"message": f"Device '{device.name}' is removed to rack '{rack.name}'"}
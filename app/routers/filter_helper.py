@@ -0,0 +1,117 @@
+import sys
+from typing import Callable
+from fastapi import Query
+from sqlmodel import column, text
+from app.models import RACK_FREE_POWER, RACK_FREE_UNITS, Device, Rack
+from app.routers.read_model_helper import DeviceRecord, RackRecord, ReadModel
+from app.routers.version_helper import DEVICE_TABLE, RACK_TABLE
+
+
+"""
+Filters of list endpoints, every filter is a WHERE condition backed by an index.
+Prefix filters are case sensitive ranges on the column so they can use its b-tree index, LIKE could not.
+"""
+
+class DeviceFilters:
+    def __init__(
+        self,
+        rack_id: int | None = Query(default=None),
+        unassigned: bool = Query(default=False, description="Only devices that are not in any rack"),
+        name_prefix: str | None = Query(default=None, min_length=1),
+        serial_prefix: str | None = Query(default=None, min_length=1),
+        q: str | None = Query(default=None, min_length=1, description="Full text search in name and description"),
+    ):
+        self.rack_id = rack_id
+        self.unassigned = unassigned
+        self.name_prefix = name_prefix
+        self.serial_prefix = serial_prefix
+        self.q = q
+
+class RackFilters:
+    def __init__(
+        self,
+        min_free_units: int | None = Query(default=None, ge=0),
+        min_free_power: int | None = Query(default=None, ge=0),
+        name_prefix: str | None = Query(default=None, min_length=1),
+        serial_prefix: str | None = Query(default=None, min_length=1),
+        q: str | None = Query(default=None, min_length=1, description="Full text search in name and description"),
+    ):
+        self.min_free_units = min_free_units
+        self.min_free_power = min_free_power
+        self.name_prefix = name_prefix
+        self.serial_prefix = serial_prefix
+        self.q = q
+
+def filter_devices(statement, filters: DeviceFilters):
+    if filters.rack_id is not None:
+        statement = statement.where(Device.rack_id == filters.rack_id)
+    if filters.unassigned:
+        statement = statement.where(Device.rack_id.is_(None))
+    statement = filter_common(statement, Device, filters)
+    return statement
+
+def filter_racks(statement, filters: RackFilters):
+    if filters.min_free_units is not None:
+        statement = statement.where(RACK_FREE_UNITS >= filters.min_free_units)
+    if filters.min_free_power is not None:
+        statement = statement.where(RACK_FREE_POWER >= filters.min_free_power)
+    statement = filter_common(statement, Rack, filters)
+    return statement
+
+def filter_common(statement, model: type[Device] | type[Rack], filters: DeviceFilters | RackFilters):
+    if filters.name_prefix is not None:
+        statement = statement.where(*prefix_conditions(model.name, filters.name_prefix))
+    if filters.serial_prefix is not None:
+        statement = statement.where(*prefix_conditions(model.serial_number, filters.serial_prefix))
+    if filters.q is not None and filters.q.split():
+        table = model.__tablename__
+        match = text(f"SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH :query").bindparams(query=fts_query(filters.q))
+        statement = statement.where(model.id.in_(match.columns(column("rowid"))))
+    return statement
+
+def filter_device_records(model: ReadModel, filters: DeviceFilters) -> tuple[list[int], Callable[[DeviceRecord], bool]]:
+    """Same filters answered from read model, returns sorted candidate ids and test for each record. q is not supported."""
+    if filters.rack_id is not None:
+        ids = sorted(model.devices_of_rack.get(filters.rack_id, ()))
+    elif filters.serial_prefix is not None:
+        ids = model.serial_number_ids(DEVICE_TABLE, filters.serial_prefix)
+    else:
+        ids = model.device_ids()
+
+    def keep(device: DeviceRecord) -> bool:
+        return ((not filters.unassigned or device.rack_id is None)
+                and (filters.name_prefix is None or device.name.startswith(filters.name_prefix))
+                and (filters.serial_prefix is None or device.serial_number.startswith(filters.serial_prefix)))
+    return ids, keep
+
+def filter_rack_records(model: ReadModel, filters: RackFilters) -> tuple[list[int], Callable[[RackRecord], bool]]:
+    if filters.serial_prefix is not None:
+        ids = model.serial_number_ids(RACK_TABLE, filters.serial_prefix)
+    else:
+        ids = model.rack_ids()
+
+    def keep(rack: RackRecord) -> bool:
+        return ((filters.min_free_units is None or rack.unit_capacity - rack.used_units >= filters.min_free_units)
+                and (filters.min_free_power is None or rack.max_power_consumption - rack.used_power >= filters.min_free_power)
+                and (filters.name_prefix is None or rack.name.startswith(filters.name_prefix)))
+    return ids, keep
+
+def prefix_conditions(column, prefix: str):
+    #Every string starting with prefix is >= prefix and < prefix with last character incremented
+    upper = prefix_upper_bound(prefix)
+    return (column >= prefix,) if upper is None else (column >= prefix, column < upper)
+
+def prefix_upper_bound(prefix: str) -> str | None:
+    #Last code point U+10FFFF has no next one, it is dropped and character before it is incremented instead
+    stripped = prefix.rstrip(chr(sys.maxunicode))
+    if not stripped:
+        return None
+    next_code = ord(stripped[-1]) + 1
+    #Surrogates cannot be encoded to UTF-8, first code point after them is next in UTF-8 order too
+    if 0xD800 <= next_code <= 0xDFFF:
+        next_code = 0xE000
+    return stripped[:-1] + chr(next_code)
+
+def fts_query(q: str) -> str:
+    #Every word is quoted so user input is never parsed as FTS5 syntax, trailing * makes it a prefix search
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in q.split())
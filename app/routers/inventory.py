@@ -0,0 +1,210 @@
+import json
+import tempfile
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.database import get_session, get_write_session
+from app.models import Device, Rack
+from app.routers.devices import DEVICE_COLUMNS
+from app.routers.racks import RACK_COLUMNS
+from app.routers.read_model_helper import read_model
+from app.routers.transfer_helper import (
+    DEVICE, FIELDS, MEDIA_TYPES, RACK, TransferFormat, csv_header, format_of_media_type, format_rows, read_records,
+)
+from app.routers.usage_helper import apply_rack_usage, bulk_rack_capacity_validation
+from app.routers.validation_helper import add_error, bulk_serial_number_validation
+from app.routers.version_helper import DEVICE_TABLE, RACK_TABLE, bump_inventory_version, get_inventory_version, inventory_etag
+from app.settings import settings
+
+router = APIRouter(tags=["inventory"])
+
+MODELS = {RACK: Rack, DEVICE: Device}
+
+@router.get("/export", response_class=StreamingResponse)
+async def export_inventory(format: TransferFormat = Query(default=TransferFormat.NDJSON), session: AsyncSession = Depends(get_session)):
+    """
+    All racks, then all devices, read from database cursor while they are sent.
+    Everything is read in one transaction, so export is a consistent snapshot of the version in ETag.
+    """
+    version = await get_inventory_version(session)
+    headers = {
+        "ETag": inventory_etag(version),
+        "Content-Disposition": f'attachment; filename="inventory.{format.value}"',
+    }
+    return StreamingResponse(export_rows(format, session), media_type=MEDIA_TYPES[format], headers=headers)
+
+async def export_rows(transfer_format: TransferFormat, session: AsyncSession):
+    if transfer_format == TransferFormat.CSV:
+        yield csv_header()
+    for kind in (RACK, DEVICE):
+        model = MODELS[kind]
+        columns = [getattr(model, field) for field in FIELDS[kind]]
+        result = await session.stream(select(*columns).order_by(model.id))
+        async for rows in result.partitions(settings.stream_batch_size):
+            yield format_rows(kind, rows, transfer_format)
+
+@router.post("/import", response_class=StreamingResponse)
+async def import_inventory(
+    request: Request,
+    format: TransferFormat | None = Query(default=None),
+    session: AsyncSession = Depends(get_write_session)
+    ):
+    """
+    Create or update racks and devices from a file in /export format, rows with existing id are updated.
+    Records are validated and written in batches of IMPORT_BATCH_SIZE, each batch in its own transaction.
+    Response is NDJSON with a progress line after every batch, last line has status done or failed.
+    Import stops at first invalid batch, batches before it stay written, so a fixed file can be imported again.
+    """
+    transfer_format = format or format_of_media_type(request.headers.get("content-type"))
+    #Body is spooled to disk first, so write lock is never held while client is still uploading
+    upload = tempfile.TemporaryFile()
+    async for chunk in request.stream():
+        upload.write(chunk)
+    upload.seek(0)
+    return StreamingResponse(import_records(upload, transfer_format, session), media_type="application/x-ndjson")
+
+async def import_records(upload, transfer_format: TransferFormat, session: AsyncSession):
+    counts = {RACK: 0, DEVICE: 0}
+    batch: list[tuple[int, dict | None, str | None]] = []
+    batch_kind = None
+
+    def progress(status: str, line: int, errors: dict[int, list[str]] | None = None) -> str:
+        content = {"status": status, "line": line, "racks": counts[RACK], "devices": counts[DEVICE]}
+        if errors:
+            content["errors"] = [{"line": line, "messages": messages} for line, messages in sorted(errors.items())]
+        return json.dumps(content) + "\n"
+
+    try:
+        last_line = 0
+        for line, kind, data, error in read_records(upload, transfer_format):
+            #Records that cannot be read are reported with the batch they are in
+            kind = kind or batch_kind or RACK
+            if batch and (kind != batch_kind or len(batch) == settings.import_batch_size):
+                errors = await import_batch(batch_kind, batch, session)
+                if errors:
+                    yield progress("failed", last_line, errors)
+                    return
+                counts[batch_kind] += len(batch)
+                yield progress("running", last_line)
+                batch = []
+            batch_kind = kind
+            batch.append((line, data, error))
+            last_line = line
+
+        if batch:
+            errors = await import_batch(batch_kind, batch, session)
+            if errors:
+                yield progress("failed", last_line, errors)
+                return
+            counts[batch_kind] += len(batch)
+        yield progress("done", last_line)
+    finally:
+        upload.close()
+
+async def import_batch(kind: str, batch: list[tuple[int, dict | None, str | None]], session: AsyncSession) -> dict[int, list[str]]:
+    """Write one batch in its own transaction, returns errors per line and writes nothing if there are any."""
+    model = MODELS[kind]
+    errors: dict[int, list[str]] = {}
+    items: list[Rack | Device] = []
+    lines: list[int] = []
+    for line, data, error in batch:
+        if error is not None:
+            add_error(errors, line, error)
+            continue
+        try:
+            item = model.model_validate(data)
+        except ValidationError as e:
+            for err in e.errors():
+                add_error(errors, line, f"{'.'.join(str(l) for l in err['loc'])}: {err['msg']}")
+            continue
+        item.name = item.name.strip()
+        item.description = item.description.strip()
+        item.serial_number = item.serial_number.strip()
+        items.append(item)
+        lines.append(line)
+
+    item_errors: dict[int, list[str]] = {}
+    tables, rack_ids = [], []
+    if items:
+        import_items = import_racks if kind == RACK else import_devices
+        tables, rack_ids = await import_items(items, session, item_errors)
+    for index, messages in item_errors.items():
+        for message in messages:
+            add_error(errors, lines[index], message)
+    if errors:
+        await session.rollback()
+        return errors
+
+    await bump_inventory_version(session, *tables)
+    #ids generated by database are read back through unique serial numbers before commit,
+    #a read after it would start a new transaction that holds the write lock while progress is sent
+    new_serials = [i.serial_number for i in items if i.id is None]
+    ids = [i.id for i in items if i.id is not None]
+    if new_serials:
+        ids += (await session.exec(select(model.id).where(model.serial_number.in_(new_serials)))).all()
+    if kind == RACK:
+        changed = await read_model.changed_rows(session, tables, rack_ids=ids)
+    else:
+        changed = await read_model.changed_rows(session, tables, rack_ids=rack_ids, device_ids=ids)
+    await session.commit()
+    read_model.apply(changed)
+    return errors
+
+def item_id_validation(items: list[Rack] | list[Device], errors: dict[int, list[str]]):
+    seen_ids: set[int] = set()
+    for index, item in enumerate(items):
+        if item.id is None:
+            continue
+        if item.id < 1:
+            add_error(errors, index, f"{item.__tablename__.capitalize()} id must be positive number.")
+        elif item.id in seen_ids:
+            add_error(errors, index, f"{item.__tablename__.capitalize()} with id '{item.id}' is imported more than once.")
+        seen_ids.add(item.id)
+
+async def import_racks(racks: list[Rack], session: AsyncSession, errors: dict[int, list[str]]) -> tuple[list[str], list[int]]:
+    #Returns tables and racks whose rows changed, same for import_devices
+    ids = [r.id for r in racks if r.id is not None]
+    current = {r.id: r for r in (await session.exec(select(Rack).where(Rack.id.in_(ids)))).all()}
+    item_id_validation(racks, errors)
+    for index, rack in enumerate(racks):
+        rack_in_db = current.get(rack.id)
+        if rack_in_db is None:
+            continue
+        if rack_in_db.used_power > rack.max_power_consumption:
+            add_error(errors, index, "Device power consumption exceeds limits of rack power limit. First detach some devices from this rack.")
+        if rack_in_db.used_units > rack.unit_capacity:
+            add_error(errors, index, "Cannot fit all devices in current rack with this unit capacity. First detach some devices from this rack.")
+    await bulk_serial_number_validation(racks, session, errors)
+    if errors:
+        return [], []
+
+    #Usage counters are kept on update, new rack is always empty
+    rows = [{**r.model_dump(include=RACK_COLUMNS), "used_units": 0, "used_power": 0} for r in racks]
+    await session.exec(upsert(Rack, RACK_COLUMNS), params=rows)
+    return [RACK_TABLE], ids
+
+async def import_devices(devices: list[Device], session: AsyncSession, errors: dict[int, list[str]]) -> tuple[list[str], list[int]]:
+    ids = [d.id for d in devices if d.id is not None]
+    current = {d.id: d for d in (await session.exec(select(Device).where(Device.id.in_(ids)))).all()}
+    item_id_validation(devices, errors)
+    await bulk_serial_number_validation(devices, session, errors)
+    changes = await bulk_rack_capacity_validation(devices, current, session, errors)
+    if errors:
+        return [], []
+
+    await apply_rack_usage(changes, session)
+    rows = [d.model_dump(include=DEVICE_COLUMNS) for d in devices]
+    await session.exec(upsert(Device, DEVICE_COLUMNS), params=rows)
+    return [DEVICE_TABLE, RACK_TABLE], list(changes.keys())
+
+def upsert(model: type[Rack] | type[Device], columns: set[str]):
+    #Rows without id get one from database, executemany needs same keys in every row so id is always present
+    table = model.__table__
+    statement = insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={column: statement.excluded[column] for column in columns if column != "id"}
+    )
@@ -0,0 +1,92 @@
+from bisect import bisect_right
+from itertools import islice
+from typing import Any, Callable
+from fastapi import Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel.sql.expression import SelectOfScalar
+from app.settings import settings
+
+
+class PageParams:
+    """
+    Query parameters of list endpoints.
+    Pages are keyset based: after is id of last row of previous page, so every page costs the same index seek.
+    With stream rows are sent as NDJSON while they are read from database cursor, without building the list first.
+    """
+    def __init__(
+        self,
+        limit: int | None = Query(default=None, gt=0, le=settings.page_max_limit),
+        after: int | None = Query(default=None),
+        stream: bool = Query(default=False),
+    ):
+        self.limit = limit
+        self.after = after
+        self.stream = stream
+
+def paginate(statement, id_column, page: PageParams):
+    statement = statement.order_by(id_column)
+    if page.after is not None:
+        statement = statement.where(id_column > page.after)
+    if page.limit is not None:
+        statement = statement.limit(page.limit)
+    return statement
+
+async def page_response(
+    statement,
+    page: PageParams,
+    map_row: Callable[[Any], BaseModel],
+    request: Request,
+    response: Response,
+    session: AsyncSession
+    ):
+    if page.stream:
+        return streaming_response(stream_rows(statement, map_row, session), response)
+
+    items = [map_row(row) for row in (await session.exec(statement)).all()]
+    set_next_link(items, page, request, response)
+    return items
+
+def page_records(
+    ids: list[int],
+    records: dict[int, Any],
+    keep: Callable[[Any], bool],
+    page: PageParams,
+    map_row: Callable[[Any], BaseModel],
+    request: Request,
+    response: Response
+    ):
+    """Same as page_response for records of read model, ids are sorted candidates and keep is the filter."""
+    start = bisect_right(ids, page.after) if page.after is not None else 0
+    #Records removed by a write while streaming are skipped
+    rows = (record for record in (records.get(id) for id in islice(ids, start, None)) if record is not None and keep(record))
+    if page.stream:
+        return streaming_response(stream_records(rows, map_row), response)
+
+    items = [map_row(row) for row in islice(rows, page.limit)]
+    set_next_link(items, page, request, response)
+    return items
+
+def streaming_response(content, response: Response) -> StreamingResponse:
+    #Headers of response are applied only to returned values, not to a returned response, so ETag is copied
+    headers = {"ETag": response.headers["etag"]} if "etag" in response.headers else None
+    return StreamingResponse(content, media_type="application/x-ndjson", headers=headers)
+
+def set_next_link(items: list[BaseModel], page: PageParams, request: Request, response: Response):
+    #Full page means there may be more rows, next page starts after last returned id
+    if page.limit is not None and len(items) == page.limit:
+        next_url = request.url.include_query_params(after=items[-1].id)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+
+async def stream_rows(statement, map_row: Callable[[Any], BaseModel], session: AsyncSession):
+    result = await session.stream(statement)
+    if isinstance(statement, SelectOfScalar):
+        #Same rows as session.exec returns for select of a single model
+        result = result.scalars()
+    async for rows in result.partitions(settings.stream_batch_size):
+        yield "".join(map_row(row).model_dump_json() + "\n" for row in rows)
+
+async def stream_records(rows, map_row: Callable[[Any], BaseModel]):
+    while batch := list(islice(rows, settings.stream_batch_size)):
+        yield "".join(map_row(row).model_dump_json() + "\n" for row in batch)
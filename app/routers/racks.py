@@ -1,24 +1,85 @@
-from fastapi import APIRouter, Depends, HTTPException
+from enum import Enum
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from pydantic import ValidationError
-from sqlmodel import Session, select
-from app.database import get_session
-from app.models import Rack, RackForm, Device
-from app.routers.validation_helper import rack_exist_validation
+from sqlmodel import delete, insert, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.database import get_session, get_write_session
+from sqlalchemy.orm import selectinload
+from app.models import RACK_FREE_POWER, RACK_FREE_UNITS, BulkDeleteForm, MessageForm, Rack, RackFitForm, RackForm, Device
+from app.routers.filter_helper import RackFilters, filter_rack_records, filter_racks
+from app.routers.pagination_helper import PageParams, page_records, page_response, paginate
+from app.routers.read_model_helper import RackRecord, read_model
+from app.routers.validation_helper import (
+    add_error, bulk_errors_validation, bulk_model_validation, bulk_serial_number_validation, bulk_size_validation,
+    rack_exist_validation, serial_number_validation,
+)
+from app.routers.version_helper import DEVICE_TABLE, RACK_TABLE, bump_inventory_version, get_inventory_version, not_modified, rack_etag
+from app.settings import settings
 
 router = APIRouter(prefix="/racks", tags=["racks"])
 
-@router.get("/")
-async def get_all(session: Session = Depends(get_session)):
-    racks = [map_rack_form(rack) for rack in session.exec(select(Rack)).all()]
-    return racks
+class FitPolicy(str, Enum):
+    #Rack with least free power that still fits, keeps roomy racks for large devices
+    BEST_FIT = "best_fit"
+    #Rack with most free power
+    MOST_HEADROOM = "most_headroom"
 
-@router.get("/{rack_id}")
-async def get_single(rack_id: int, session: Session = Depends(get_session)):
-    rack = session.get(Rack, rack_id)
+@router.get("/", response_model=list[RackForm])
+async def get_all(
+    request: Request,
+    response: Response,
+    page: PageParams = Depends(),
+    filters: RackFilters = Depends(),
+    session: AsyncSession = Depends(get_session)
+    ):
+    #Full text search needs the FTS index, it is always answered by database
+    model = await read_model.current(session) if read_model.enabled and filters.q is None else None
+    #Version is read in the same transaction as rows, or is the version read model holds
+    version = model.version if model is not None else await get_inventory_version(session)
+    if (cached := not_modified(request, response, rack_etag(version))) is not None:
+        return cached
+
+    if model is not None:
+        ids, keep = filter_rack_records(model, filters)
+        return page_records(ids, model.racks, keep, page, map_rack_form, request, response)
+
+    statement = paginate(filter_racks(select(Rack), filters), Rack.id, page)
+    return await page_response(statement, page, map_rack_form, request, response, session)
+
+@router.get("/fit", response_model=list[RackFitForm])
+async def get_fitting(
+    units: int = Query(gt=0),
+    power: int = Query(gt=0),
+    policy: FitPolicy = Query(default=FitPolicy.BEST_FIT),
+    limit: int = Query(default=10, gt=0, le=settings.page_max_limit),
+    session: AsyncSession = Depends(get_session)
+    ):
+    """
+    Racks that have room for a device of given units and power right now.
+    Answered by a range scan of ix_rack_free_power in policy order, rows stop being read once limit is reached.
+    """
+    order = RACK_FREE_POWER.asc() if policy == FitPolicy.BEST_FIT else RACK_FREE_POWER.desc()
+    statement = (select(Rack)
+                 .where(RACK_FREE_POWER >= power, RACK_FREE_UNITS >= units)
+                 .order_by(order)
+                 .limit(limit))
+    return [map_rack_fit_form(rack) for rack in (await session.exec(statement)).all()]
+
+@router.get("/{rack_id}", response_model=RackForm)
+async def get_single(rack_id: int, request: Request, response: Response, session: AsyncSession = Depends(get_session)):
+    model = await read_model.current(session) if read_model.enabled else None
+    version = model.version if model is not None else await get_inventory_version(session)
+    if model is not None:
+        rack = model.racks.get(rack_id)
+    else:
+        rack = await session.get(Rack, rack_id)
+    #Checked before If-None-Match, * must not turn 404 into 304
     rack_exist_validation(rack_id, rack)
+    if (cached := not_modified(request, response, rack_etag(version))) is not None:
+        return cached
     return map_rack_form(rack)
 
-def map_rack_form(rack: Rack):
+def map_rack_form(rack: Rack | RackRecord):
     return RackForm(
         id = rack.id,
         name = rack.name,
@@ -26,22 +87,41 @@ def map_rack_form(rack: Rack):
         serial_number = rack.serial_number,
         unit_capacity = rack.unit_capacity,
         max_power_consumption = rack.max_power_consumption,
-        power_consumption = sum([d.power_consumption for d in rack.devices])
+        power_consumption = rack.used_power
+    )
+
+def map_rack_fit_form(rack: Rack):
+    #Built directly, not from a RackForm, so every row is validated once
+    return RackFitForm(
+        id = rack.id,
+        name = rack.name,
+        description = rack.description,
+        serial_number = rack.serial_number,
+        unit_capacity = rack.unit_capacity,
+        max_power_consumption = rack.max_power_consumption,
+        power_consumption = rack.used_power,
+        free_units = rack.unit_capacity - rack.used_units,
+        free_power = rack.max_power_consumption - rack.used_power
     )
 
-@router.post("/")
-async def create_rack(rack: Rack, session: Session = Depends(get_session)):
+@router.post("/", response_model=Rack)
+async def create_rack(rack: Rack, session: AsyncSession = Depends(get_write_session)):
     try: 
         rack.name = rack.name.strip()
         rack.description = rack.description.strip()
         rack.serial_number = rack.serial_number.strip()
         
-        rack_validation(rack, session, True)
+        await rack_validation(rack, session, True)
         new_rack = Rack.model_validate(rack)
+        #Usage is maintained by device write paths, new rack is always empty
+        new_rack.used_units = 0
+        new_rack.used_power = 0
 
         session.add(new_rack)
-        session.commit()
-        session.refresh(new_rack)
+        await bump_inventory_version(session, RACK_TABLE)
+        changed = await read_model.changed_rows(session, [RACK_TABLE], rack_ids=[new_rack.id])
+        await session.commit()
+        read_model.apply(changed)
         return new_rack
     except ValidationError as e:
         msg: list[str] = [err["msg"] for err in  e.errors()]
@@ -50,7 +130,7 @@ async def create_rack(rack: Rack, session: Session = Depends(get_session)):
                 detail={'messages': msg}
             )
 
-def rack_validation(rack: Rack, session: Session, create_mod: bool):
+async def rack_validation(rack: Rack, session: AsyncSession, create_mod: bool):
     #Check if Rack with this id already exist, only check if it is creation, not update of rack
     if rack.id < 1:
         raise HTTPException(
@@ -59,7 +139,7 @@ def rack_validation(rack: Rack, session: Session, create_mod: bool):
             )
     
     if create_mod:
-        if(session.get(Rack, rack.id) is not None):
+        if(await session.get(Rack, rack.id) is not None):
             raise HTTPException(
                 status_code=400,
                 detail=f"Rack with id '{rack.id}' already exists."
@@ -77,44 +157,134 @@ def rack_validation(rack: Rack, session: Session, create_mod: bool):
         )
     
     if(not create_mod):
-        rack_in_db = session.get(Rack, rack.id)
-        total_consumption = sum([d.power_consumption for d in rack_in_db.devices])
-        if(total_consumption > rack.max_power_consumption):
+        rack_in_db = await session.get(Rack, rack.id)
+        if(rack_in_db.used_power > rack.max_power_consumption):
             raise HTTPException(
                 status_code=400,
                 detail=f"Device power consumption exceeds limits of rack power limit. First detach some devices from this rack."
             ) 
         
-        total_size = sum([d.unit_size for d in rack_in_db.devices])
-        if(total_size > rack.unit_capacity):
+        if(rack_in_db.used_units > rack.unit_capacity):
             raise HTTPException(
                 status_code=400,
                 detail=f"Cannot fit all devices in current rack with this unit capacity. First detach some devices from this rack."
             ) 
 
-    id_to_check = rack.id if not create_mod else -1
-    unique_serial_number_validation(id_to_check, rack.serial_number, session)
+    await serial_number_validation(rack, session)
 
-def unique_serial_number_validation(current_id: int, value: str, session: Session): 
-    select_rack = select(Rack.id).where(Rack.serial_number == value).where(Rack.id != current_id)
-    rack = session.exec(select_rack).first()
-    select_device = select(Device.id).where(Device.serial_number == value)
-    device = session.exec(select_device).first()
-    if rack is not None or device is not None:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Serial number '{value}' already exists."
-        )
-    return
+@router.post("/bulk", response_model=list[Rack])
+async def create_racks(racks: list[Rack], session: AsyncSession = Depends(get_write_session)):
+    """Create all racks in one transaction, nothing is created if any rack is invalid."""
+    bulk_size_validation(racks)
+    errors: dict[int, list[str]] = {}
+    for rack in racks:
+        rack.name = rack.name.strip()
+        rack.description = rack.description.strip()
+        rack.serial_number = rack.serial_number.strip()
+    bulk_model_validation(Rack, racks, errors)
+
+    given_ids = [r.id for r in racks if r.id is not None]
+    existing_ids = set((await session.exec(select(Rack.id).where(Rack.id.in_(given_ids)))).all())
+    seen_ids: set[int] = set()
+    for index, rack in enumerate(racks):
+        if rack.id is None:
+            continue
+        if rack.id < 1:
+            add_error(errors, index, "Rack id must be positive number.")
+        elif rack.id in existing_ids or rack.id in seen_ids:
+            add_error(errors, index, f"Rack with id '{rack.id}' already exists.")
+        seen_ids.add(rack.id)
+
+    await bulk_serial_number_validation(racks, session, errors)
+    bulk_errors_validation(errors)
+
+    #Usage is maintained by device write paths, new rack is always empty
+    rows = [{**r.model_dump(include=RACK_COLUMNS), "used_units": 0, "used_power": 0} for r in racks]
+    await session.exec(insert(Rack.__table__), params=rows)
+    await bump_inventory_version(session, RACK_TABLE)
+    #ids generated by database are read back through unique serial numbers before commit
+    serials = [r.serial_number for r in racks]
+    created = {r.serial_number: r for r in (await session.exec(select(Rack).where(Rack.serial_number.in_(serials)))).all()}
+    changed = await read_model.changed_rows(session, [RACK_TABLE], rack_ids=[r.id for r in created.values()])
+    await session.commit()
+    read_model.apply(changed)
+    return [created[serial] for serial in serials]
+
+@router.put("/bulk", response_model=list[RackForm])
+async def update_racks(racks: list[Rack], session: AsyncSession = Depends(get_write_session)):
+    """Update all racks in one transaction, nothing is updated if any rack is invalid."""
+    bulk_size_validation(racks)
+    errors: dict[int, list[str]] = {}
+    for rack in racks:
+        rack.name = rack.name.strip()
+        rack.description = rack.description.strip()
+        rack.serial_number = rack.serial_number.strip()
+    bulk_model_validation(Rack, racks, errors)
+
+    ids = [r.id for r in racks if r.id is not None]
+    current = {r.id: r for r in (await session.exec(select(Rack).where(Rack.id.in_(ids)))).all()}
+    seen_ids: set[int] = set()
+    for index, rack in enumerate(racks):
+        if rack.id is None:
+            add_error(errors, index, "Rack id is required.")
+            continue
+        rack_in_db = current.get(rack.id)
+        if rack_in_db is None:
+            add_error(errors, index, f"Rack with id {rack.id} does not exist")
+            continue
+        if rack.id in seen_ids:
+            add_error(errors, index, f"Rack with id '{rack.id}' is updated more than once.")
+        seen_ids.add(rack.id)
+        if rack_in_db.used_power > rack.max_power_consumption:
+            add_error(errors, index, "Device power consumption exceeds limits of rack power limit. First detach some devices from this rack.")
+        if rack_in_db.used_units > rack.unit_capacity:
+            add_error(errors, index, "Cannot fit all devices in current rack with this unit capacity. First detach some devices from this rack.")
+
+    await bulk_serial_number_validation(racks, session, errors)
+    bulk_errors_validation(errors)
+
+    #Usage columns are not part of rows so counters stay as they are
+    rows = [r.model_dump(include=RACK_COLUMNS) for r in racks]
+    await session.exec(update(Rack), params=rows)
+    await bump_inventory_version(session, RACK_TABLE)
+    changed = await read_model.changed_rows(session, [RACK_TABLE], rack_ids=ids)
+    await session.commit()
+    read_model.apply(changed)
+
+    for rack in racks:
+        rack.used_units = current[rack.id].used_units
+        rack.used_power = current[rack.id].used_power
+    return [map_rack_form(rack) for rack in racks]
+
+@router.post("/bulk_delete", response_model=MessageForm)
+async def delete_racks(form: BulkDeleteForm, session: AsyncSession = Depends(get_write_session)):
+    bulk_size_validation(form.ids)
+    errors: dict[int, list[str]] = {}
+    existing_ids = set((await session.exec(select(Rack.id).where(Rack.id.in_(form.ids)))).all())
+    for index, rack_id in enumerate(form.ids):
+        if rack_id not in existing_ids:
+            add_error(errors, index, f"Rack with id {rack_id} does not exist")
+    bulk_errors_validation(errors)
+
+    #Devices are detached from deleted racks same as with single delete
+    detached = (await session.exec(update(Device).where(Device.rack_id.in_(form.ids)).values(rack_id=None).returning(Device.id))).scalars().all()
+    await session.exec(delete(Rack).where(Rack.id.in_(form.ids)))
+    await bump_inventory_version(session, RACK_TABLE, DEVICE_TABLE)
+    changed = await read_model.changed_rows(session, [RACK_TABLE, DEVICE_TABLE], rack_ids=form.ids, device_ids=detached)
+    await session.commit()
+    read_model.apply(changed)
+    return {"message": f"{len(existing_ids)} racks deleted successfully"}
+
+RACK_COLUMNS = {"id", "name", "description", "serial_number", "unit_capacity", "max_power_consumption"}
 
-@router.put("/{rack_id}")
-async def update_rack(rack_id: int, rack: Rack, session: Session = Depends(get_session)):
+@router.put("/{rack_id}", response_model=Rack)
+async def update_rack(rack_id: int, rack: Rack, session: AsyncSession = Depends(get_write_session)):
     try: 
         rack.id = rack_id
-        rack_to_update: Rack = session.get(Rack, rack_id)
+        rack_to_update: Rack = await session.get(Rack, rack_id)
         rack_exist_validation(rack_id, rack_to_update)
         
-        rack_validation(rack, session, False)
+        await rack_validation(rack, session, False)
         Rack.model_validate(rack)
 
         rack_to_update.name = rack.name.strip()
@@ -124,8 +294,10 @@ async def update_rack(rack_id: int, rack: Rack, session: Session = Depends(get_s
         rack_to_update.max_power_consumption = rack.max_power_consumption
 
         session.add(rack_to_update)
-        session.commit()
-        session.refresh(rack_to_update)
+        await bump_inventory_version(session, RACK_TABLE)
+        changed = await read_model.changed_rows(session, [RACK_TABLE], rack_ids=[rack_id])
+        await session.commit()
+        read_model.apply(changed)
         return rack_to_update
     except ValidationError as e:
         msg: list[str] = [err["msg"] for err in  e.errors()]
@@ -134,10 +306,15 @@ async def update_rack(rack_id: int, rack: Rack, session: Session = Depends(get_s
                 detail={'messages': msg}
             )
     
-@router.delete("/{rack_id}")
-async def delete_rack(rack_id: int, session: Session = Depends(get_session)):
-    rack_to_delete: Rack = session.get(Rack, rack_id)
+@router.delete("/{rack_id}", response_model=MessageForm)
+async def delete_rack(rack_id: int, session: AsyncSession = Depends(get_write_session)):
+    #Devices are loaded so they are detached from rack on delete
+    rack_to_delete: Rack = await session.get(Rack, rack_id, options=[selectinload(Rack.devices)])
     rack_exist_validation(rack_id, rack_to_delete)
-    session.delete(rack_to_delete)
-    session.commit()
+    detached = [d.id for d in rack_to_delete.devices]
+    await session.delete(rack_to_delete)
+    await bump_inventory_version(session, RACK_TABLE, DEVICE_TABLE)
+    changed = await read_model.changed_rows(session, [RACK_TABLE, DEVICE_TABLE], rack_ids=[rack_id], device_ids=detached)
+    await session.commit()
+    read_model.apply(changed)
     return {"message": f"Rack '{rack_to_delete.name}' deleted successfully"}
@@ -0,0 +1,222 @@
+import time
+from bisect import bisect_left
+from typing import Iterable
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.models import Device, Rack
+from app.settings import settings
+from app.routers.version_helper import DEVICE_TABLE, RACK_TABLE, get_inventory_version, version_signal
+
+"""
+In-process copy of racks and devices that serves reads without database round trips.
+It is built on first use, write paths of this process read rows they changed before commit and patch them in after.
+Writes of other processes are noticed through version_signal on every read, and through inventory_version
+in the database at most every check_interval_ms for writers that do not publish the signal.
+A version the model did not expect makes it rebuild from the database.
+"""
+
+class RackRecord:
+    __slots__ = ("id", "name", "description", "serial_number", "unit_capacity", "max_power_consumption", "used_units", "used_power")
+
+    def __init__(self, id, name, description, serial_number, unit_capacity, max_power_consumption, used_units, used_power):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.serial_number = serial_number
+        self.unit_capacity = unit_capacity
+        self.max_power_consumption = max_power_consumption
+        self.used_units = used_units
+        self.used_power = used_power
+
+class DeviceRecord:
+    __slots__ = ("id", "name", "description", "serial_number", "unit_size", "power_consumption", "rack_id")
+
+    def __init__(self, id, name, description, serial_number, unit_size, power_consumption, rack_id):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.serial_number = serial_number
+        self.unit_size = unit_size
+        self.power_consumption = power_consumption
+        self.rack_id = rack_id
+
+class ChangedRows:
+    """Rows a write changed and versions it wrote, read before commit."""
+    __slots__ = ("tables", "version", "rack_ids", "device_ids", "rack_rows", "device_rows")
+
+    def __init__(self, tables, version, rack_ids, device_ids, rack_rows, device_rows):
+        self.tables = tables
+        self.version = version
+        self.rack_ids = rack_ids
+        self.device_ids = device_ids
+        self.rack_rows = rack_rows
+        self.device_rows = device_rows
+
+RACK_COLUMNS = [getattr(Rack, name) for name in RackRecord.__slots__]
+DEVICE_COLUMNS = [getattr(Device, name) for name in DeviceRecord.__slots__]
+
+class ReadModel:
+    def __init__(self, enabled: bool, check_interval_ms: int):
+        self.enabled = enabled
+        self.check_interval_ms = check_interval_ms
+        self.racks: dict[int, RackRecord] = {}
+        self.devices: dict[int, DeviceRecord] = {}
+        self.devices_of_rack: dict[int, set[int]] = {}
+        #Same as serial_number table, serial number to (table, id)
+        self.serial_numbers: dict[str, tuple[str, int]] = {}
+        #None until built, then versions of racks and devices the model holds
+        self.version: tuple[int, int] | None = None
+        self.checked_at = 0.0
+        #Sorted lists are built when first needed after a change
+        self.sorted_rack_ids: list[int] | None = None
+        self.sorted_device_ids: list[int] | None = None
+        self.sorted_serial_numbers: list[str] | None = None
+        self.rebuilds = 0
+
+    async def current(self, session: AsyncSession) -> "ReadModel":
+        """Model that reflects committed writes, rebuilt if it is stale."""
+        signal = version_signal.read()
+        if (self.version is not None and (signal is None or signal == self.version)
+                and (time.monotonic() - self.checked_at) * 1000 < self.check_interval_ms):
+            return self
+        version = await get_inventory_version(session)
+        if version != self.version:
+            await self.rebuild(session, version)
+        self.checked_at = time.monotonic()
+        return self
+
+    async def rebuild(self, session: AsyncSession, version: tuple[int, int]):
+        #Version is read before rows, so rows are never older than the version they are stored with
+        rack_rows = (await session.exec(select(*RACK_COLUMNS))).all()
+        device_rows = (await session.exec(select(*DEVICE_COLUMNS))).all()
+        self.racks = {row[0]: RackRecord(*row) for row in rack_rows}
+        self.devices = {}
+        self.devices_of_rack = {}
+        self.serial_numbers = {r.serial_number: (RACK_TABLE, r.id) for r in self.racks.values()}
+        for row in device_rows:
+            self.put_device(DeviceRecord(*row))
+        self.version = version
+        self.changed()
+        self.rebuilds += 1
+
+    async def changed_rows(
+        self,
+        session: AsyncSession,
+        tables: Iterable[str],
+        rack_ids: Iterable[int | None] = (),
+        device_ids: Iterable[int] = ()
+        ) -> "ChangedRows | None":
+        """
+        Called by write paths before commit with tables they bumped and ids of rows they changed, rows are read
+        in the write transaction so no second transaction is started after commit. Pass result to apply once committed.
+        """
+        if not self.enabled or self.version is None:
+            return None
+        rack_ids = [id for id in set(rack_ids) if id is not None]
+        device_ids = list(set(device_ids))
+        version = await get_inventory_version(session)
+        rack_rows = (await session.exec(select(*RACK_COLUMNS).where(Rack.id.in_(rack_ids)))).all() if rack_ids else []
+        device_rows = (await session.exec(select(*DEVICE_COLUMNS).where(Device.id.in_(device_ids)))).all() if device_ids else []
+        return ChangedRows(set(tables), version, rack_ids, device_ids, rack_rows, device_rows)
+
+    def apply(self, changed: "ChangedRows | None"):
+        """
+        Patch rows read by changed_rows after their write is committed, rows missing from database are removed.
+        If versions are not exactly one above model for tables written, another writer came in between
+        and the model is rebuilt on next read.
+        """
+        #Checked here, another request may have changed the model since rows were read
+        if changed is None or self.version is None:
+            return
+        rack_version, device_version = self.version
+        if changed.version != (rack_version + (RACK_TABLE in changed.tables), device_version + (DEVICE_TABLE in changed.tables)):
+            self.version = None
+            return
+
+        found = {row[0] for row in changed.rack_rows}
+        for rack_id in changed.rack_ids:
+            if rack_id not in found:
+                self.remove_rack(rack_id)
+        for row in changed.rack_rows:
+            self.put_rack(RackRecord(*row))
+        found = {row[0] for row in changed.device_rows}
+        for device_id in changed.device_ids:
+            if device_id not in found:
+                self.remove_device(device_id)
+        for row in changed.device_rows:
+            self.put_device(DeviceRecord(*row))
+        self.version = changed.version
+        self.changed()
+
+    def put_rack(self, rack: RackRecord):
+        old = self.racks.get(rack.id)
+        if old is not None and self.serial_numbers.get(old.serial_number) == (RACK_TABLE, old.id):
+            del self.serial_numbers[old.serial_number]
+        self.racks[rack.id] = rack
+        self.serial_numbers[rack.serial_number] = (RACK_TABLE, rack.id)
+
+    def remove_rack(self, rack_id: int):
+        old = self.racks.pop(rack_id, None)
+        if old is not None and self.serial_numbers.get(old.serial_number) == (RACK_TABLE, old.id):
+            del self.serial_numbers[old.serial_number]
+        #Devices of deleted rack are detached by the same write and refreshed with it
+        self.devices_of_rack.pop(rack_id, None)
+
+    def put_device(self, device: DeviceRecord):
+        self.remove_device(device.id)
+        self.devices[device.id] = device
+        self.serial_numbers[device.serial_number] = (DEVICE_TABLE, device.id)
+        if device.rack_id is not None:
+            self.devices_of_rack.setdefault(device.rack_id, set()).add(device.id)
+
+    def remove_device(self, device_id: int):
+        old = self.devices.pop(device_id, None)
+        if old is None:
+            return
+        if self.serial_numbers.get(old.serial_number) == (DEVICE_TABLE, old.id):
+            del self.serial_numbers[old.serial_number]
+        if old.rack_id is not None:
+            self.devices_of_rack.get(old.rack_id, set()).discard(device_id)
+
+    def changed(self):
+        self.sorted_rack_ids = None
+        self.sorted_device_ids = None
+        self.sorted_serial_numbers = None
+
+    def rack_ids(self) -> list[int]:
+        if self.sorted_rack_ids is None:
+            self.sorted_rack_ids = sorted(self.racks)
+        return self.sorted_rack_ids
+
+    def device_ids(self) -> list[int]:
+        if self.sorted_device_ids is None:
+            self.sorted_device_ids = sorted(self.devices)
+        return self.sorted_device_ids
+
+    def serial_number_ids(self, table: str, prefix: str) -> list[int]:
+        """Sorted ids of rows of table whose serial number starts with prefix."""
+        if self.sorted_serial_numbers is None:
+            self.sorted_serial_numbers = sorted(self.serial_numbers)
+        ids = []
+        for serial_number in self.sorted_serial_numbers[bisect_left(self.sorted_serial_numbers, prefix):]:
+            if not serial_number.startswith(prefix):
+                break
+            owner_table, owner_id = self.serial_numbers[serial_number]
+            if owner_table == table:
+                ids.append(owner_id)
+        return sorted(ids)
+
+    def rack_name(self, rack_id: int | None) -> str | None:
+        rack = self.racks.get(rack_id)
+        return rack.name if rack is not None else None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "version": self.version,
+            "racks": len(self.racks),
+            "devices": len(self.devices),
+            "rebuilds": self.rebuilds,
+        }
+
+read_model = ReadModel(settings.read_model, settings.read_model_check_interval_ms)
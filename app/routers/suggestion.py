@@ -1,119 +1,582 @@
-import math
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlmodel import Session, select
-from app.database import get_session
-from app.models import Rack, Device
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from functools import partial
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Field, SQLModel, delete, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.cache import ResultCache
+from app.database import engine, get_session, get_write_session, write_engine
+from app.jobs import Job, JobQueue, JobStatus, QueueFullError
+from app.metrics import observe_planning
+from app.models import RACK_FREE_POWER, RACK_FREE_UNITS, PlanningJob, Rack, Device
+from app.planner import PackingStrategy, PlacementError, RebalanceResult, SearchResult, optimize, pack, rebalance, snapshot
+from app.routers.read_model_helper import ReadModel, read_model
+from app.routers.usage_helper import apply_rack_usage, bulk_rack_capacity_validation
+from app.routers.validation_helper import add_error, bulk_errors_validation, bulk_size_validation
+from app.routers.version_helper import DEVICE_TABLE, RACK_TABLE, bump_inventory_version, get_inventory_version, inventory_etag
+from app.settings import settings
 
 router = APIRouter(prefix="/suggestion", tags=["suggestion"])
 
-@router.get("/")
+class SuggestionMode(str, Enum):
+    GREEDY = "greedy"
+    #Improve greedy plan until budget_ms runs out, response also contains objective and optimality
+    OPTIMIZE = "optimize"
+
+class PlacementForm(SQLModel):
+    rack_id: int
+    device_ids: list[int]
+
+class SuggestionParams(SQLModel):
+    device_ids: list[int] = []
+    rack_ids: list[int] = []
+    strategy: PackingStrategy = PackingStrategy.LEAST_POWER_PERCENTAGE
+    mode: SuggestionMode = SuggestionMode.GREEDY
+    budget_ms: int = Field(default=200, gt=0, le=60000)
+    incremental: bool = False
+
+class ApplySuggestionForm(SuggestionParams):
+    #Plan as returned by /suggestion, if missing it is computed from other fields
+    racks: list[PlacementForm] | None = None
+
+class RebalanceForm(SQLModel):
+    #Empty means all racks
+    rack_ids: list[int] = []
+    #Target, at least one of these is required
+    max_power_percentage: float | None = Field(default=None, gt=0, le=100)
+    max_variance: float | None = Field(default=None, ge=0, description="Variance of power percentages of racks")
+    max_moves: int = Field(default=10, gt=0, le=settings.bulk_max_items)
+    budget_ms: int = Field(default=200, gt=0, le=60000)
+    dry_run: bool = True
+
+class JobKind(str, Enum):
+    SUGGESTION = "suggestion"
+    REBALANCE = "rebalance"
+
+class JobForm(SQLModel):
+    kind: JobKind = JobKind.SUGGESTION
+    #Used by kind suggestion
+    suggestion: SuggestionParams = SuggestionParams()
+    #Used by kind rebalance, jobs only plan moves
+    rebalance: RebalanceForm = RebalanceForm()
+
+class SuggestionInfo(SQLModel):
+    rack_id: int
+    rack_name: str
+    max_power_consumption: int
+    power_consumption: int
+    power_percentage: float
+    unit_capacity: int
+    unit_size_taken: int
+    size_percentage: float
+    device_ids: list[int]
+
+class OptimizedSuggestion(SQLModel):
+    racks: list[SuggestionInfo]
+    #Capacity weighted mean of squared power fractions of racks, lower is more balanced
+    objective: float
+    #True if search proved no better plan exists
+    optimal: bool
+
+class RebalanceMove(SQLModel):
+    device_id: int
+    from_rack_id: int
+    to_rack_id: int
+
+class RebalancePlan(SQLModel):
+    moves: list[RebalanceMove]
+    #False if target could not be reached within max_moves or budget_ms, moves then get as close as found
+    target_met: bool
+    max_power_percentage_before: float
+    max_power_percentage_after: float
+    variance_before: float
+    variance_after: float
+    applied: bool
+
+class JobInfo(SQLModel):
+    id: str
+    kind: JobKind
+    status: JobStatus
+    #ETag of racks and devices job was planned from, If-Match header for /suggestion/apply
+    etag: str | None
+    #Unix timestamps
+    created_at: float
+    started_at: float | None
+    finished_at: float | None
+    #Set when status is done
+    result: list[SuggestionInfo] | OptimizedSuggestion | RebalancePlan | None
+    #Set when status is failed or timed_out
+    error: str | None
+
+#Planner is pure Python, in these threads it still shares the GIL but event loop keeps serving other requests
+planning_executor = ThreadPoolExecutor(settings.planning_threads, thread_name_prefix="planning")
+suggestion_cache = ResultCache(settings.suggestion_cache_size, settings.suggestion_cache_ttl_seconds)
+job_queue = JobQueue(
+    settings.job_workers, settings.job_queue_size, settings.job_timeout_seconds, settings.job_keep_finished,
+    on_change=lambda job: save_job(job),
+    cancelled=lambda job: saved_job_cancelled(job)
+)
+
+@router.get("/", response_model=list[SuggestionInfo] | OptimizedSuggestion)
 async def suggest(
+    response: Response,
     device_ids: list[int] = Query(default=[]),
     rack_ids: list[int] = Query(default=[]),
-    session: Session = Depends(get_session)
+    strategy: PackingStrategy = Query(default=PackingStrategy.LEAST_POWER_PERCENTAGE),
+    mode: SuggestionMode = Query(default=SuggestionMode.GREEDY),
+    budget_ms: int = Query(default=200, gt=0, le=60000),
+    incremental: bool = Query(default=False, description=(
+        "Plan only unassigned devices into racks as they are now, empty device_ids or rack_ids mean all of them"
+    )),
+    session: AsyncSession = Depends(get_session)
     ):
-    
-    #get racks and sort by consumption
-    select_racks = select(Rack).where(Rack.id.in_(rack_ids)).order_by(Rack.max_power_consumption.desc())
-    racks_list: list[Rack] = session.exec(select_racks).all()
 
-    #get devices and sort by consumption
-    select_devices = select(Device).where(Device.id.in_(device_ids)).order_by(Device.power_consumption.desc())
-    devices_list: list[Device] = session.exec(select_devices).all()
+    inline_budget_validation(mode, budget_ms)
+    version = await get_inventory_version(session)
+    #Client sends it back in If-Match header of /suggestion/apply
+    response.headers["ETag"] = inventory_etag(version)
 
-    #Test if total unit size or power consumption of devices is larger then the racks 
-    #if yes go to early exit and return error message
-    rack_max_units = sum([r.unit_capacity for r in racks_list])
-    rack_max_pow = sum([r.max_power_consumption for r in racks_list])
-    device_max_untis = sum([r.unit_size for r in devices_list])
-    device_max_pow = sum([r.power_consumption for r in devices_list])
+    #Result does not depend on order of ids because rows are sorted when loaded
+    key = (
+        tuple(sorted(set(device_ids))),
+        tuple(sorted(set(rack_ids))),
+        strategy,
+        mode,
+        budget_ms if mode == SuggestionMode.OPTIMIZE else None,
+        incremental,
+        version,
+    )
+    return await suggestion_cache.get_or_compute(
+        key, lambda: plan_suggestion(device_ids, rack_ids, strategy, mode, budget_ms, incremental, session, allow_read_model=True)
+    )
 
-    if(device_max_untis > rack_max_units):
+@router.post("/apply", response_model=list[SuggestionInfo])
+async def apply_suggestion(
+    form: ApplySuggestionForm,
+    response: Response,
+    if_match: str | None = Header(default=None),
+    session: AsyncSession = Depends(get_write_session)
+    ):
+    """
+    Move devices into racks as planned, in one transaction so either all devices are moved or none is.
+    Plan sent by client needs If-Match header with ETag of /suggestion response it came from,
+    it is rejected if racks or devices changed since then.
+    Without a plan, suggestion is computed from ids in the same transaction.
+    """
+    if form.racks is not None and if_match is None:
         raise HTTPException(
-                status_code=400,
-                detail="Not enough space to store all devices"
-            )   
-    if(device_max_pow > rack_max_pow):
+            status_code=428,
+            detail="If-Match header with ETag of the suggestion is required to apply a plan."
+        )
+
+    if form.racks is None:
+        inline_budget_validation(form.mode, form.budget_ms)
+    version = await if_match_validation(session, if_match)
+
+    if form.racks is None:
+        plan = await plan_suggestion(form.device_ids, form.rack_ids, form.strategy, form.mode, form.budget_ms, form.incremental, session)
+        suggestions = plan.racks if isinstance(plan, OptimizedSuggestion) else plan
+        placements = [PlacementForm(rack_id=s.rack_id, device_ids=s.device_ids) for s in suggestions]
+    else:
+        placements = form.racks
+
+    device_ids = [id for p in placements for id in p.device_ids]
+    bulk_size_validation(device_ids)
+    current = {d.id: d for d in (await session.exec(select(Device).where(Device.id.in_(device_ids)))).all()}
+
+    #Errors are reported per index of rack in plan
+    errors: dict[int, list[str]] = {}
+    moved: list[Device] = []
+    placement_of_moved: list[int] = []
+    seen_ids: set[int] = set()
+    for index, placement in enumerate(placements):
+        for device_id in placement.device_ids:
+            device = current.get(device_id)
+            if device is None:
+                add_error(errors, index, f"Device with id {device_id} does not exist")
+            elif device_id in seen_ids:
+                add_error(errors, index, f"Device with id '{device_id}' is placed more than once.")
+            else:
+                moved.append(Device(id=device.id, unit_size=device.unit_size, power_consumption=device.power_consumption, rack_id=placement.rack_id))
+                placement_of_moved.append(index)
+            seen_ids.add(device_id)
+
+    device_errors: dict[int, list[str]] = {}
+    changes = await bulk_rack_capacity_validation(moved, current, session, device_errors)
+    for device_index, messages in device_errors.items():
+        index = placement_of_moved[device_index]
+        for message in messages:
+            if message not in errors.get(index, []):
+                add_error(errors, index, message)
+    bulk_errors_validation(errors)
+
+    await apply_rack_usage(changes, session)
+    changed_rack_ids = [d.rack_id for d in moved] + [current[d.id].rack_id for d in moved]
+    if moved:
+        await session.exec(update(Device), params=[{"id": d.id, "rack_id": d.rack_id} for d in moved])
+    await bump_inventory_version(session, RACK_TABLE, DEVICE_TABLE)
+    changed = await read_model.changed_rows(session, [RACK_TABLE, DEVICE_TABLE], rack_ids=changed_rack_ids, device_ids=[d.id for d in moved])
+    await session.commit()
+    read_model.apply(changed)
+
+    response.headers["ETag"] = inventory_etag(version)
+    #Racks and devices are already in identity map, no query is made
+    return [map_suggestion_info(await session.get(Rack, p.rack_id), [current[id] for id in p.device_ids]) for p in placements]
+
+@router.post("/rebalance", response_model=RebalancePlan)
+async def rebalance_racks(
+    form: RebalanceForm,
+    response: Response,
+    if_match: str | None = Header(default=None),
+    session: AsyncSession = Depends(get_session)
+    ):
+    """
+    Smallest set of device moves found after which racks meet the target, devices stay where they are otherwise.
+    With dry_run false moves are planned without the write lock, then applied only if racks and devices
+    did not change in the meantime, else 412 is returned.
+    """
+    rebalance_target_validation(form)
+    inline_budget_validation(SuggestionMode.OPTIMIZE, form.budget_ms)
+
+    #Moves that are applied are planned from the database, read model of this process may miss writes of others
+    racks_list, devices_list, rack_of_device = await load_rebalance_input(form.rack_ids, session, allow_read_model=form.dry_run)
+    if not form.dry_run:
+        planned_version = await get_inventory_version(session)
+        etag_validation(planned_version, if_match)
+        #Read transaction ends here, objects are not expired
+        await session.commit()
+
+    result = await run_planning(partial(
+        rebalance, racks_list, devices_list, rack_of_device,
+        form.max_power_percentage, form.max_variance, form.max_moves, form.budget_ms
+    ))
+    plan = map_rebalance_plan(racks_list, devices_list, result, applied=not form.dry_run)
+
+    if not form.dry_run:
+        #Write lock is held only while moves are applied, version tells if input changed during planning
+        await session.connection(execution_options={"sqlite_begin": "IMMEDIATE"})
+        version = await if_match_validation(session, inventory_etag(planned_version))
+        current = {d.id: d for d in devices_list}
+        moved = [Device(id=m.device_id, unit_size=current[m.device_id].unit_size,
+                        power_consumption=current[m.device_id].power_consumption, rack_id=m.to_rack_id) for m in plan.moves]
+        #Moves always fit, this only applies them to rack usage counters
+        errors: dict[int, list[str]] = {}
+        changes = await bulk_rack_capacity_validation(moved, current, session, errors)
+        bulk_errors_validation(errors)
+        await apply_rack_usage(changes, session)
+        if moved:
+            await session.exec(update(Device), params=[{"id": d.id, "rack_id": d.rack_id} for d in moved])
+        await bump_inventory_version(session, RACK_TABLE, DEVICE_TABLE)
+        changed = await read_model.changed_rows(
+            session, [RACK_TABLE, DEVICE_TABLE],
+            rack_ids=[m.from_rack_id for m in plan.moves] + [m.to_rack_id for m in plan.moves], device_ids=[m.device_id for m in plan.moves]
+        )
+        await session.commit()
+        read_model.apply(changed)
+        response.headers["ETag"] = inventory_etag(version)
+    return plan
+
+def rebalance_target_validation(form: RebalanceForm):
+    if form.max_power_percentage is None and form.max_variance is None:
         raise HTTPException(
+            status_code=400,
+            detail="Target needs max_power_percentage, max_variance or both."
+        )
+
+async def load_rebalance_input(rack_ids: list[int], session: AsyncSession, allow_read_model: bool = False) -> tuple[list[Rack], list[Device], list[int]]:
+    #Returns racks, devices in them and index of rack of every device
+    if allow_read_model and read_model.enabled:
+        return rebalance_input_records(await read_model.current(session), rack_ids)
+
+    select_racks = select(Rack).order_by(Rack.id)
+    if rack_ids:
+        select_racks = select_racks.where(Rack.id.in_(rack_ids))
+    racks_list: list[Rack] = (await session.exec(select_racks)).all()
+    rack_index = {r.id: idx for idx, r in enumerate(racks_list)}
+    select_devices = select(Device).where(Device.rack_id.in_(rack_index.keys())).order_by(Device.id)
+    devices_list: list[Device] = (await session.exec(select_devices)).all()
+    return racks_list, devices_list, [rack_index[d.rack_id] for d in devices_list]
+
+def rebalance_input_records(model: ReadModel, rack_ids: list[int]):
+    #Same rows and order as load_rebalance_input reads from database
+    rack_filter = set(rack_ids)
+    racks_list = [model.racks[id] for id in model.rack_ids() if not rack_filter or id in rack_filter]
+    rack_index = {r.id: idx for idx, r in enumerate(racks_list)}
+    device_ids = sorted(id for r in racks_list for id in model.devices_of_rack.get(r.id, ()))
+    devices_list = [model.devices[id] for id in device_ids]
+    return racks_list, devices_list, [rack_index[d.rack_id] for d in devices_list]
+
+def map_rebalance_plan(racks_list: list[Rack], devices_list: list[Device], result: RebalanceResult, applied: bool):
+    moves = [RebalanceMove(device_id=devices_list[m.device_index].id, from_rack_id=racks_list[m.from_rack_index].id,
+                           to_rack_id=racks_list[m.to_rack_index].id) for m in result.moves]
+    return RebalancePlan(
+        moves = moves,
+        target_met = result.target_met,
+        max_power_percentage_before = result.max_percentage_before,
+        max_power_percentage_after = result.max_percentage_after,
+        variance_before = result.variance_before,
+        variance_after = result.variance_after,
+        applied = applied
+    )
+
+@router.post("/jobs", status_code=202, response_model=JobInfo)
+async def submit_job(form: JobForm, session: AsyncSession = Depends(get_session)):
+    """
+    Plan in a worker process instead of the request, for inputs that take too long to plan while client waits.
+    Job id is returned at once, poll GET /suggestion/jobs/{id} until status is done.
+    Result is what /suggestion or a dry run of /suggestion/rebalance returns, etag is ETag of data it was planned from.
+    """
+    version = await get_inventory_version(session)
+    #Input is read here so worker never touches the database, it gets only unit and power numbers
+    if form.kind == JobKind.SUGGESTION:
+        params = form.suggestion
+        racks_list, devices_list = await load_suggestion_input(params.device_ids, params.rack_ids, params.incremental, session, allow_read_model=True)
+        rack_specs, device_specs = snapshot(racks_list, devices_list)
+        if params.mode == SuggestionMode.OPTIMIZE:
+            fn, args = optimize, (rack_specs, device_specs, params.strategy, params.budget_ms, params.incremental)
+        else:
+            fn, args = pack, (rack_specs, device_specs, params.strategy, params.incremental)
+        finish = lambda value: map_suggestion(racks_list, devices_list, value, params.incremental)
+    else:
+        params = form.rebalance
+        rebalance_target_validation(params)
+        if not params.dry_run:
+            raise HTTPException(
                 status_code=400,
-                detail="Not enough power to store all devices"
+                detail="Rebalance jobs only plan moves, apply them with /suggestion/apply."
             )
+        racks_list, devices_list, rack_of_device = await load_rebalance_input(params.rack_ids, session, allow_read_model=True)
+        rack_specs, device_specs = snapshot(racks_list, devices_list)
+        fn, args = rebalance, (rack_specs, device_specs, rack_of_device,
+                               params.max_power_percentage, params.max_variance, params.max_moves, params.budget_ms)
+        finish = lambda result: map_rebalance_plan(racks_list, devices_list, result, applied=False)
 
-    devices_in_racks: list[DevicesInRacks] = []
-
-    capacity_arr: list[int] = [] 
-    power_arr: list[int] = []
-
-    #initalize zeros in helper arrays
-    for i in range(len(racks_list)):
-        capacity_arr.append(0)
-        power_arr.append(0)
-
-    for device in devices_list:
-        new_rack_pcts: list[int] = []
-
-        for idx, rack in enumerate(racks_list):
-            #not enough space or power to store device in rack
-            if(capacity_arr[idx] + device.unit_size > rack.unit_capacity):
-                new_rack_pcts.append(math.inf) #set max value
-                continue;
-            if(power_arr[idx] + device.power_consumption > rack.max_power_consumption):
-                new_rack_pcts.append(math.inf) #set max value
-                continue;
-
-            pct = (power_arr[idx] + device.power_consumption) / rack.max_power_consumption * 100
-            new_rack_pcts.append(pct)
-
-        min_pct = min(new_rack_pcts)
-        #Check device is added to any rack
-        if(min_pct < math.inf):
-            store_index = new_rack_pcts.index(min_pct)
-            #Check if rack is already added if not add new one
-            res = [idx for idx, dr in enumerate(devices_in_racks) if dr.rack.id == racks_list[store_index].id]
-            if(len(res) == 0):
-                devices_in_racks.append(DevicesInRacks(rack=racks_list[store_index], devices=[device]))
-            else:
-                devices_in_racks[res[0]].devices.append(device)
+    try:
+        job = job_queue.submit(form.kind, fn, args, finish)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e)
+        )
+    job.etag = inventory_etag(version)
+    #Saved before response so the job can be polled through any worker process
+    await save_job(job)
+    return map_job_info(job)
+
+@router.get("/jobs", response_model=dict[str, int])
+async def job_stats():
+    #Queue of this worker process
+    return job_queue.stats()
+
+@router.get("/jobs/{job_id}", response_model=JobInfo)
+async def get_job(job_id: str, session: AsyncSession = Depends(get_session)):
+    """Saved job is the source of truth, running job of this process that was cancelled through another one is cancelled here too."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return map_job_info(await saved_job_or_404(job_id, session))
+    if job.finished_at is None:
+        saved = await session.get(PlanningJob, job_id)
+        if saved is not None and saved.status == JobStatus.CANCELLED:
+            job_queue.cancel(job)
+    return map_job_info(job)
+
+@router.delete("/jobs/{job_id}", response_model=JobInfo)
+async def cancel_job(job_id: str, session: AsyncSession = Depends(get_write_session)):
+    """
+    Queued job never starts, result of running job is dropped. Finished job is returned as it is.
+    Job of another worker process is marked cancelled, it still runs there but its result is dropped when it finishes.
+    """
+    job = job_queue.get(job_id)
+    if job is not None:
+        job_queue.cancel(job)
+        return map_job_info(job)
+
+    saved = await saved_job_or_404(job_id, session)
+    if saved.status in (JobStatus.QUEUED, JobStatus.RUNNING):
+        saved.status = JobStatus.CANCELLED
+        saved.finished_at = time.time()
+        session.add(saved)
+        await session.commit()
+    return map_job_info(saved)
+
+async def saved_job_or_404(job_id: str, session: AsyncSession) -> PlanningJob:
+    saved = await session.get(PlanningJob, job_id)
+    if saved is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Job with id '{job_id}' does not exist."
+        )
+    return saved
+
+async def saved_job_cancelled(job: Job) -> bool:
+    #Cancel made through another worker process only changes the saved row
+    async with AsyncSession(engine) as session:
+        status = (await session.exec(select(PlanningJob.status).where(PlanningJob.id == job.id))).first()
+    return status == JobStatus.CANCELLED
+
+async def save_job(job: Job):
+    """
+    Write current state of job for other worker processes. State is read after the write lock is taken,
+    so of two saves of the same job the later one always writes the newer state.
+    Job cancelled by another process is not overwritten.
+    """
+    async with AsyncSession(write_engine) as session:
+        await session.connection()
+        row = {
+            "id": job.id, "kind": job.kind, "status": job.status, "etag": job.etag, "created_at": job.created_at,
+            "started_at": job.started_at, "finished_at": job.finished_at, "result": jsonable_encoder(job.result), "error": job.error,
+        }
+        statement = insert(PlanningJob).values(row).on_conflict_do_update(
+            index_elements=[PlanningJob.id],
+            set_={key: value for key, value in row.items() if key != "id"},
+            where=PlanningJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING])
+        )
+        await session.exec(statement)
+        if job.finished_at is not None:
+            #Finished jobs above keep_finished are dropped, oldest first
+            oldest_kept = (select(PlanningJob.finished_at).where(PlanningJob.finished_at.is_not(None))
+                           .order_by(PlanningJob.finished_at.desc()).offset(settings.job_keep_finished - 1).limit(1).scalar_subquery())
+            await session.exec(delete(PlanningJob).where(PlanningJob.finished_at < oldest_kept))
+        await session.commit()
+
+async def if_match_validation(session: AsyncSession, if_match: str | None) -> tuple[int, int]:
+    """
+    Check If-Match against current versions, session must be in a write transaction so they cannot change
+    until commit. Returns versions that will be current after the write bumps them.
+    """
+    rack_version, device_version = await get_inventory_version(session)
+    etag_validation((rack_version, device_version), if_match)
+    return rack_version + 1, device_version + 1
+
+def etag_validation(version: tuple[int, int], if_match: str | None):
+    if if_match is not None and if_match != "*" and if_match != inventory_etag(version):
+        raise HTTPException(
+            status_code=412,
+            detail="Racks or devices changed since suggestion was made."
+        )
+
+@router.get("/cache", response_model=dict[str, int])
+async def cache_stats():
+    return suggestion_cache.stats()
+
+async def plan_suggestion(
+    device_ids: list[int],
+    rack_ids: list[int],
+    strategy: PackingStrategy,
+    mode: SuggestionMode,
+    budget_ms: int,
+    incremental: bool,
+    session: AsyncSession,
+    allow_read_model: bool = False
+    ):
 
-            power_arr[store_index] += device.power_consumption
-            capacity_arr[store_index] += device.unit_size
+    racks_list, devices_list = await load_suggestion_input(device_ids, rack_ids, incremental, session, allow_read_model)
+    start = time.perf_counter()
+    try:
+        if mode == SuggestionMode.OPTIMIZE:
+            value = await run_planning(partial(optimize, racks_list, devices_list, strategy, budget_ms, occupied=incremental))
         else:
-            raise HTTPException(
+            value = await run_planning(partial(pack, racks_list, devices_list, strategy, occupied=incremental))
+    except PlacementError as e:
+        raise HTTPException(
                 status_code=400,
-                detail="Not enough space or power to store all devices"
+                detail=e.message
             )
+    finally:
+        observe_planning(strategy.value, mode.value, len(devices_list), len(racks_list), time.perf_counter() - start)
+    return map_suggestion(racks_list, devices_list, value, incremental)
 
-    response: list[SuggestionInfo] = []
-    for dir in devices_in_racks:
-        si = SuggestionInfo()
-        si.rack_id = dir.rack.id
-        si.rack_name = dir.rack.name
-        si.max_power_consumption = dir.rack.max_power_consumption
-        si.power_consumption = sum([d.power_consumption for d in dir.devices])
-        si.power_percentage = sum([d.power_consumption for d in dir.devices]) / dir.rack.max_power_consumption * 100
-        si.unit_capacity = dir.rack.unit_capacity
-        si.unit_size_taken = sum([d.unit_size for d in dir.devices])
-        si.size_percentage = sum([d.unit_size for d in dir.devices]) / dir.rack.unit_capacity * 100
-        si.device_ids = [d.id for d in dir.devices]
-        response.append(si)
-
-    return response
-
-class DevicesInRacks:
-    def __init__(self, rack: Rack, devices: list[Device]):
-        self.rack = rack
-        self.devices = devices
-
-    rack: Rack
-    devices: list[Device]
-
-class SuggestionInfo:
-    rack_id: int
-    rack_name: str
-    max_power_consumption: int
-    power_consumption: int
-    power_percentage: float
-    unit_capacity: int
-    unit_size_taken: int
-    size_percentage: float
-    device_ids: list[int]
+async def run_planning(fn):
+    return await asyncio.get_running_loop().run_in_executor(planning_executor, fn)
+
+def inline_budget_validation(mode: SuggestionMode, budget_ms: int):
+    if mode == SuggestionMode.OPTIMIZE and budget_ms > settings.inline_budget_max_ms:
+        raise HTTPException(
+            status_code=400,
+            detail=f"budget_ms above {settings.inline_budget_max_ms} is accepted only by /suggestion/jobs."
+        )
+
+async def load_suggestion_input(
+    device_ids: list[int],
+    rack_ids: list[int],
+    incremental: bool,
+    session: AsyncSession,
+    allow_read_model: bool = False
+    ) -> tuple[list[Rack], list[Device]]:
+    if allow_read_model and read_model.enabled:
+        return suggestion_input_records(await read_model.current(session), device_ids, rack_ids, incremental)
+
+    #get racks and sort by consumption, ties by id so database and read model give the same order
+    select_racks = select(Rack).order_by(Rack.max_power_consumption.desc(), Rack.id)
+    #get devices and sort by consumption
+    select_devices = select(Device).order_by(Device.power_consumption.desc(), Device.id)
+    if incremental:
+        #Usage comes from rack counters loaded with the racks, full racks and placed devices are not read at all
+        select_racks = select_racks.where(RACK_FREE_UNITS > 0, RACK_FREE_POWER > 0)
+        select_devices = select_devices.where(Device.rack_id.is_(None))
+        if rack_ids:
+            select_racks = select_racks.where(Rack.id.in_(rack_ids))
+        if device_ids:
+            select_devices = select_devices.where(Device.id.in_(device_ids))
+    else:
+        select_racks = select_racks.where(Rack.id.in_(rack_ids))
+        select_devices = select_devices.where(Device.id.in_(device_ids))
+    racks_list: list[Rack] = (await session.exec(select_racks)).all()
+    devices_list: list[Device] = (await session.exec(select_devices)).all()
+    return racks_list, devices_list
+
+def suggestion_input_records(model: ReadModel, device_ids: list[int], rack_ids: list[int], incremental: bool):
+    #Same rows and order as load_suggestion_input reads from database
+    if incremental:
+        rack_filter, device_filter = set(rack_ids), set(device_ids)
+        racks_list = [r for r in model.racks.values() if r.unit_capacity > r.used_units and r.max_power_consumption > r.used_power
+                      and (not rack_filter or r.id in rack_filter)]
+        devices_list = [d for d in model.devices.values() if d.rack_id is None and (not device_filter or d.id in device_filter)]
+    else:
+        racks_list = [model.racks[id] for id in set(rack_ids) if id in model.racks]
+        devices_list = [model.devices[id] for id in set(device_ids) if id in model.devices]
+    racks_list.sort(key=lambda r: (-r.max_power_consumption, r.id))
+    devices_list.sort(key=lambda d: (-d.power_consumption, d.id))
+    return racks_list, devices_list
+
+def map_suggestion(racks_list: list[Rack], devices_list: list[Device], value: SearchResult | list, incremental: bool):
+    #value is what optimize or pack returned
+    placements = value.placements if isinstance(value, SearchResult) else value
+    racks = [map_suggestion_info(racks_list[p.rack_index], [devices_list[i] for i in p.device_indexes], incremental) for p in placements]
+    if isinstance(value, SearchResult):
+        return OptimizedSuggestion(racks=racks, objective=value.objective, optimal=value.optimal)
+    return racks
+
+def map_suggestion_info(rack: Rack, devices: list[Device], occupied: bool = False):
+    #With occupied numbers include devices that are already in the rack
+    power_consumption = sum([d.power_consumption for d in devices]) + (rack.used_power if occupied else 0)
+    unit_size_taken = sum([d.unit_size for d in devices]) + (rack.used_units if occupied else 0)
+    return SuggestionInfo(
+        rack_id = rack.id,
+        rack_name = rack.name,
+        max_power_consumption = rack.max_power_consumption,
+        power_consumption = power_consumption,
+        power_percentage = power_consumption / rack.max_power_consumption * 100,
+        unit_capacity = rack.unit_capacity,
+        unit_size_taken = unit_size_taken,
+        size_percentage = unit_size_taken / rack.unit_capacity * 100,
+        device_ids = [d.id for d in devices]
+    )
+
+def map_job_info(job: Job | PlanningJob):
+    #Result of saved job is JSON, it is validated back into plan models
+    return JobInfo(
+        id = job.id,
+        kind = job.kind,
+        status = job.status,
+        etag = job.etag,
+        created_at = job.created_at,
+        started_at = job.started_at,
+        finished_at = job.finished_at,
+        result = job.result,
+        error = job.error
+    )
@@ -0,0 +1,90 @@
+import csv
+import io
+import json
+from enum import Enum
+from typing import BinaryIO, Iterator
+
+"""
+File formats of /export and /import.
+Every record is a rack or a device, racks come first so devices can reference them by rack_id.
+NDJSON has one object per line with a type key, CSV has one header with columns of both and type column.
+"""
+
+class TransferFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+MEDIA_TYPES = {TransferFormat.NDJSON: "application/x-ndjson", TransferFormat.CSV: "text/csv"}
+
+RACK = "rack"
+DEVICE = "device"
+FIELDS = {
+    RACK: ["id", "name", "description", "serial_number", "unit_capacity", "max_power_consumption"],
+    DEVICE: ["id", "name", "description", "serial_number", "unit_size", "power_consumption", "rack_id"],
+}
+CSV_HEADER = ["type", "id", "name", "description", "serial_number", "unit_capacity", "max_power_consumption",
+              "unit_size", "power_consumption", "rack_id"]
+#Empty CSV cell of these columns means no value, other empty cells are empty strings
+OPTIONAL_FIELDS = {"id", "rack_id"}
+
+def format_of_media_type(media_type: str | None) -> TransferFormat:
+    if media_type is not None and media_type.split(";")[0].strip() in ("text/csv", "application/csv"):
+        return TransferFormat.CSV
+    return TransferFormat.NDJSON
+
+def csv_header() -> str:
+    text = io.StringIO()
+    csv.writer(text).writerow(CSV_HEADER)
+    return text.getvalue()
+
+def format_rows(kind: str, rows, transfer_format: TransferFormat) -> str:
+    #rows are tuples of FIELDS[kind] columns
+    fields = FIELDS[kind]
+    if transfer_format == TransferFormat.NDJSON:
+        return "".join(json.dumps({"type": kind, **dict(zip(fields, row))}) + "\n" for row in rows)
+
+    text = io.StringIO()
+    writer = csv.writer(text)
+    for row in rows:
+        values = dict(zip(fields, row))
+        writer.writerow([kind] + ["" if values.get(c) is None else values[c] for c in CSV_HEADER[1:]])
+    return text.getvalue()
+
+def read_records(upload: BinaryIO, transfer_format: TransferFormat) -> Iterator[tuple[int, str | None, dict | None, str | None]]:
+    """
+    Read records one at a time, yields (line, type, data, error) where line is last line of the record.
+    data holds only fields of its type, error is set instead if record cannot be read.
+    """
+    text = io.TextIOWrapper(upload, encoding="utf-8-sig", errors="replace", newline="")
+    if transfer_format == TransferFormat.NDJSON:
+        yield from read_ndjson(text)
+    else:
+        yield from read_csv(text)
+
+def read_ndjson(text: io.TextIOBase):
+    for line, content in enumerate(text, start=1):
+        if not content.strip():
+            continue
+        try:
+            data = json.loads(content)
+        except ValueError:
+            yield line, None, None, "Line is not valid JSON."
+            continue
+        if not isinstance(data, dict):
+            yield line, None, None, "Line must be a JSON object."
+            continue
+        yield record(line, data.get("type"), data)
+
+def read_csv(text: io.TextIOBase):
+    reader = csv.DictReader(text)
+    if reader.fieldnames is None or "type" not in reader.fieldnames:
+        yield 1, None, None, "CSV header must contain type column."
+        return
+    for row in reader:
+        data = {k: (None if v == "" and k in OPTIONAL_FIELDS else v) for k, v in row.items() if k is not None}
+        yield record(reader.line_num, data.get("type"), data)
+
+def record(line: int, kind, data: dict):
+    if kind not in FIELDS:
+        return line, None, None, f"Unknown type '{kind}', expected '{RACK}' or '{DEVICE}'."
+    return line, kind, {k: data.get(k) for k in FIELDS[kind] if k in data}, None
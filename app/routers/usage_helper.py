@@ -0,0 +1,130 @@
+from fastapi import HTTPException
+from sqlmodel import bindparam, or_, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.models import Device, Rack
+from app.routers.validation_helper import add_error, rack_exist_validation
+
+#Times a device is checked again against a rack that changed between validation and write
+RACK_USAGE_RETRIES = 3
+
+async def add_rack_usage(device: Device, session: AsyncSession):
+    """
+    Count device in used_units and used_power of the rack it is placed in.
+    Limits are checked by the UPDATE itself, so two writers that both passed validation cannot overfill the rack.
+    If the rack changed since it was validated it is read and checked again, raises 400 if device no longer fits.
+    """
+    if device.rack_id is None:
+        return
+    for _ in range(RACK_USAGE_RETRIES):
+        if await change_rack_usage(device.rack_id, device.unit_size, device.power_consumption, session):
+            return
+        rack = await session.get(Rack, device.rack_id, populate_existing=True)
+        rack_exist_validation(device.rack_id, rack)
+        rack_power_validation(rack, rack.used_power, device.power_consumption)
+        rack_units_validation(rack, rack.used_units, device.unit_size)
+    raise HTTPException(
+        status_code=409,
+        detail="Rack usage kept changing while device was written, try again."
+    )
+
+async def remove_rack_usage(device: Device, session: AsyncSession):
+    #Must be called before rack_id, unit_size or power_consumption of device are changed
+    if device.rack_id is None:
+        return
+    await change_rack_usage(device.rack_id, -device.unit_size, -device.power_consumption, session)
+
+async def change_rack_usage(rack_id: int, units: int, power: int, session: AsyncSession) -> bool:
+    #Compare and swap on the counters, returns False if rack is missing or an increase would exceed its limits
+    statement = (update(Rack)
+                 .where(Rack.id == rack_id, *usage_limit_conditions(units, power))
+                 .values(used_units=Rack.used_units + units, used_power=Rack.used_power + power)
+                 .execution_options(synchronize_session=False))
+    return (await session.exec(statement)).rowcount == 1
+
+def usage_limit_conditions(units, power):
+    #Decrease is always allowed, it must never fail on a rack that is already above its limits
+    return (or_(units <= 0, Rack.used_units + units <= Rack.unit_capacity),
+            or_(power <= 0, Rack.used_power + power <= Rack.max_power_consumption))
+
+def rack_power_validation(rack: Rack, used_power: int, power: int):
+    if used_power + power > rack.max_power_consumption:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Power consumption exceeds maximum allowed value in the current rack."
+        )
+
+def rack_units_validation(rack: Rack, used_units: int, units: int):
+    if used_units + units > rack.unit_capacity:
+        raise HTTPException(
+            status_code=400,
+            detail=f"There is not enough space in rack to store this device."
+        )
+
+async def load_racks(rack_ids: set[int | None], session: AsyncSession) -> dict[int, Rack]:
+    ids = [id for id in rack_ids if id is not None]
+    return {r.id: r for r in (await session.exec(select(Rack).where(Rack.id.in_(ids)))).all()}
+
+async def bulk_rack_capacity_validation(
+    devices: list[Device],
+    current: dict[int, Device],
+    session: AsyncSession,
+    errors: dict[int, list[str]]
+    ) -> dict[int, list[int]]:
+    """
+    Sum usage changes of whole batch per rack and check capacity once per rack.
+    current holds devices as they are in database for updates.
+    Returns [units, power] change of every rack, it is written by apply_rack_usage.
+    """
+    rack_ids = {d.rack_id for d in devices} | {current[d.id].rack_id for d in devices if d.id in current}
+    racks = await load_racks(rack_ids, session)
+    changes: dict[int, list[int]] = {}
+
+    def change(rack_id: int, units: int, power: int):
+        rack_change = changes.setdefault(rack_id, [0, 0])
+        rack_change[0] += units
+        rack_change[1] += power
+
+    for index, device in enumerate(devices):
+        old = current.get(device.id)
+        if old is not None and old.rack_id is not None:
+            change(old.rack_id, -old.unit_size, -old.power_consumption)
+        if device.rack_id is None:
+            continue
+        if device.rack_id not in racks:
+            add_error(errors, index, f"Rack with id {device.rack_id} does not exist")
+            continue
+        change(device.rack_id, device.unit_size, device.power_consumption)
+
+    for index, device in enumerate(devices):
+        rack = racks.get(device.rack_id)
+        if rack is None:
+            continue
+        units, power = changes[rack.id]
+        if rack.used_power + power > rack.max_power_consumption:
+            add_error(errors, index, f"Power consumption exceeds maximum allowed value in rack '{rack.name}'.")
+        if rack.used_units + units > rack.unit_capacity:
+            add_error(errors, index, f"There is not enough space in rack '{rack.name}' to store this device.")
+    return changes
+
+async def apply_rack_usage(changes: dict[int, list[int]], session: AsyncSession):
+    """
+    Write usage changes of a batch as one executemany UPDATE, every row is a compare and swap like in add_rack_usage.
+    If any rack no longer has room the batch fails with 409 and nothing is written.
+    """
+    rows = [{"rack": rack_id, "units": units, "power": power} for rack_id, (units, power) in changes.items() if units or power]
+    if not rows:
+        return
+    table = Rack.__table__
+    units, power = bindparam("units"), bindparam("power")
+    statement = (update(table)
+                 .where(table.c.id == bindparam("rack"),
+                        or_(units <= 0, table.c.used_units + units <= table.c.unit_capacity),
+                        or_(power <= 0, table.c.used_power + power <= table.c.max_power_consumption))
+                 .values(used_units=table.c.used_units + units, used_power=table.c.used_power + power))
+    result = await session.exec(statement, params=rows)
+    if result.rowcount != len(rows):
+        await session.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail="Racks changed while devices were written, try again."
+        )
@@ -1,5 +1,9 @@
 from fastapi import HTTPException
-from app.models import Device, Rack
+from pydantic import ValidationError
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.models import Device, Rack, SerialNumber
+from app.settings import settings
 
 
 def rack_exist_validation(rack_id: int, rack: Rack):
@@ -14,4 +18,54 @@ def device_exist_validation(device_id: int, device: Device):
         raise HTTPException(
             status_code=404, 
             detail=f"Device with id {device_id} does not exist"
-        )
\ No newline at end of file
+        )
+
+#Helpers for bulk endpoints, errors are collected per item index and returned together
+
+def add_error(errors: dict[int, list[str]], index: int, message: str):
+    errors.setdefault(index, []).append(message)
+
+def bulk_size_validation(items: list):
+    #Also keeps IN lists of set based queries below SQLite variable limit
+    if len(items) > settings.bulk_max_items:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch can contain at most {settings.bulk_max_items} items."
+        )
+
+def bulk_errors_validation(errors: dict[int, list[str]]):
+    if errors:
+        raise HTTPException(
+            status_code=400,
+            detail={'errors': [{'index': index, 'messages': messages} for index, messages in sorted(errors.items())]}
+        )
+
+def bulk_model_validation(model: type[SQLModel], items: list[SQLModel], errors: dict[int, list[str]]):
+    for index, item in enumerate(items):
+        try:
+            model.model_validate(item)
+        except ValidationError as e:
+            for err in e.errors():
+                add_error(errors, index, err["msg"])
+
+async def bulk_serial_number_validation(items: list[Rack] | list[Device], session: AsyncSession, errors: dict[int, list[str]]):
+    #Serial number has to be unique across racks and devices, items may keep their own serial number
+    serials = [item.serial_number for item in items]
+    select_owners = select(SerialNumber).where(SerialNumber.serial_number.in_(serials))
+    taken = {s.serial_number: (s.owner_table, s.owner_id) for s in (await session.exec(select_owners)).all()}
+
+    seen: set[str] = set()
+    for index, item in enumerate(items):
+        owner = taken.get(item.serial_number)
+        if (owner is not None and owner != (item.__tablename__, item.id)) or item.serial_number in seen:
+            add_error(errors, index, f"Serial number '{item.serial_number}' already exists.")
+        seen.add(item.serial_number)
+
+async def serial_number_validation(item: Rack | Device, session: AsyncSession):
+    #Single primary key probe of the registry, same item may keep its serial number on update
+    owner = await session.get(SerialNumber, item.serial_number)
+    if owner is not None and (owner.owner_table, owner.owner_id) != (item.__tablename__, item.id):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Serial number '{item.serial_number}' already exists."
+        )
@@ -0,0 +1,101 @@
+import mmap
+import os
+import struct
+from fastapi import Request, Response
+from sqlalchemy import make_url
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.models import InventoryVersion
+from app.settings import settings
+
+RACK_TABLE = "rack"
+DEVICE_TABLE = "device"
+
+class VersionSignal:
+    """
+    Inventory version shared by all processes using the database through a memory mapped file next to it.
+    It is written while the write lock is held, so writes are serialized by the database and it never goes back.
+    Reading it costs a memory read, caches compare it with the version they hold and query the database only
+    when it differs. It can be ahead of the database until the writer commits, or if the writer rolled back.
+    """
+    SIZE = 16
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self.map: mmap.mmap | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def open(self) -> mmap.mmap | None:
+        if self.map is None and self.path is not None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            try:
+                if os.fstat(fd).st_size < self.SIZE:
+                    os.ftruncate(fd, self.SIZE)
+                self.map = mmap.mmap(fd, self.SIZE)
+            finally:
+                os.close(fd)
+        return self.map
+
+    def read(self) -> tuple[int, int] | None:
+        signal = self.open()
+        return struct.unpack_from("<qq", signal) if signal is not None else None
+
+    def publish(self, version: tuple[int, int]):
+        signal = self.open()
+        if signal is not None:
+            struct.pack_into("<qq", signal, 0, *version)
+
+def version_signal_path(database_url: str) -> str | None:
+    #Only processes sharing a database file can share the signal
+    url = make_url(database_url)
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    return f"{url.database}-version"
+
+version_signal = VersionSignal(version_signal_path(settings.database_url))
+
+
+async def bump_inventory_version(session: AsyncSession, *tables: str):
+    #Must run before commit so version changes together with data
+    statement = insert(InventoryVersion).values([{"table_name": t, "version": 1} for t in tables])
+    statement = statement.on_conflict_do_update(
+        index_elements=[InventoryVersion.table_name],
+        set_={"version": InventoryVersion.version + 1}
+    )
+    await session.exec(statement)
+    if version_signal.enabled:
+        version_signal.publish(await get_inventory_version(session))
+
+async def get_inventory_version(session: AsyncSession) -> tuple[int, int]:
+    versions = {v.table_name: v.version for v in (await session.exec(select(InventoryVersion))).all()}
+    return versions.get(RACK_TABLE, 0), versions.get(DEVICE_TABLE, 0)
+
+def inventory_etag(version: tuple[int, int]) -> str:
+    rack_version, device_version = version
+    return f'"{rack_version}-{device_version}"'
+
+def rack_etag(version: tuple[int, int]) -> str:
+    #Rack rows include usage counters, device writes that change them bump rack version too
+    return f'"rack-{version[0]}"'
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    #If-None-Match uses weak comparison, W/ prefix is ignored
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def not_modified(request: Request, response: Response, etag: str) -> Response | None:
+    """
+    Set ETag of a GET response, returns 304 response if client already has this version.
+    Version is read from inventory_version only, so 304 of a list costs no query of racks or devices and no serialization.
+    Single resources must be found first, If-None-Match: * matches any version of a resource that exists.
+    """
+    response.headers["ETag"] = etag
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
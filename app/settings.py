@@ -0,0 +1,78 @@
+import os
+
+"""
+Application settings read from environment variables.
+Defaults are meant for production, set DATABASE_ECHO=true to log every SQL statement while developing.
+"""
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return int(value)
+
+class Settings:
+    def __init__(self):
+        self.database_url: str = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///database.db")
+        self.database_echo: bool = env_bool("DATABASE_ECHO", False)
+        self.database_pool_size: int = env_int("DATABASE_POOL_SIZE", 5)
+        self.database_max_overflow: int = env_int("DATABASE_MAX_OVERFLOW", 10)
+
+        #Applied on every new SQLite connection, WAL lets readers run concurrently with a writer
+        self.sqlite_journal_mode: str = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+        self.sqlite_synchronous: str = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+        self.sqlite_busy_timeout_ms: int = env_int("SQLITE_BUSY_TIMEOUT_MS", 5000)
+        #Times BEGIN of a write transaction is retried after busy timeout, then request fails with 503
+        self.sqlite_busy_retries: int = env_int("SQLITE_BUSY_RETRIES", 3)
+        #Negative value is size in KiB, positive is number of pages
+        self.sqlite_cache_size: int = env_int("SQLITE_CACHE_SIZE", -64000)
+        self.sqlite_mmap_size: int = env_int("SQLITE_MMAP_SIZE", 268435456)
+
+        #Results of /suggestion, size 0 disables cache
+        self.suggestion_cache_size: int = env_int("SUGGESTION_CACHE_SIZE", 256)
+        self.suggestion_cache_ttl_seconds: int = env_int("SUGGESTION_CACHE_TTL_SECONDS", 300)
+
+        #Maximum number of items in one request to bulk endpoints
+        self.bulk_max_items: int = env_int("BULK_MAX_ITEMS", 10000)
+
+        #Largest page of list endpoints and number of rows fetched from cursor at once while streaming
+        self.page_max_limit: int = env_int("PAGE_MAX_LIMIT", 1000)
+        self.stream_batch_size: int = env_int("STREAM_BATCH_SIZE", 500)
+        #Records of /import validated and written in one transaction
+        self.import_batch_size: int = env_int("IMPORT_BATCH_SIZE", 1000)
+
+        #Background planning jobs, each running job takes one worker process
+        self.job_workers: int = env_int("JOB_WORKERS", 2)
+        self.job_queue_size: int = env_int("JOB_QUEUE_SIZE", 16)
+        self.job_timeout_seconds: int = env_int("JOB_TIMEOUT_SECONDS", 120)
+        self.job_keep_finished: int = env_int("JOB_KEEP_FINISHED", 100)
+        #Threads that run planning of /suggestion requests off the event loop
+        self.planning_threads: int = env_int("PLANNING_THREADS", 2)
+        #Longest budget_ms planned within a request, longer searches have to go through /suggestion/jobs
+        self.inline_budget_max_ms: int = env_int("INLINE_BUDGET_MAX_MS", 5000)
+
+        #Serve reads from an in-process copy of racks and devices, writes of other processes show up within the interval
+        self.read_model: bool = env_bool("READ_MODEL", False)
+        self.read_model_check_interval_ms: int = env_int("READ_MODEL_CHECK_INTERVAL_MS", 1000)
+
+        #Request latency, SQL counts and planning time served at /metrics in Prometheus format
+        self.metrics: bool = env_bool("METRICS", True)
+
+        #Requests sent with X-Profile: true are profiled, reports are served under /debug
+        self.profiling: bool = env_bool("PROFILING", False)
+        #Directory for .prof files of profiled requests, empty keeps reports only in memory
+        self.profile_dir: str = os.getenv("PROFILE_DIR", "")
+        #Statements slower than this are logged, 0 disables the log
+        self.slow_query_ms: int = env_int("SLOW_QUERY_MS", 0)
+        #Same SELECT run this many times in one request is logged as N+1, 0 disables the check
+        self.n_plus_one_threshold: int = env_int("N_PLUS_ONE_THRESHOLD", 0)
+        #Profiles, slow queries and N+1 reports kept for /debug
+        self.profiling_keep: int = env_int("PROFILING_KEEP", 50)
+
+settings = Settings()
@@ -1,6 +1,43 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+import pytest
+import httpx
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session, create_engine, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+#Tests run against their own copy of dummy data, database.db is never touched
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+os.environ["PROFILING"] = "true"
+
+from .benchmarks.generator import DatacenterShape, generate
+from .benchmarks.results import compare_results
+from . import profiling
+from .database import begin_sqlite_transaction, create_db, create_dummy_data, engine, get_session, get_write_session, set_sqlite_pragmas
 from .main import app
+from .cache import ResultCache
+from .jobs import Job, JobQueue, JobStatus, QueueFullError
+from .models import Device, InventoryVersion, PlanningJob, Rack, SerialNumber
+from .planner import PackingStrategy, PlacementError, optimize, pack
+from .routers.inventory import import_records
+from .routers.read_model_helper import read_model
+from .routers import suggestion
+from .routers.suggestion import job_queue
+from .routers.transfer_helper import TransferFormat
+from .routers.usage_helper import add_rack_usage, apply_rack_usage
+from .routers.version_helper import version_signal
+from .settings import Settings, settings
 
+asyncio.run(create_db())
+asyncio.run(create_dummy_data())
 client = TestClient(app)
 
 def test_index():
@@ -73,3 +110,1039 @@ def test_suggestion_3():
     assert response.json()[2]["unit_size_taken"] == 1
     assert response.json()[2]["size_percentage"] == 25.0
     assert response.json()[2]["device_ids"] == [16]
+
+@contextmanager
+def isolated_database():
+    """
+    Serve requests from a fresh database file instead of database.db.
+    Yields (engine, app_engine): sync engine for test setup and the async engine used by the app.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "test.db")
+        engine = create_engine(f"sqlite:///{path}")
+        app_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        event.listen(app_engine.sync_engine, "connect", set_sqlite_pragmas)
+        event.listen(app_engine.sync_engine, "begin", begin_sqlite_transaction)
+        SQLModel.metadata.create_all(engine)
+
+        async def get_test_session():
+            async with AsyncSession(app_engine, expire_on_commit=False) as session:
+                yield session
+
+        async def get_test_write_session():
+            async with AsyncSession(app_engine.execution_options(sqlite_begin="IMMEDIATE"), expire_on_commit=False) as session:
+                yield session
+
+        #Overrides of an outer isolated database are restored on exit
+        previous = dict(app.dependency_overrides)
+        app.dependency_overrides[get_session] = get_test_session
+        app.dependency_overrides[get_write_session] = get_test_write_session
+        try:
+            yield engine, app_engine
+        finally:
+            app.dependency_overrides.clear()
+            app.dependency_overrides.update(previous)
+            engine.dispose()
+            asyncio.run(app_engine.dispose())
+
+@pytest.fixture
+def app_engine():
+    """Fresh database served by the app during the test, yields the async engine the app uses."""
+    with isolated_database() as (engine, app_engine):
+        yield app_engine
+
+@pytest.fixture
+def database(app_engine):
+    """Sync engine of the same database for setup and checks of a test."""
+    engine = create_engine(app_engine.url.set(drivername="sqlite"))
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def statements(app_engine) -> list[str]:
+    """SQL statements the app runs during the test."""
+    return capture_statements(app_engine)
+
+@pytest.fixture
+def inventory(database):
+    """Creates racks and devices through bulk endpoints, ids follow order of the lists."""
+    def create(racks: list[dict], devices: list[dict] = []):
+        assert client.post("/racks/bulk", json=racks).status_code == 200
+        if devices:
+            assert client.post("/devices/bulk", json=devices).status_code == 200
+    return create
+
+@pytest.fixture
+def usage(database):
+    """Used units and power of a rack as stored in database."""
+    def usage(rack_id: int) -> tuple[int, int]:
+        with Session(database) as session:
+            rack = session.get(Rack, rack_id)
+            return rack.used_units, rack.used_power
+    return usage
+
+def rack_data(i: int, **fields) -> dict:
+    #Rack as sent to the API, fields override defaults
+    return {"name": f"R{i}", "description": "", "serial_number": f"RACK-{i}", "unit_capacity": 10, "max_power_consumption": 1000, **fields}
+
+def device_data(i: int, **fields) -> dict:
+    return {"name": f"D{i}", "description": "", "serial_number": f"DEV-{i}", "unit_size": 1, "power_consumption": 100, **fields}
+
+def capture_statements(app_engine) -> list[str]:
+    statements: list[str] = []
+    event.listen(app_engine.sync_engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+    return statements
+
+def count_queries(url: str, rack_count: int) -> int:
+    """Serve url from a database with rack_count racks (one device each) and count SQL statements."""
+    with isolated_database() as (engine, app_engine):
+        with Session(engine) as session:
+            for i in range(1, rack_count + 1):
+                rack = Rack(**rack_data(i))
+                session.add(rack)
+                session.add(Device(**device_data(i), rack=rack))
+            session.commit()
+
+        statements = capture_statements(app_engine)
+        response = client.get(url)
+    assert response.status_code == 200
+    #BEGIN of the read transaction and version read for ETag are not queries of rows
+    return len([s for s in statements if not s.startswith("BEGIN") and "FROM inventory_version" not in s])
+
+#Listing must not lazy load rack.devices or device.rack per row
+def test_list_query_count_is_constant():
+    for url in ["/racks/", "/devices/", "/racks/1", "/devices/1"]:
+        assert count_queries(url, 1) == 1
+        assert count_queries(url, 50) == 1
+
+#Every device write path has to keep used_units and used_power of racks in sync
+def test_rack_usage_counters(usage):
+    for i in (1, 2):
+        assert client.post("/racks/", json=rack_data(i, id=i, used_units=5)).status_code == 200
+    assert usage(1) == (0, 0)
+
+    device = device_data(1, unit_size=2, power_consumption=300, rack_id=1)
+    assert client.post("/devices/", json=device).status_code == 200
+    assert usage(1) == (2, 300)
+
+    assert client.put("/devices/1", json={**device, "unit_size": 3, "power_consumption": 900}).status_code == 200
+    assert usage(1) == (3, 900)
+    response = client.post("/devices/", json={**device, "serial_number": "DEV-2", "power_consumption": 200})
+    assert response.status_code == 400
+    assert usage(1) == (3, 900)
+
+    assert client.post("/devices/add_to_rack", json={"rack_id": 2, "device_id": 1}).status_code == 200
+    assert usage(1) == (0, 0)
+    assert usage(2) == (3, 900)
+
+    assert client.put("/racks/2", json=rack_data(2, unit_capacity=2)).status_code == 400
+
+    assert client.post("/devices/remove_from_rack", json={"rack_id": 2, "device_id": 1}).status_code == 200
+    assert usage(2) == (0, 0)
+
+    assert client.put("/devices/1", json=device).status_code == 200
+    assert usage(1) == (2, 300)
+    assert client.delete("/devices/1").status_code == 200
+    assert usage(1) == (0, 0)
+
+def test_suggestion_strategies():
+    device_ids = [9, 10, 11, 12, 13, 14, 15, 16, 17, 18]
+    for strategy in ["least_power_percentage", "best_fit_decreasing", "first_fit_decreasing", "balanced"]:
+        response = client.get("/suggestion", params={"device_ids": device_ids, "rack_ids": [6, 7, 8], "strategy": strategy})
+        assert response.status_code == 200
+        placed = [i for rack in response.json() for i in rack["device_ids"]]
+        assert sorted(placed) == device_ids
+        for rack in response.json():
+            assert rack["power_consumption"] <= rack["max_power_consumption"]
+            assert rack["unit_size_taken"] <= rack["unit_capacity"]
+
+    response = client.get("/suggestion", params={"device_ids": device_ids, "rack_ids": [6, 7, 8], "strategy": "random"})
+    assert response.status_code == 422
+
+#Same input as test_suggestion_3, optimizer has to find a better balanced plan than greedy and prove it is optimal
+def test_suggestion_optimize():
+    params = {"device_ids": [9, 10, 11, 12, 13, 14, 15, 16, 17, 18], "rack_ids": [6, 7, 8]}
+    greedy = client.get("/suggestion", params=params).json()
+    greedy_objective = sum(r["power_consumption"] ** 2 / r["max_power_consumption"] for r in greedy) / 16000
+
+    response = client.get("/suggestion", params={**params, "mode": "optimize", "budget_ms": 2000})
+    assert response.status_code == 200
+    assert response.json()["optimal"] is True
+    assert response.json()["objective"] < greedy_objective
+    placed = [i for rack in response.json()["racks"] for i in rack["device_ids"]]
+    assert sorted(placed) == params["device_ids"]
+    assert max(r["power_percentage"] for r in response.json()["racks"]) < max(r["power_percentage"] for r in greedy)
+
+    #Long searches block a planning thread, they have to go through jobs
+    response = client.get("/suggestion", params={**params, "mode": "optimize", "budget_ms": settings.inline_budget_max_ms + 1})
+    assert response.status_code == 400
+
+#Every greedy strategy puts the first device into first rack and then cannot fit the 2 unit device
+def test_optimize_packs_when_greedy_fails():
+    racks = [Rack(unit_capacity=2, max_power_consumption=1000), Rack(unit_capacity=1, max_power_consumption=1000)]
+    devices = [Device(unit_size=1, power_consumption=600), Device(unit_size=2, power_consumption=500)]
+    for strategy in PackingStrategy:
+        with pytest.raises(PlacementError):
+            pack(racks, devices, strategy)
+
+    result = optimize(racks, devices, PackingStrategy.LEAST_POWER_PERCENTAGE, 1000)
+    assert result.optimal
+    assert [(p.rack_index, p.device_indexes) for p in result.placements] == [(1, [0]), (0, [1])]
+
+#Every rack has its own max power, search must stay far from trying every rack for every device
+def test_least_power_percentage_distinct_max_power():
+    rng = random.Random(5)
+    racks = [Rack(unit_capacity=42, max_power_consumption=rng.randint(5000, 20000)) for _ in range(40)]
+    devices = sorted([Device(unit_size=rng.choice([1, 2, 4]), power_consumption=rng.randint(20, 900)) for _ in range(400)],
+                     key=lambda d: -d.power_consumption)
+    units, power = [0] * len(racks), [0] * len(racks)
+    for device_index, device in enumerate(devices):
+        #Reference rule: lowest percentage after placement, lowest rack index on ties
+        fits = [i for i, r in enumerate(racks) if units[i] + device.unit_size <= r.unit_capacity
+                and power[i] + device.power_consumption <= r.max_power_consumption]
+        best = min(fits, key=lambda i: ((power[i] + device.power_consumption) / racks[i].max_power_consumption, i))
+        units[best] += device.unit_size
+        power[best] += device.power_consumption
+        placements = pack(racks, devices[:device_index + 1], PackingStrategy.LEAST_POWER_PERCENTAGE)
+        assert next(p.rack_index for p in placements if device_index in p.device_indexes) == best
+
+    racks = [Rack(unit_capacity=48, max_power_consumption=rng.randint(5000, 20000)) for _ in range(4000)]
+    devices = sorted([Device(unit_size=rng.choice([1, 1, 2, 4]), power_consumption=rng.randint(20, 900)) for _ in range(20000)],
+                     key=lambda d: -d.power_consumption)
+    timings = {}
+    for strategy in (PackingStrategy.FIRST_FIT_DECREASING, PackingStrategy.LEAST_POWER_PERCENTAGE):
+        start = time.perf_counter()
+        pack(racks, devices, strategy)
+        timings[strategy] = time.perf_counter() - start
+    #Loop over every rack group was hundreds of times slower than first fit here
+    assert timings[PackingStrategy.LEAST_POWER_PERCENTAGE] < 40 * timings[PackingStrategy.FIRST_FIT_DECREASING]
+
+def test_best_fit_and_balanced_skip_racks_without_room():
+    rng = random.Random(6)
+    racks = [Rack(unit_capacity=rng.choice([4, 8]), max_power_consumption=rng.choice([1000, 2000])) for _ in range(30)]
+    devices = sorted([Device(unit_size=rng.choice([1, 2, 3]), power_consumption=rng.randint(50, 600)) for _ in range(60)],
+                     key=lambda d: -d.power_consumption)
+    rules = {
+        #Reference rules: least free power, lowest max(units %, power %), lowest rack index on ties
+        PackingStrategy.BEST_FIT_DECREASING: lambda i, units, power: (racks[i].max_power_consumption - power[i], i),
+        PackingStrategy.BALANCED: lambda i, units, power: (max(units[i] / racks[i].unit_capacity, power[i] / racks[i].max_power_consumption), i),
+    }
+    for strategy, rule in rules.items():
+        units, power = [0] * len(racks), [0] * len(racks)
+        expected = []
+        for device in devices:
+            fits = [i for i, r in enumerate(racks) if units[i] + device.unit_size <= r.unit_capacity
+                    and power[i] + device.power_consumption <= r.max_power_consumption]
+            best = min(fits, key=lambda i: rule(i, units, power))
+            units[best] += device.unit_size
+            power[best] += device.power_consumption
+            expected.append(best)
+        placements = pack(racks, devices, strategy)
+        assert [next(p.rack_index for p in placements if i in p.device_indexes) for i in range(len(devices))] == expected
+
+    #Racks with power to spare but a single unit sort first, they must not be scanned for every device
+    racks = [Rack(unit_capacity=1, max_power_consumption=3000 + i % 100) for i in range(1000)]
+    racks += [Rack(unit_capacity=48, max_power_consumption=20000) for _ in range(1000)]
+    devices = [Device(unit_size=2, power_consumption=100) for _ in range(4000)]
+    timings = {}
+    for strategy in (PackingStrategy.FIRST_FIT_DECREASING, PackingStrategy.BEST_FIT_DECREASING, PackingStrategy.BALANCED):
+        start = time.perf_counter()
+        pack(racks, devices, strategy)
+        timings[strategy] = time.perf_counter() - start
+    assert timings[PackingStrategy.BEST_FIT_DECREASING] < 40 * timings[PackingStrategy.FIRST_FIT_DECREASING]
+    assert timings[PackingStrategy.BALANCED] < 40 * timings[PackingStrategy.FIRST_FIT_DECREASING]
+
+def test_suggestion_cache():
+    params = {"device_ids": [7, 6, 5, 4], "rack_ids": [5, 4, 3]}
+    client.get("/suggestion", params=params)
+    hits = client.get("/suggestion/cache").json()["hits"]
+    misses = client.get("/suggestion/cache").json()["misses"]
+
+    #same sets in different order are served from cache
+    response = client.get("/suggestion", params={"device_ids": [4, 5, 6, 7], "rack_ids": [3, 4, 5]})
+    assert response.json()[0]["device_ids"] == [4, 7]
+    assert client.get("/suggestion/cache").json()["hits"] == hits + 1
+
+    #any write changes inventory version so result is computed again
+    rack = client.get("/racks/3").json()
+    assert client.put("/racks/3", json=rack).status_code == 200
+    client.get("/suggestion", params=params)
+    assert client.get("/suggestion/cache").json()["misses"] == misses + 1
+
+def test_result_cache_single_flight():
+    cache = ResultCache(max_size=2, ttl_seconds=60)
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    async def run():
+        return await asyncio.gather(*[cache.get_or_compute("key", compute) for _ in range(5)])
+
+    assert asyncio.run(run()) == [1, 1, 1, 1, 1]
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["coalesced"] == 4
+
+    for key in ["a", "b", "c"]:
+        asyncio.run(cache.get_or_compute(key, compute))
+    assert cache.stats()["size"] == 2
+    assert "key" not in cache.entries
+
+    #Client of computing request disconnects, requests waiting for the same key still get a result
+    async def cancel_first():
+        first = asyncio.ensure_future(cache.get_or_compute("cancelled", compute))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(cache.get_or_compute("cancelled", compute)) for _ in range(3)]
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await asyncio.gather(*waiters)
+
+    calls = 10
+    assert asyncio.run(cancel_first()) == [12, 12, 12]
+    assert "cancelled" not in cache.in_flight
+
+def test_bulk_endpoints(usage, statements):
+    racks = [rack_data(i) for i in (1, 2)]
+    response = client.post("/racks/bulk", json=racks)
+    assert response.status_code == 200
+    assert [r["id"] for r in response.json()] == [1, 2]
+
+    def devices(count: int, rack_id: int | None, prefix: str) -> list[dict]:
+        return [device_data(i, name=f"{prefix}{i}", serial_number=f"{prefix}-{i}", rack_id=rack_id) for i in range(count)]
+
+    #set based validation, number of statements does not grow with batch size
+    statements.clear()
+    assert client.post("/devices/bulk", json=devices(2, 1, "A")).status_code == 200
+    small_batch = len(statements)
+    statements.clear()
+    response = client.post("/devices/bulk", json=devices(5, 2, "B") + devices(20, None, "C"))
+    assert response.status_code == 200
+    assert len(statements) == small_batch
+    assert usage(1) == (2, 200)
+    assert usage(2) == (5, 500)
+
+    #whole batch is rejected with errors for every invalid item
+    invalid = devices(3, 1, "D")
+    invalid[0]["serial_number"] = "RACK-1"
+    invalid[2]["serial_number"] = "D-1"
+    invalid[2]["rack_id"] = 2
+    invalid[2]["unit_size"] = 11
+    response = client.post("/devices/bulk", json=invalid)
+    assert response.status_code == 400
+    errors = response.json()["detail"]["errors"]
+    assert [e["index"] for e in errors] == [0, 2]
+    assert errors[0]["messages"] == ["Serial number 'RACK-1' already exists."]
+    assert errors[1]["messages"][0] == "Serial number 'D-1' already exists."
+    assert "not enough space" in errors[1]["messages"][1]
+    assert usage(1) == (2, 200)
+
+    #move all devices of rack 2 into rack 1
+    moved = [{**d, "rack_id": 1} for d in client.get("/devices/").json() if d["rack_id"] == 2]
+    response = client.put("/devices/bulk", json=moved)
+    assert response.status_code == 200
+    assert usage(1) == (7, 700)
+    assert usage(2) == (0, 0)
+
+    response = client.put("/racks/bulk", json=[{**racks[0], "id": 1, "unit_capacity": 6}])
+    assert response.status_code == 400
+
+    assert client.post("/devices/bulk_delete", json={"ids": [d["id"] for d in moved]}).status_code == 200
+    assert usage(1) == (2, 200)
+
+    assert client.post("/racks/bulk_delete", json={"ids": [1, 2]}).status_code == 200
+    assert client.get("/racks/").json() == []
+    assert all(d["rack_id"] is None for d in client.get("/devices/").json())
+
+def test_apply_suggestion(database, inventory):
+    inventory([rack_data(i, unit_capacity=4) for i in (1, 2)], [device_data(i, power_consumption=200) for i in range(4)])
+    params = {"device_ids": [1, 2, 3, 4], "rack_ids": [1, 2]}
+
+    response = client.get("/suggestion", params=params)
+    etag = response.headers["ETag"]
+    plan = {"racks": [{"rack_id": r["rack_id"], "device_ids": r["device_ids"]} for r in response.json()]}
+    assert client.post("/suggestion/apply", json=plan).status_code == 428
+
+    response = client.post("/suggestion/apply", json=plan, headers={"If-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    with Session(database) as session:
+        assert {d.id: d.rack_id for d in session.exec(select(Device))} == {1: 1, 2: 2, 3: 1, 4: 2}
+        assert [(r.used_units, r.used_power) for r in session.exec(select(Rack))] == [(2, 400), (2, 400)]
+
+    #plan made before inventory changed is rejected as a whole
+    response = client.post("/suggestion/apply", json={"racks": [{"rack_id": 1, "device_ids": [2]}]}, headers={"If-Match": etag})
+    assert response.status_code == 412
+    with Session(database) as session:
+        assert session.get(Device, 2).rack_id == 2
+
+    #without a plan suggestion is computed in the same transaction
+    response = client.post("/suggestion/apply", json={**params, "rack_ids": [1]})
+    assert response.status_code == 200
+    with Session(database) as session:
+        assert [(r.used_units, r.used_power) for r in session.exec(select(Rack))] == [(4, 800), (0, 0)]
+
+    plan = {"racks": [{"rack_id": 2, "device_ids": [1, 9]}, {"rack_id": 3, "device_ids": [2]}]}
+    response = client.post("/suggestion/apply", json=plan, headers={"If-Match": response.headers["ETag"]})
+    assert response.status_code == 400
+    assert response.json()["detail"]["errors"] == [
+        {"index": 0, "messages": ["Device with id 9 does not exist"]},
+        {"index": 1, "messages": ["Rack with id 3 does not exist"]},
+    ]
+    with Session(database) as session:
+        assert session.get(Device, 1).rack_id == 1
+
+def test_serial_number_registry(database):
+    rack = rack_data(1, id=1, serial_number="SN-1")
+    device = device_data(1, serial_number="SN-1", rack_id=1)
+    assert client.post("/racks/", json=rack).status_code == 200
+    response = client.post("/devices/", json=device)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Serial number 'SN-1' already exists."
+
+    #serial number is released once its owner changes it
+    assert client.put("/racks/1", json={**rack, "serial_number": "SN-2"}).status_code == 200
+    assert client.post("/devices/", json=device).status_code == 200
+    assert client.put("/devices/1", json=device).status_code == 200
+    assert client.put("/devices/1", json={**device, "serial_number": "SN-2"}).status_code == 400
+
+    with Session(database) as session:
+        registry = {s.serial_number: (s.owner_table, s.owner_id) for s in session.exec(select(SerialNumber))}
+        assert registry == {"SN-1": ("device", 1), "SN-2": ("rack", 1)}
+        plan = session.connection().exec_driver_sql("EXPLAIN QUERY PLAN SELECT id FROM device WHERE rack_id = 1").all()
+        assert "ix_device_rack_id" in plan[0][-1]
+
+    assert client.delete("/devices/1").status_code == 200
+    with Session(database) as session:
+        assert session.get(SerialNumber, "SN-1") is None
+
+def test_list_pagination_and_streaming():
+    for url in ["/racks/", "/devices/"]:
+        everything = client.get(url).json()
+        assert [item["id"] for item in everything] == sorted(item["id"] for item in everything)
+
+        pages = []
+        response = client.get(url, params={"limit": 3})
+        while True:
+            assert response.status_code == 200
+            pages.append(response.json())
+            if "next" not in response.links:
+                break
+            response = client.get(response.links["next"]["url"])
+        assert all(len(page) == 3 for page in pages[:-1])
+        assert [item for page in pages for item in page] == everything
+
+        response = client.get(url, params={"stream": True, "after": everything[0]["id"]})
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert [json.loads(line) for line in response.text.splitlines()] == everything[1:]
+
+def test_list_filters(database, inventory):
+    racks = [rack_data(i, name=name, description=description)
+             for i, (name, description) in enumerate([("Alpha", "cold aisle"), ("Beta", "hot aisle"), ("Alpine", "storage")])]
+    devices = [device_data(i, name=name, description=description, unit_size=4, power_consumption=500, rack_id=rack_id)
+               for i, (name, description, rack_id) in enumerate([("web-1", "Web server", 1), ("web-2", "web server", 2), ("db-1", "Database", None)])]
+    inventory(racks, devices)
+
+    def ids(url: str, **params) -> list[int]:
+        response = client.get(url, params=params)
+        assert response.status_code == 200
+        return [item["id"] for item in response.json()]
+
+    assert ids("/devices/", unassigned=True) == [3]
+    assert ids("/devices/", rack_id=2) == [2]
+    assert ids("/devices/", name_prefix="web") == [1, 2]
+    assert ids("/devices/", serial_prefix="DEV-2") == [3]
+    assert ids("/devices/", q="SERV") == [1, 2]
+    assert ids("/devices/", q='web "server', rack_id=1) == [1]
+    assert ids("/racks/", name_prefix="Alp") == [1, 3]
+    assert ids("/racks/", q="aisle") == [1, 2]
+    assert ids("/racks/", min_free_units=7) == [3]
+    assert ids("/racks/", min_free_power=600, limit=1) == [3]
+    #Last code point of a prefix may have no next one
+    assert ids("/racks/", name_prefix="Alp" + chr(0x10FFFF)) == []
+    assert ids("/racks/", name_prefix=chr(0x10FFFF)) == []
+    assert ids("/racks/", name_prefix="Alp" + chr(0xD7FF)) == []
+
+    #search index follows updates and deletes
+    assert client.put("/devices/2", json={**devices[1], "description": "cache"}).status_code == 200
+    assert client.delete("/devices/1").status_code == 200
+    assert ids("/devices/", q="server") == []
+    assert ids("/devices/", q="cache") == [2]
+
+    with Session(database) as session:
+        plan = session.connection().exec_driver_sql("EXPLAIN QUERY PLAN SELECT id FROM rack WHERE rack.unit_capacity - rack.used_units >= 7").all()
+        assert "ix_rack_free_units" in plan[0][-1]
+
+def test_rack_fit(inventory):
+    inventory([rack_data(i, unit_capacity=capacity, max_power_consumption=power)
+               for i, (capacity, power) in enumerate([(10, 1000), (10, 3000), (2, 5000), (10, 2000)])],
+              [device_data(1, unit_size=4, power_consumption=1500, rack_id=2)])
+
+    def fit(**params) -> list[int]:
+        response = client.get("/racks/fit", params=params)
+        assert response.status_code == 200
+        return [r["id"] for r in response.json()]
+
+    #rack 2 has 1500 W and 6 units left, rack 3 has power but not units
+    assert fit(units=4, power=900) == [1, 2, 4]
+    assert fit(units=4, power=900, policy="most_headroom") == [4, 2, 1]
+    assert fit(units=4, power=1600, limit=1) == [4]
+    assert client.get("/racks/fit", params={"units": 4, "power": 1600}).json()[0]["free_power"] == 2000
+    assert fit(units=11, power=1) == []
+
+def test_incremental_suggestion(database, inventory):
+    inventory([rack_data(i, max_power_consumption=power) for i, power in enumerate([1200, 1000, 1000])],
+              [device_data(i, unit_size=size, power_consumption=power, rack_id=rack_id)
+               for i, (size, power, rack_id) in enumerate([(8, 1000, 1), (10, 100, 3), (2, 300, None), (2, 300, None)])])
+
+    #empty racks are assumed without incremental, so the plan overfills rack 1
+    response = client.get("/suggestion", params={"device_ids": [3, 4], "rack_ids": [1, 2, 3]})
+    assert 1 in [r["rack_id"] for r in response.json()]
+
+    #placed devices are skipped, full rack 3 is not even loaded
+    response = client.get("/suggestion", params={"device_ids": [1, 3, 4], "incremental": True})
+    assert response.status_code == 200
+    assert [(r["rack_id"], r["device_ids"], r["power_consumption"]) for r in response.json()] == [(2, [3, 4], 600)]
+
+    response = client.get("/suggestion", params={"incremental": True, "rack_ids": [1], "mode": "optimize"})
+    assert response.status_code == 400
+    response = client.post("/suggestion/apply", json={"incremental": True, "mode": "optimize"})
+    assert response.status_code == 200
+    with Session(database) as session:
+        assert [(r.used_units, r.used_power) for r in session.exec(select(Rack))] == [(8, 1000), (4, 600), (10, 100)]
+
+def test_rebalance(database, inventory, monkeypatch):
+    inventory([rack_data(i) for i in range(3)],
+              [device_data(i, power_consumption=power, rack_id=rack_id)
+               for i, (power, rack_id) in enumerate([(400, 1), (300, 1), (200, 1), (100, 1), (300, 2)])])
+    assert client.post("/suggestion/rebalance", json={}).status_code == 400
+
+    #rack 1 is at 100%, moving the 400 W device is enough
+    response = client.post("/suggestion/rebalance", json={"max_power_percentage": 60})
+    assert response.status_code == 200
+    plan = response.json()
+    assert plan["moves"] == [{"device_id": 1, "from_rack_id": 1, "to_rack_id": 3}]
+    assert plan["target_met"] and not plan["applied"]
+    assert plan["max_power_percentage_before"] == 100.0
+    assert plan["max_power_percentage_after"] == 60.0
+
+    response = client.post("/suggestion/rebalance", json={"max_variance": 0, "max_moves": 1})
+    assert not response.json()["target_met"]
+    assert len(response.json()["moves"]) == 1
+
+    response = client.post("/suggestion/rebalance", json={"max_variance": 100, "dry_run": False})
+    assert response.status_code == 200
+    moves = response.json()["moves"]
+    assert response.json()["target_met"] and response.json()["applied"]
+    with Session(database) as session:
+        used_power = [r.used_power for r in session.exec(select(Rack))]
+        assert sum(used_power) == 1300
+        assert max(used_power) - min(used_power) <= 300
+        assert {d.id: d.rack_id for d in session.exec(select(Device))}[moves[0]["device_id"]] == moves[0]["to_rack_id"]
+
+    #Planning runs without the write lock, a write in the meantime must stop moves from being applied
+    assert client.post("/suggestion/rebalance", json={"max_power_percentage": 10, "dry_run": False},
+                       headers={"If-Match": '"0-0"'}).status_code == 412
+    planner = suggestion.rebalance
+    def rebalance_during_write(*args):
+        with Session(database) as session:
+            session.exec(update(InventoryVersion).values(version=InventoryVersion.version + 1))
+            session.commit()
+        return planner(*args)
+    monkeypatch.setattr(suggestion, "rebalance", rebalance_during_write)
+    response = client.post("/suggestion/rebalance", json={"max_power_percentage": 10, "dry_run": False})
+    assert response.status_code == 412
+    with Session(database) as session:
+        assert sum(r.used_power for r in session.exec(select(Rack))) == 1300
+
+def test_suggestion_jobs():
+    params = {"device_ids": [4, 5, 6, 7], "rack_ids": [3, 4, 5]}
+    expected = client.get("/suggestion", params=params)
+    #Jobs run in the event loop of the app, so one client is kept open for all requests
+    with TestClient(app) as job_client:
+        response = job_client.post("/suggestion/jobs", json={"suggestion": params})
+        assert response.status_code == 202
+        assert response.json()["etag"] == expected.headers["ETag"]
+        job_id = response.json()["id"]
+        for _ in range(200):
+            job = job_client.get(f"/suggestion/jobs/{job_id}").json()
+            if job["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.05)
+        assert job["status"] == "done"
+        assert job["result"] == expected.json()
+        #Another worker process reads the saved job, saving it is scheduled after job finished so it may still run
+        local_job = job_queue.jobs.pop(job_id)
+        for _ in range(200):
+            saved = job_client.get(f"/suggestion/jobs/{job_id}").json()
+            if saved["status"] == "done":
+                break
+            time.sleep(0.05)
+        assert saved == job
+        job_queue.jobs[job_id] = local_job
+
+        response = job_client.post("/suggestion/jobs", json={"suggestion": {"device_ids": [8, 9, 10], "rack_ids": [3, 4]}})
+        job_id = response.json()["id"]
+        for _ in range(200):
+            job = job_client.get(f"/suggestion/jobs/{job_id}").json()
+            if job["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.05)
+        assert job["status"] == "failed"
+        assert job["error"] == "Not enough power to store all devices"
+
+        assert job_client.post("/suggestion/jobs", json={"kind": "rebalance"}).status_code == 400
+        assert job_client.get("/suggestion/jobs/missing").status_code == 404
+
+def test_job_queue_limits():
+    async def run():
+        queue = JobQueue(max_workers=1, max_pending=2, timeout_seconds=0.2, keep_finished=10)
+        try:
+            slow = queue.submit("test", time.sleep, (1,), lambda value: "slow")
+            waiting = queue.submit("test", time.sleep, (0,), lambda value: "waiting")
+            with pytest.raises(QueueFullError):
+                queue.submit("test", time.sleep, (0,), lambda value: "rejected")
+            queue.cancel(waiting)
+            assert waiting.status == JobStatus.CANCELLED
+
+            while slow.status == JobStatus.RUNNING:
+                await asyncio.sleep(0.05)
+            assert slow.status == JobStatus.TIMED_OUT
+            #worker is still busy with timed out job, so its slot is not free yet
+            assert queue.stats()["running"] == 1
+
+            while queue.running:
+                await asyncio.sleep(0.05)
+            quick = queue.submit("test", time.sleep, (0,), lambda value: "quick")
+            while quick.status == JobStatus.RUNNING:
+                await asyncio.sleep(0.05)
+            assert (quick.status, quick.result) == (JobStatus.DONE, "quick")
+        finally:
+            queue.shutdown()
+    asyncio.run(run())
+
+def test_read_model(database, inventory):
+    read_model.enabled, read_model.version, read_model.check_interval_ms = True, None, 60000
+    try:
+        devices = [device_data(i, power_consumption=100 + 50 * (i % 3), rack_id=[1, 1, 2, None][i % 4]) for i in range(12)]
+        inventory([rack_data(i) for i in range(4)], devices)
+
+        def same_as_database(url, params=None):
+            read_model.enabled = False
+            expected = client.get(url, params=params)
+            read_model.enabled = True
+            response = client.get(url, params=params)
+            assert (response.status_code, response.text) == (expected.status_code, expected.text)
+            assert response.headers.get("Link") == expected.headers.get("Link")
+            assert response.headers.get("ETag") == expected.headers.get("ETag")
+
+        urls = [
+            ("/racks", None), ("/racks", {"min_free_power": 800}), ("/racks", {"name_prefix": "R1"}), ("/racks/2", None), ("/racks/9", None),
+            ("/devices", None), ("/devices", {"rack_id": 1}), ("/devices", {"unassigned": True}), ("/devices", {"serial_prefix": "DEV-1"}),
+            ("/devices", {"limit": 5, "after": 3}), ("/devices", {"stream": True}), ("/devices/5", None),
+            ("/suggestion", {"incremental": True}), ("/suggestion", {"device_ids": [4, 8, 12], "rack_ids": [3, 4]}),
+        ]
+        for url, params in urls:
+            same_as_database(url, params)
+        assert client.post("/suggestion/rebalance", json={"max_variance": 0}).status_code == 200
+
+        #writes of this process patch the model without rebuilding it
+        rebuilds = read_model.rebuilds
+        device = {**devices[4], "rack_id": 3}
+        assert client.put("/devices/5", json=device).status_code == 200
+        assert client.delete("/racks/1").status_code == 200
+        assert client.post("/suggestion/apply", json={"incremental": True}).status_code == 200
+        for url, params in urls:
+            same_as_database(url, params)
+        assert read_model.rebuilds == rebuilds
+
+        #write of another process that does not publish version signal is noticed once check interval passes
+        def write_from_other_process(name):
+            with Session(database) as session:
+                session.exec(update(Device).where(Device.id == 2).values(name=name))
+                session.exec(update(InventoryVersion).where(InventoryVersion.table_name == "device").values(version=InventoryVersion.version + 1))
+                session.commit()
+                return session.exec(select(InventoryVersion.version).order_by(InventoryVersion.table_name.desc())).all()
+        write_from_other_process("Renamed")
+        assert client.get("/devices/2").json()["name"] == "D1"
+        read_model.checked_at = 0
+        assert client.get("/devices/2").json()["name"] == "Renamed"
+        assert read_model.rebuilds == rebuilds + 1
+
+        #with the signal it is noticed on next read
+        version_signal.publish(tuple(write_from_other_process("Renamed again")))
+        assert client.get("/devices/2").json()["name"] == "Renamed again"
+        assert read_model.rebuilds == rebuilds + 2
+    finally:
+        read_model.enabled, read_model.version = False, None
+
+def test_busy_database(database, monkeypatch):
+    monkeypatch.setattr(settings, "sqlite_busy_timeout_ms", 50)
+    monkeypatch.setattr(settings, "sqlite_busy_retries", 1)
+    #First connection switches the file to WAL
+    assert client.get("/racks").status_code == 200
+    #Another process holds the write lock
+    with database.connect() as connection:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        response = client.post("/racks/bulk", json=[rack_data(1)])
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        #Readers are not blocked by the writer
+        assert client.get("/racks").status_code == 200
+        connection.exec_driver_sql("ROLLBACK")
+    assert client.post("/racks/bulk", json=[rack_data(1)]).status_code == 200
+
+def test_saved_job_cancelled_from_other_process():
+    with Session(create_engine(os.environ["DATABASE_URL"].replace("+aiosqlite", ""))) as session:
+        session.add(PlanningJob(id="other-worker-job", kind="suggestion", status="running", created_at=time.time()))
+        session.commit()
+    response = client.delete("/suggestion/jobs/other-worker-job")
+    assert response.status_code == 200
+    assert response.json()["status"] == "cancelled"
+    assert client.get("/suggestion/jobs/other-worker-job").json()["status"] == "cancelled"
+
+def test_job_cancelled_through_other_process():
+    async def run() -> Job:
+        queue = JobQueue(max_workers=1, max_pending=1, timeout_seconds=5, keep_finished=10, cancelled=suggestion.saved_job_cancelled)
+        try:
+            job = queue.submit("suggestion", time.sleep, (0.5,), lambda value: [])
+            await suggestion.save_job(job)
+            #Another worker process cancels the job while it runs here
+            async with AsyncSession(engine) as session:
+                await session.exec(update(PlanningJob).where(PlanningJob.id == job.id).values(status=JobStatus.CANCELLED))
+                await session.commit()
+            while job.finished_at is None:
+                await asyncio.sleep(0.05)
+            return job
+        finally:
+            queue.shutdown()
+    job = asyncio.run(run())
+    assert (job.status, job.result) == (JobStatus.CANCELLED, None)
+
+    #Polled on the owner before it finished
+    running = Job("suggestion", time.sleep, (0,), lambda value: [])
+    running.status = JobStatus.RUNNING
+    job_queue.jobs[running.id] = running
+    try:
+        asyncio.run(suggestion.save_job(running))
+        with Session(create_engine(os.environ["DATABASE_URL"].replace("+aiosqlite", ""))) as session:
+            session.exec(update(PlanningJob).where(PlanningJob.id == running.id).values(status=JobStatus.CANCELLED))
+            session.commit()
+        assert client.get(f"/suggestion/jobs/{running.id}").json()["status"] == "cancelled"
+        assert running.status == JobStatus.CANCELLED
+    finally:
+        job_queue.jobs.pop(running.id)
+
+def test_write_takes_lock_once(statements, monkeypatch):
+    #Rows returned and patched into read model are read before commit, no transaction is started after it
+    monkeypatch.setattr(read_model, "enabled", True)
+    monkeypatch.setattr(read_model, "version", None)
+    assert client.get("/racks/").status_code == 200
+    rebuilds = read_model.rebuilds
+    statements.clear()
+    assert client.post("/racks/", json=rack_data(1, id=1)).status_code == 200
+    assert client.post("/devices/bulk", json=[device_data(1, rack_id=1)]).status_code == 200
+    assert [s for s in statements if s.startswith("BEGIN")] == ["BEGIN IMMEDIATE"] * 2
+    assert client.get("/devices/").json()[0]["rack_name"] == "R1"
+    assert read_model.rebuilds == rebuilds
+
+#Writers that validated against the same counters must not overfill a rack together,
+#with deferred transactions writers are not serialized before they validate
+@pytest.mark.parametrize("begin", ["IMMEDIATE", "DEFERRED"])
+def test_concurrent_rack_capacity(begin: str, database, app_engine):
+    async def get_test_write_session():
+        async with AsyncSession(app_engine.execution_options(sqlite_begin=begin), expire_on_commit=False) as session:
+            yield session
+    app.dependency_overrides[get_write_session] = get_test_write_session
+
+    with Session(database) as session:
+        for i in (1, 2):
+            session.add(Rack(**rack_data(i), id=i))
+        for i in range(1, 31):
+            session.add(Device(**device_data(i, unit_size=1 + i % 2), id=i))
+        session.commit()
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            requests = []
+            for i in range(1, 31):
+                requests.append(async_client.post("/devices/add_to_rack", json={"rack_id": 1 + i % 2, "device_id": i}))
+                requests.append(async_client.put(f"/devices/{i}", json=device_data(i, unit_size=2, power_consumption=150, rack_id=2 - i % 2)))
+            return await asyncio.gather(*requests)
+    responses = asyncio.run(run())
+    assert {r.status_code for r in responses} <= {200, 400, 409, 503}
+    succeeded = sum(r.status_code == 200 for r in responses)
+    #Deferred writers that lose the race get 503, but first writer always commits
+    assert succeeded > 0
+    if begin == "IMMEDIATE":
+        assert any(r.status_code == 400 for r in responses)
+
+    with Session(database) as session:
+        placed = session.exec(select(Device).where(Device.rack_id.is_not(None))).all()
+        #Every device in a rack was put there by a request that succeeded
+        assert 0 < len(placed) <= succeeded
+        for rack in session.exec(select(Rack)).all():
+            devices = [d for d in placed if d.rack_id == rack.id]
+            assert rack.used_units == sum(d.unit_size for d in devices) <= rack.unit_capacity
+            assert rack.used_power == sum(d.power_consumption for d in devices) <= rack.max_power_consumption
+
+def test_rack_usage_guard(database, app_engine):
+    with Session(database) as session:
+        session.add(Rack(**rack_data(1), id=1))
+        session.commit()
+
+    async def run():
+        #Device was validated against an empty rack, then another writer filled it
+        with Session(database) as session:
+            session.exec(update(Rack).values(used_units=9, used_power=500))
+            session.commit()
+        async with AsyncSession(app_engine) as session:
+            with pytest.raises(HTTPException) as error:
+                await add_rack_usage(Device(unit_size=2, power_consumption=100, rack_id=1), session)
+            assert error.value.status_code == 400
+            with pytest.raises(HTTPException) as error:
+                await apply_rack_usage({1: [1, 600]}, session)
+            assert error.value.status_code == 409
+            #Usage is only ever lowered without a check
+            await apply_rack_usage({1: [-9, -500]}, session)
+            await session.commit()
+    asyncio.run(run())
+
+    with Session(database) as session:
+        rack = session.get(Rack, 1)
+        assert (rack.used_units, rack.used_power) == (0, 0)
+
+def export_inventory() -> tuple[dict[str, bytes], tuple]:
+    """/export of a small inventory in every format, and lists of racks and devices as the app served them."""
+    with isolated_database() as (engine, app_engine):
+        with Session(engine) as session:
+            session.add(Rack(**rack_data(1, description="Row, \"A\"\nfirst"), id=1))
+            session.add(Rack(**rack_data(2), id=2))
+            session.commit()
+        devices = [device_data(i, rack_id=1 + i % 2) for i in range(1, 6)]
+        assert client.post("/devices/bulk", json=devices + [{**devices[0], "serial_number": "DEV-6", "rack_id": None}]).status_code == 200
+
+        exports = {}
+        for format in ("ndjson", "csv"):
+            response = client.get("/export", params={"format": format})
+            assert response.status_code == 200
+            assert response.headers["ETag"]
+            exports[format] = response.content
+        return exports, (client.get("/devices").json(), client.get("/racks").json())
+
+@pytest.mark.parametrize("format, content_type", [("ndjson", "application/x-ndjson"), ("csv", "text/csv")])
+def test_export_import(format: str, content_type: str, database, monkeypatch):
+    exports, snapshot = export_inventory()
+    lines = [json.loads(line) for line in exports["ndjson"].decode().splitlines()]
+    assert [line["type"] for line in lines] == ["rack"] * 2 + ["device"] * 6
+    assert lines[0]["description"] == "Row, \"A\"\nfirst"
+    assert "used_units" not in lines[0]
+    assert exports["csv"].decode().splitlines()[0] == "type,id,name,description,serial_number,unit_capacity,max_power_consumption,unit_size,power_consumption,rack_id"
+
+    monkeypatch.setattr(settings, "import_batch_size", 4)
+    response = client.post("/import", content=exports[format], headers={"Content-Type": content_type})
+    progress = [json.loads(line) for line in response.text.splitlines()]
+    #Racks and devices are never in the same batch
+    assert [p["status"] for p in progress] == ["running", "running", "done"]
+    assert (progress[-1]["racks"], progress[-1]["devices"]) == (2, 6)
+    assert (client.get("/devices").json(), client.get("/racks").json()) == snapshot
+    with Session(database) as session:
+        assert (session.get(Rack, 1).used_units, session.get(Rack, 2).used_power) == (2, 300)
+
+    #Import again is an update, moving devices keeps counters in sync
+    moved = exports["ndjson"].decode().replace('"rack_id": 2', '"rack_id": 1')
+    response = client.post("/import", content=moved)
+    assert json.loads(response.text.splitlines()[-1])["status"] == "done"
+    with Session(database) as session:
+        assert (session.get(Rack, 1).used_units, session.get(Rack, 2).used_units) == (5, 0)
+
+def test_import_errors(database):
+    rack = {"type": "rack", **rack_data(1, unit_capacity=2)}
+    device = {"type": "device", **device_data(1, rack_id=1)}
+    lines = [rack, device, {**device, "serial_number": "DEV-2"}, {**device, "serial_number": "DEV-1"}, {**device, "serial_number": "DEV-4", "unit_size": 0}]
+    content = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+    progress = [json.loads(line) for line in client.post("/import", params={"format": "ndjson"}, content=content).text.splitlines()]
+    assert [p["status"] for p in progress] == ["running", "failed"]
+    errors = {e["line"]: e["messages"] for e in progress[-1]["errors"]}
+    assert set(errors) == {2, 3, 4, 5, 6}
+    assert errors[6] == ["Line is not valid JSON."]
+    assert "There is not enough space in rack 'R1' to store this device." in errors[2]
+    assert "Serial number 'DEV-1' already exists." in errors[4]
+    assert errors[5] == ["unit_size: Input should be greater than 0"]
+    #Rack batch was written, failed device batch was not
+    with Session(database) as session:
+        assert session.exec(select(Device)).all() == []
+        assert session.get(Rack, 1).used_units == 0
+
+    response = client.post("/import", content="name,description\nR,\n", headers={"Content-Type": "text/csv"})
+    assert json.loads(response.text)["errors"] == [{"line": 1, "messages": ["CSV header must contain type column."]}]
+
+def test_import_releases_write_lock(database, app_engine, monkeypatch):
+    monkeypatch.setattr(settings, "import_batch_size", 1)
+    upload = tempfile.TemporaryFile()
+    upload.write("".join(json.dumps({"type": "rack", **rack_data(i)}) + "\n" for i in (1, 2, 3)).encode())
+    upload.seek(0)
+    #Another process, fails at once if the lock is held
+    writer = sqlite3.connect(database.url.database, timeout=0, isolation_level=None)
+
+    async def run() -> list[str]:
+        statuses = []
+        async with AsyncSession(app_engine.execution_options(sqlite_begin="IMMEDIATE"), expire_on_commit=False) as session:
+            async for line in import_records(upload, TransferFormat.NDJSON, session):
+                #Lock is free while a progress line is sent to the client
+                writer.execute("BEGIN IMMEDIATE")
+                writer.execute("ROLLBACK")
+                statuses.append(json.loads(line)["status"])
+        return statuses
+    try:
+        assert asyncio.run(run()) == ["running", "running", "done"]
+    finally:
+        writer.close()
+
+def test_benchmark_generator():
+    shape = DatacenterShape(racks=20, devices=400, seed=7)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, name) for name in ("a.db", "b.db")]
+        for path in paths:
+            generate(path, shape)
+        dumps = []
+        for path in paths:
+            with Session(create_engine(f"sqlite:///{path}")) as session:
+                racks = session.exec(select(Rack)).all()
+                devices = session.exec(select(Device)).all()
+                dumps.append(([r.model_dump() for r in racks], [d.model_dump() for d in devices]))
+                assert (len(racks), len(devices)) == (20, 400)
+                for rack in racks:
+                    placed = [d for d in devices if d.rack_id == rack.id]
+                    assert rack.used_units == sum(d.unit_size for d in placed) <= rack.unit_capacity
+                    assert rack.used_power == sum(d.power_consumption for d in placed) <= rack.max_power_consumption
+        #Same seed gives same datacenter
+        assert dumps[0] == dumps[1]
+
+    old = {"kind": "load", "results": [{"name": "GET /racks", "p50_ms": 10.0, "p99_ms": 20.0, "requests_per_second": 100.0}]}
+    new = {"kind": "load", "results": [{"name": "GET /racks", "p50_ms": 10.5, "p99_ms": 20.0, "requests_per_second": 80.0}]}
+    rows, regressed = compare_results(old, new, threshold_percent=10)
+    assert regressed
+    assert [row["metric"] for row in rows if row["regression"]] == ["requests_per_second"]
+
+def test_metrics():
+    def sample(text: str, name: str) -> float:
+        return sum(float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(name))
+
+    before = client.get("/metrics").text
+    assert client.get("/racks/1").status_code == 200
+    assert client.get("/suggestion/", params={"device_ids": [4, 5], "rack_ids": [3, 4], "strategy": "balanced"}).status_code == 200
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    after = response.text
+
+    requests = 'datacenter_http_request_duration_seconds_count{method="GET",route="/racks/{rack_id}",status="200"}'
+    assert sample(after, requests) == sample(before, requests) + 1
+    #Route template is the label, not the requested path
+    assert 'route="/racks/1"' not in after
+    statements = 'datacenter_http_request_sql_statements_sum{method="GET",route="/racks/{rack_id}"}'
+    assert sample(after, statements) > sample(before, statements)
+    assert 'datacenter_suggestion_planning_seconds_count{strategy="balanced",mode="greedy",devices="<=10",racks="<=10"}' in after
+    assert 'datacenter_sql_statements_total{operation="SELECT"}' in after
+
+def test_profiling():
+    response = client.get("/suggestion/", params={"device_ids": [4, 5], "rack_ids": [3, 4]}, headers={"X-Profile": "true"})
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    assert profile_id in [p["id"] for p in client.get("/debug/profiles").json()]
+    report = client.get(f"/debug/profiles/{profile_id}")
+    assert report.text.startswith("GET /suggestion/")
+    assert "cumulative" in report.text
+    assert client.get("/debug/profiles/missing").status_code == 404
+    #Requests without header are not profiled
+    assert "X-Profile-Id" not in client.get("/racks/1").headers
+
+def test_slow_and_repeated_queries():
+    async def run():
+        token = profiling.current_trace.set(profiling.RequestTrace({"method": "GET", "path": "/test"}))
+        try:
+            async with AsyncSession(engine) as session:
+                for rack_id in (1, 1, 1):
+                    await session.exec(select(Rack.name).where(Rack.id == rack_id))
+                slow = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 300000) SELECT count(*) FROM c WHERE x > :x"
+                await session.exec(text(slow), params={"x": 5})
+            profiling.report_repeated_selects(profiling.current_trace.get())
+        finally:
+            profiling.current_trace.reset(token)
+
+    slow_query_ms, threshold = settings.slow_query_ms, settings.n_plus_one_threshold
+    settings.slow_query_ms, settings.n_plus_one_threshold = 1, 3
+    try:
+        asyncio.run(run())
+    finally:
+        settings.slow_query_ms, settings.n_plus_one_threshold = slow_query_ms, threshold
+
+    slow = client.get("/debug/slow_queries").json()[0]
+    assert "WITH RECURSIVE" in slow["statement"]
+    assert slow["parameters"] == "(5,)"
+    assert slow["route"] == "GET /test"
+    assert slow["duration_ms"] >= 1
+    repeated = client.get("/debug/n_plus_one").json()[0]
+    assert repeated["count"] == 3
+    assert repeated["route"] == "GET /test"
+    assert "FROM rack" in repeated["statement"]
+
+def test_diagnostics_off_by_default(monkeypatch):
+    for name in ("PROFILING", "SLOW_QUERY_MS", "N_PLUS_ONE_THRESHOLD"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(profiling, "settings", Settings())
+    assert not profiling.diagnostics_enabled()
+
+def test_response_models():
+    #Every JSON route declares its response, so responses skip jsonable_encoder
+    spec = client.get("/openapi.json").json()
+    for path, operations in spec["paths"].items():
+        for method, operation in operations.items():
+            content = next(iter(operation["responses"].values())).get("content", {})
+            if path not in ("/export", "/import"):
+                assert "schema" in content.get("application/json", {}), f"{method} {path}"
+    response = client.get("/suggestion/", params={"device_ids": [4, 5], "rack_ids": [3, 4], "mode": "optimize"})
+    assert response.headers["content-type"] == "application/json"
+    assert set(response.json()) == {"racks", "objective", "optimal"}
+
+def test_conditional_get(inventory, statements):
+    device = device_data(1)
+    inventory([rack_data(1)], [device])
+
+    etags = {}
+    for url in ["/racks/", "/racks/1", "/devices/", "/devices/1", "/devices/?stream=true"]:
+        response = client.get(url)
+        assert response.status_code == 200
+        etags[url] = response.headers["ETag"]
+        statements.clear()
+        response = client.get(url, headers={"If-None-Match": f'"other", W/{etags[url]}'})
+        assert (response.status_code, response.content, response.headers["ETag"]) == (304, b"", etags[url])
+        #Lists read only version, single resources also check that the row exists
+        queries = [s for s in statements if not s.startswith("BEGIN")]
+        assert "FROM inventory_version" in queries[0]
+        assert len(queries) == (2 if url.endswith("/1") else 1)
+    assert etags["/racks/"] == etags["/racks/1"] != etags["/devices/"]
+
+    #* matches only resources that exist
+    for url in ["/racks/1", "/devices/1"]:
+        assert client.get(url, headers={"If-None-Match": "*"}).status_code == 304
+        assert client.get(url[:-1] + "99", headers={"If-None-Match": "*"}).status_code == 404
+
+    #Unplaced device changes device version only
+    assert client.post("/devices/", json={**device, "serial_number": "DEV-2"}).status_code == 200
+    assert client.get("/racks/", headers={"If-None-Match": etags["/racks/"]}).status_code == 304
+    response = client.get("/devices/", headers={"If-None-Match": etags["/devices/"]})
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+
+    #Placing a device changes rack usage, so rack version too
+    assert client.post("/devices/add_to_rack", json={"rack_id": 1, "device_id": 2}).status_code == 200
+    response = client.get("/racks/1", headers={"If-None-Match": etags["/racks/1"]})
+    assert response.status_code == 200
+    assert response.json()["power_consumption"] == 100
+    assert response.headers["ETag"] != etags["/racks/1"]